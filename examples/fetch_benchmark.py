@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+
+'''Per message parse cost of the message list fetch responses.
+
+Compares the generic parser (scan_sexp) with the single pass parser used for
+the usual fetch layouts, for the responses to:
+
+    FETCH 1:* (UID FLAGS RFC822.SIZE INTERNALDATE ENVELOPE)
+
+The last entries time IMAP4P.fetch() against a local server thread, the
+whole path a fetch really takes: the responses are read from the socket,
+classified and parsed. The subjects are sent either quoted, each response is
+a single line, or as literals, the responses are then streamed through
+FetchScanner.
+'''
+
+import socket
+import threading
+from time import time
+
+from imaplibii.imapp import IMAP4P
+from imaplibii.parsefetch import FetchParser, fetch_data_items, \
+    scan_data_items
+
+RESPONSE = ('(UID %d FLAGS (\\Seen) RFC822.SIZE %d INTERNALDATE '
+    '"30-Jan-2008 02:48:01 +0000" ENVELOPE ("Tue, 29 Jan 2008 14:00:24 +0000" '
+    '"Aprenda as tecnicas e os truques da cozinha mais doce %d" '
+    '(("Ediclube" NIL "ediclube" "sigmathis.info")) '
+    '(("Ediclube" NIL "ediclube" "sigmathis.info")) '
+    '((NIL NIL "ediclube" "sigmathis.info")) '
+    '((NIL NIL "helder" "example.com")) NIL NIL NIL '
+    '"<64360f85d83238281a27b921fd3e7eb3@localhost.localdomain>"))')
+
+def serve(listener, data):
+    '''Answers the commands of a single connection, FETCH gets data.'''
+    sock, address = listener.accept()
+    listener.close()
+    f = sock.makefile('rb')
+    sock.sendall('* OK [CAPABILITY IMAP4rev1] ready\r\n')
+    for line in iter(f.readline, ''):
+        tag, command = line.split(' ', 2)[:2]
+        command = command.strip().upper()
+        if command == 'UID':
+            sock.sendall(data)
+        elif command == 'SELECT':
+            sock.sendall('* %d EXISTS\r\n' % data.count('\r\n* '))
+        sock.sendall('%s OK done\r\n' % tag)
+        if command == 'LOGOUT':
+            break
+    sock.close()
+
+def bench_fetch(label, responses):
+    '''Times IMAP4P.fetch_uid() for responses, sent by a local server.'''
+    data = ''.join( '* %d FETCH %s\r\n' % (i + 1, response)
+                    for i, response in enumerate(responses) )
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    server = threading.Thread(target = serve, args = (listener, data))
+    server.daemon = True
+    server.start()
+
+    M = IMAP4P('127.0.0.1', listener.getsockname()[1], autologout = False)
+    M.login('user', 'password')
+    M.select('INBOX')
+
+    a = time()
+    fetched = M.fetch_uid('1:*',
+        '(UID FLAGS RFC822.SIZE INTERNALDATE ENVELOPE)')
+    b = time()
+    assert len(fetched) == len(responses)
+    print '%-40s %8.2f us/msg' % (label, 1e6 * (b - a) / len(responses))
+
+    M.logout()
+    server.join()
+
+def literal_subject(response):
+    '''Sends the subject of response as a literal.'''
+    start = response.index('"Aprenda')
+    end = response.index('"', start + 1) + 1
+    subject = response[start+1:end-1]
+    return '%s{%d}\r\n%s%s' % (response[:start], len(subject), subject,
+        response[end:])
+
+def bench(label, func, responses):
+    a = time()
+    for response in responses:
+        func(response)
+    b = time()
+    print '%-40s %8.2f us/msg' % (label, 1e6 * (b - a) / len(responses))
+
+if __name__ == '__main__':
+    count = 20000
+    responses = [ RESPONSE % (uid, 1000 + uid, uid)
+                  for uid in xrange(1, count + 1) ]
+
+    assert fetch_data_items(responses[0]) == scan_data_items(responses[0])
+
+    print 'Parsing %d fetch responses:' % count
+    print
+    bench('generic (scan_sexp)', scan_data_items, responses)
+    bench('fast path (fetch_data_items)', fetch_data_items, responses)
+    print
+    bench('FetchParser', FetchParser, responses)
+    bench('FetchParser, lazy', lambda r: FetchParser(r, True), responses)
+    print
+    bench_fetch('IMAP4P.fetch, single lines', responses)
+    bench_fetch('IMAP4P.fetch, literals (streamed)',
+        [ literal_subject(response) for response in responses ])
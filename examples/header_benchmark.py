@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+
+'''Header decoding cost over a corpus of 100k envelopes.
+
+The corpus mimics a real mailbox: a few thousand correspondents and
+subjects, some of them used much more often than the others, with about a
+third of the names and subjects RFC 2047 encoded.
+'''
+
+import random
+from time import time
+
+from imaplibii import utils
+
+NAMES = ('Helder Guerreiro', 'Jo\xc3\xa3o Gon\xc3\xa7alves', 'Ediclube',
+    'M\xc3\xbcller', 'Support Team', '\xe6\x9d\x8e\xe5\x9b\x9b')
+SUBJECTS = ('Re: meeting notes', 'A\xc3\xa7\xc3\xa3o de forma\xc3\xa7\xc3\xa3o',
+    'Your invoice', 'Fw: f\xc3\xbcr dich', 'Weekly report')
+
+def encode(text, index):
+    if index % 3:
+        return '%s %d' % (text, index)
+    text = '%s %d' % (text, index)
+    return '=?utf-8?q?%s?=' % ''.join( c.isalnum() and c or '=%02X' % ord(c)
+                                       for c in text )
+
+def corpus(count, names = 3000, subjects = 20000):
+    '''Builds a list of (subject, from, to) envelope tuples.'''
+    rnd = random.Random(2008)
+    def pick(total):
+        return min(int(rnd.paretovariate(1.2)) - 1, total - 1)
+    result = []
+    for i in xrange(count):
+        sender = pick(names)
+        subject = pick(subjects)
+        result.append( (
+            encode(SUBJECTS[subject % len(SUBJECTS)], subject),
+            [ (encode(NAMES[sender % len(NAMES)], sender), None, 'user%d' %
+                sender, 'example.com') ],
+            [ ('Helder Guerreiro', None, 'helder', 'example.com') ] ) )
+    return result
+
+def bench(label, decode, envelopes):
+    a = time()
+    for subject, env_from, env_to in envelopes:
+        decode(subject)
+        for address in env_from + env_to:
+            decode(address[0])
+    b = time()
+    print '%-36s %8.3f s %8.2f us/envelope' % (label, b - a,
+        1e6 * (b - a) / len(envelopes))
+
+if __name__ == '__main__':
+    envelopes = corpus(100000)
+
+    print 'Decoding the headers of %d envelopes:' % len(envelopes)
+    print
+    bench('decodeHeader (no cache)', utils.decodeHeader, envelopes)
+    utils.header_cache.clear()
+    bench('getUnicodeHeader (cold cache)', utils.getUnicodeHeader, envelopes)
+    bench('getUnicodeHeader (warm cache)', utils.getUnicodeHeader, envelopes)
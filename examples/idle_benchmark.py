@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+'''Latency of the IDLE responses delivery.
+
+Bursts of untagged responses, like the ones sent by Exchange, are fed to a
+dispatcher. We measure the time from the first response of a burst to the
+callback, and how many callbacks each burst takes. The IdleDispatcher, with
+an adaptive window, is compared with the old per response Timer, which was
+restarted with a 3 seconds delay on every response.
+'''
+
+import threading
+from time import time, sleep
+
+from imaplibii.imapll import IdleDispatcher
+
+class TimerDispatcher(object):
+    '''The old IMAP4._read_resp_loop behaviour.'''
+    def __init__(self, callback, delay = 3):
+        self.callback = callback
+        self.delay = delay
+        self.timer = None
+        self.buffer = []
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def put(self, line):
+        if self.timer:
+            self.timer.cancel()
+        self.buffer.append(line)
+        self.timer = threading.Timer(self.delay, self._dispatch)
+        self.timer.start()
+
+    def _dispatch(self):
+        burst, self.buffer = self.buffer, []
+        self.callback({ 'tagged': {}, 'untagged': burst })
+
+def bench(label, make_dispatcher, bursts, size, gap, pause):
+    '''
+    @param bursts: number of bursts.
+    @param size: responses on each burst.
+    @param gap: seconds between the responses of a burst.
+    @param pause: seconds between bursts.
+    '''
+    delivered = []
+    def callback(response):
+        delivered.append( (time(), len(response['untagged'])) )
+
+    dispatcher = make_dispatcher(callback)
+    dispatcher.start()
+
+    latencies = []
+    callbacks = 0
+    for burst in range(bursts):
+        count = len(delivered)
+        start = time()
+        for i in range(size):
+            dispatcher.put('* %d EXISTS' % (burst * size + i))
+            sleep(gap)
+
+        # Wait for the whole burst
+        received = 0
+        while received < size:
+            sleep(0.001)
+            received = sum( n for t, n in delivered[count:] )
+        latencies.append(delivered[count][0] - start)
+        callbacks += len(delivered) - count
+        sleep(pause)
+
+    dispatcher.stop()
+    if getattr(dispatcher, 'thread', None):
+        dispatcher.thread.join()
+
+    latencies.sort()
+    print '%-18s %3d x %2d gap %5.3fs  median %7.3fs  max %7.3fs  ' \
+        'callbacks/burst %.2f' % (label, bursts, size, gap,
+        latencies[len(latencies) // 2], latencies[-1],
+        float(callbacks) / bursts)
+
+if __name__ == '__main__':
+    for size, gap in ( (1, 0), (5, 0.002), (5, 0.02) ):
+        bench('Timer(3)', TimerDispatcher, 3, size, gap, 0)
+        bench('IdleDispatcher', IdleDispatcher, 50, size, gap, 0.3)
@@ -29,8 +29,8 @@
 '''
 
 import imaplibii.imapp
+from imaplibii.scheduler import KeepaliveScheduler
 
-from threading import Timer
 import time
 
 imaplibii.imapp.imapll.Debug = 3
@@ -54,10 +54,11 @@ if __name__ == '__main__':
     t = time.time()
     M = imaplibii.imapp.IMAP4P( host, ssl = True)
 
+    scheduler = KeepaliveScheduler()
+
     def do_done():
         print 'trying do_done'
-        pprint.pprint(M.done())
-        #M.state = 'SELECTED'
+        scheduler.stop_idle(M)
 
     pprint.pprint(M.login(USER, PASSWD))
 
@@ -66,12 +67,11 @@ if __name__ == '__main__':
 
     pprint.pprint( M.capabilities)
 
-    mt = Timer(60, do_done)
-    mt.start()
-
-    #M.state = 'IDLE'
+    scheduler.register(M)
+    scheduler.wheel.schedule(60, do_done)
 
-    pprint.pprint(M.idle())
+    scheduler.idle(M)
+    scheduler.unregister(M)
 
     pprint.pprint(M.logout())
     t = time.time() - t
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+'''Throughput of the response reader when fetching large literals.
+
+A thread writes fetch responses with large literals to one end of a socket
+pair, the other end is read the way IMAP4._get_line does: a line, the
+literal, and the rest of the line. The buffered recv_into reader is compared
+with the socket.makefile file object IMAP4 used to read from, the one of a
+socket.socket (the makefile of the bare _socket objects returned by
+socketpair is a C stdio file).
+'''
+
+import socket
+import threading
+from time import time
+
+from imaplibii.imapll import Reader
+
+LITERAL = 'x' * 1000 + '\r\n'
+
+def writer(sock, count, size):
+    literal = (LITERAL * (size // len(LITERAL) + 1))[:size]
+    response = '* 1 FETCH (BODY[] {%d}\r\n%s)\r\n' % (size, literal)
+    for i in xrange(count):
+        sock.sendall(response)
+    sock.close()
+
+def consume(readline, read):
+    total = 0
+    while True:
+        line = readline()
+        if not line:
+            return total
+        size = int(line[line.rfind('{')+1:-3])
+        total += len(line) + len(read(size)) + len(readline())
+
+def bench(label, make_reader, count, size):
+    a_sock, b_sock = socket.socketpair()
+    b_sock = socket.socket(_sock = b_sock)
+    thread = threading.Thread(target = writer, args = (a_sock, count, size))
+    thread.start()
+
+    readline, read = make_reader(b_sock)
+    a = time()
+    total = consume(readline, read)
+    b = time()
+    thread.join()
+    b_sock.close()
+    print '%-24s %8d KB literals %8.1f MB/s' % (label, size // 1024,
+        total / (b - a) / 1e6)
+
+def file_reader(sock):
+    f = sock.makefile('rb')
+    return f.readline, f.read
+
+def recv_into_reader(sock):
+    reader = Reader(sock.recv_into)
+    return reader.readline, reader.read
+
+if __name__ == '__main__':
+    total = 256 * 1024 * 1024
+    for size in (4 * 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024):
+        bench('makefile', file_reader, total // size, size)
+        bench('recv_into', recv_into_reader, total // size, size)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+'''Cost of keeping a timer per connection.
+
+10000 connections each get a 29 minutes IDLE refresh timer, which is then
+cancelled and rescheduled, as done on every IDLE restart. The TimerWheel is
+compared with a threading.Timer per connection (only 1000 of those, each
+one is a thread).
+'''
+
+import threading
+from time import time
+
+from imaplibii.scheduler import TimerWheel, IDLE_REFRESH
+
+def noop():
+    pass
+
+def bench_wheel(connections):
+    wheel = TimerWheel()
+    t = time()
+    timers = [ wheel.schedule(IDLE_REFRESH, noop)
+        for i in xrange(connections) ]
+    scheduled = time() - t
+
+    t = time()
+    for timer in timers:
+        timer.cancel()
+        wheel.schedule(IDLE_REFRESH, noop)
+    rescheduled = time() - t
+
+    print '%-16s %6d timers  schedule %6.2fus  cancel+schedule %6.2fus  ' \
+        'threads %d' % ('TimerWheel', connections,
+        scheduled / connections * 1e6, rescheduled / connections * 1e6,
+        threading.active_count())
+
+def bench_timer(connections):
+    t = time()
+    timers = []
+    for i in xrange(connections):
+        timer = threading.Timer(IDLE_REFRESH, noop)
+        timer.daemon = True
+        timer.start()
+        timers.append(timer)
+    scheduled = time() - t
+    threads = threading.active_count()
+
+    t = time()
+    for timer in timers:
+        timer.cancel()
+        timer.join()
+    cancelled = time() - t
+
+    print '%-16s %6d timers  schedule %6.2fus  cancel %6.2fus           ' \
+        'threads %d' % ('threading.Timer', connections,
+        scheduled / connections * 1e6, cancelled / connections * 1e6,
+        threads)
+
+if __name__ == '__main__':
+    bench_wheel(10000)
+    bench_timer(1000)
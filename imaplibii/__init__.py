@@ -35,6 +35,12 @@ The package contents are:
 * imapll - low level imap library, it makes no attempt to parse the server
 responses;
 * imapp - parsed imap library;
+* imapasync - asynchronous imap library, based on asyncore;
+* idlehub - keeps many connections in IDLE from a single thread;
+* pool - thread safe pool of logged in imapp sessions;
+* partial - resumable download of big messages with partial fetches;
+* scheduler - timer wheel driven keepalives and IDLE refreshes;
+* poller - adaptive mailbox polling for servers without IDLE;
 * parsefetch - parses the fetch command responses;
 * parselist - parses the list and lsub commands responses;
 * sexp - scans nested parentheses lists on a string and transforms it in python
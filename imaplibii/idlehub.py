@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+
+'''IDLE on many connections from a single thread.
+
+The connections, L{IMAP4P<imaplibii.imapp.IMAP4P>} sessions or
+L{IMAP4<imaplibii.imapll.IMAP4>}/L{IMAP4_SSL<imaplibii.imapll.IMAP4_SSL>}
+instances with a mailbox selected, are handed to an L{IdleHub<IdleHub>}.
+The hub sends IDLE, waits for the server responses on all of them with
+epoll (or poll where epoll isn't available) and calls a callback for each
+untagged response. The IDLE is renewed (DONE and IDLE again) before the
+servers drop it.
+
+Usage example::
+
+    from imaplibii.idlehub import IdleHub
+
+    def new_mail(session, name, number, data):
+        if name == 'EXISTS':
+            print '%d messages' % number
+
+    hub = IdleHub()
+    hub.start()
+
+    for user, password in accounts:
+        M = IMAP4P('imap.example.com', autologout = False)
+        M.login(user, password)
+        M.select('INBOX')
+        hub.add(M, new_mail)
+
+The callbacks are called from the hub thread, they shouldn't block. While
+on the hub a connection can't be used for anything else, to use it again
+call L{remove<IdleHub.remove>}.
+
+The sockets are in non blocking mode while on the hub: the responses are
+handled once they're complete, and what a socket doesn't take is sent when
+it becomes writable, so a slow server doesn't stall the other connections.
+'''
+
+# Global imports
+import os
+import re
+import time
+import errno
+import fcntl
+import select
+import socket
+import ssl
+import traceback
+from threading import Thread, Lock
+
+# Local imports
+from imapll import IMAP4, CRLF
+from imapp import IMAP4P
+from parsefetch import FetchParser
+from sexp import scan_sexp
+
+# Constants
+
+IDLE_RENEW = 29 * 60    #: Seconds before the IDLE is renewed (RFC2177)
+RENEW_CHECK = 10        #: Seconds between checks for IDLEs to renew
+HUB_READ_BUFFER = 4096  #: Reader buffer size of the connections on the hub
+
+#: Errors that drop a connection from the hub
+CONNECTION_ERRORS = (IMAP4.Abort, IMAP4.Error, IMAP4P.Abort, socket.error)
+
+untagged_re = re.compile(r'\* (?:(?P<number>\d+) )?(?P<name>[A-Za-z]+)'
+    r'(?: (?P<data>.*))?$', re.DOTALL)
+
+#: Errors of the non blocking sockets when there's nothing to read or no
+#  room to write
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+class Poller(object):
+    '''Readiness of many file descriptors, using epoll when available and
+    poll otherwise. The descriptors are watched for reading, and for writing
+    too when asked.'''
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.mask = select.EPOLLIN
+            self.write_mask = select.EPOLLIN | select.EPOLLOUT
+            self.scale = 1
+        else:
+            self.poller = select.poll()
+            self.mask = select.POLLIN
+            self.write_mask = select.POLLIN | select.POLLOUT
+            self.scale = 1000
+
+    def register(self, fd):
+        self.poller.register(fd, self.mask)
+
+    def modify(self, fd, write):
+        '''Starts or stops watching fd for writing.'''
+        self.poller.modify(fd, self.write_mask if write else self.mask)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout = None):
+        '''@return: list of readable, or writable, file descriptors. The
+        descriptors with errors are returned too, the error shows up when
+        reading.'''
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout *= self.scale
+        try:
+            return [ fd for fd, event in self.poller.poll(timeout) ]
+        except (select.error, IOError), val:
+            if val.args[0] == errno.EINTR:
+                return []
+            raise
+
+class IdleConnection(object):
+    '''State of a connection on the hub.'''
+    __slots__ = ('conn', 'callback', 'fd', 'tag', 'state', 'started',
+        'next', 'removed', 'timeout', 'output', 'want_write', 'writing')
+
+    def __init__(self, conn, callback, fd):
+        self.conn = conn
+        self.callback = callback
+        self.fd = fd
+        self.tag = None
+        self.state = None       # 'STARTING', 'IDLE' or 'DONE'
+        self.started = None     # Time the IDLE was accepted
+        self.next = None        # After DONE: 'renew' or 'remove'
+        self.removed = None     # Called when the connection leaves the hub
+        self.timeout = None     # Socket timeout, restored on remove
+        self.output = ''        # Data the socket didn't take yet
+        self.want_write = False # The SSL layer must write to go on reading
+        self.writing = False    # The socket is watched for writing
+
+class IdleHub(object):
+    '''Keeps many connections in IDLE, from a single thread.
+
+    The callback of each connection is called as::
+
+        callback(connection, name, number, data)
+
+    Where name is the response name, for instance 'EXISTS', 'EXPUNGE',
+    'FETCH' or 'BYE', number is the message number (or None) and data is the
+    rest of the response. The FETCH data is parsed with
+    L{FetchParser<imaplibii.parsefetch.FetchParser>}, the STATUS data (sent
+    by servers with L{NOTIFY<imaplibii.imapp.IMAP4P.notify>}) is a
+    (mailbox, dict) tuple. The untagged OK responses (keep alives) aren't
+    delivered.
+
+    When a connection is lost, or the server rejects the IDLE, the
+    connection leaves the hub and the callback is called with name 'CLOSED'
+    and the reason as data.
+    '''
+    def __init__(self, renew = IDLE_RENEW, read_buffer = HUB_READ_BUFFER):
+        '''
+        @param renew: seconds in IDLE before a connection's IDLE is renewed.
+        @param read_buffer: size of the connections reader buffer while on
+        the hub. The buffer grows if needed.
+        '''
+        self.renew = renew
+        self.read_buffer = read_buffer
+
+        self.poller = Poller()
+        self.connections = {}   # fd: IdleConnection
+        self.last_check = time.time()
+
+        # The requests from other threads are queued, the hub thread is
+        # woken up through a pipe
+        self.lock = Lock()
+        self.requests = []
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self.wakeup_r)
+
+        self.thread = None
+        self.running = False
+
+    def __len__(self):
+        return len(self.connections)
+
+    ##
+    # Requests, can be made from any thread
+    ##
+
+    def _request(self, method, *args):
+        with self.lock:
+            self.requests.append( (method, args) )
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError, val:
+            # The pipe is full, the hub will wake up anyway
+            if val.errno != errno.EAGAIN:
+                raise
+
+    def add(self, conn, callback):
+        '''Puts a connection in IDLE on the hub.
+
+        @param conn: IMAP4P or IMAP4 instance, with a mailbox selected.
+        @param callback: see L{IdleHub<IdleHub>}.
+        '''
+        self._request(self._add, conn, callback)
+
+    def remove(self, conn, removed = None):
+        '''Takes a connection out of IDLE and out of the hub.
+
+        @param removed: called, from the hub thread, with the connection
+        once it's out of IDLE. From then on the connection can be used
+        again.
+        '''
+        self._request(self._remove, conn, removed)
+
+    def stop(self):
+        '''Stops the hub thread, the connections are left as they are.'''
+        self._request(self._stop)
+
+    ##
+    # Main loop
+    ##
+
+    def start(self):
+        '''Runs the hub on a new thread.'''
+        self.thread = Thread(target = self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve_forever(self):
+        self.running = True
+        while self.running:
+            self.loop(RENEW_CHECK)
+
+    def loop(self, timeout = None):
+        '''Runs a single iteration: processes the requests, waits at most
+        timeout seconds for the servers and reads their responses.'''
+        self._process_requests()
+
+        for fd in self.poller.poll(timeout):
+            if fd == self.wakeup_r:
+                try:
+                    os.read(self.wakeup_r, 4096)
+                except OSError:
+                    pass
+                continue
+            entry = self.connections.get(fd)
+            if entry is not None:
+                self._ready(entry)
+
+        self._process_requests()
+
+        now = time.time()
+        if now - self.last_check >= RENEW_CHECK:
+            self.last_check = now
+            self._renew(now)
+
+    def _process_requests(self):
+        with self.lock:
+            requests, self.requests = self.requests, []
+        for method, args in requests:
+            method(*args)
+
+    ##
+    # Connections
+    ##
+
+    def _find(self, conn):
+        try:
+            entry = self.connections.get(conn.socket().fileno())
+        except socket.error:
+            return None
+        if entry is not None and entry.conn is conn:
+            return entry
+        return None
+
+    def _add(self, conn, callback):
+        sock = conn.socket()
+        fd = sock.fileno()
+        entry = IdleConnection(conn, callback, fd)
+        entry.timeout = sock.gettimeout()
+        sock.setblocking(0)
+        conn.reader.resize(self.read_buffer)
+        self.connections[fd] = entry
+        self.poller.register(fd)
+        try:
+            self._idle(entry)
+        except CONNECTION_ERRORS, val:
+            self._drop(entry, str(val))
+
+    def _remove(self, conn, removed):
+        entry = self._find(conn)
+        if entry is None:
+            if removed:
+                removed(conn)
+            return
+
+        entry.next = 'remove'
+        entry.removed = removed
+        if entry.state == 'IDLE':
+            try:
+                self._done(entry)
+            except CONNECTION_ERRORS, val:
+                self._drop(entry, str(val))
+        # If we're waiting for the IDLE continuation DONE is sent when it
+        # arrives, if DONE was already sent the connection is removed when
+        # the IDLE completes
+
+    def _stop(self):
+        self.running = False
+
+    def _unregister(self, entry):
+        del self.connections[entry.fd]
+        try:
+            self.poller.unregister(entry.fd)
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+
+    def _drop(self, entry, reason):
+        '''The connection is lost, or unusable.'''
+        self._unregister(entry)
+        conn = entry.conn
+        conn.state = 'LOGOUT'
+        conn.connected = False
+        try:
+            conn.shutdown()
+        except CONNECTION_ERRORS:
+            pass
+        self._deliver(entry, 'CLOSED', None, reason)
+
+    def _idle(self, entry):
+        conn = entry.conn
+        conn.state = 'IDLE'
+        entry.tag = conn._tag_command('IDLE')
+        entry.state = 'STARTING'
+        self._send(entry, '%s IDLE%s' % (entry.tag, CRLF))
+
+    def _done(self, entry):
+        entry.state = 'DONE'
+        self._send(entry, 'DONE%s' % CRLF)
+
+    def _renew(self, now):
+        '''Renews the IDLEs older than self.renew seconds.'''
+        for entry in self.connections.values():
+            if entry.state == 'IDLE' and now - entry.started >= self.renew:
+                entry.next = 'renew'
+                try:
+                    self._done(entry)
+                except CONNECTION_ERRORS, val:
+                    self._drop(entry, str(val))
+
+    ##
+    # Non blocking IO
+    ##
+
+    def _watch(self, entry):
+        '''Watches the socket for writing while there's data waiting to be
+        sent or the SSL layer needs to write.'''
+        write = bool(entry.output) or entry.want_write
+        if write != entry.writing:
+            self.poller.modify(entry.fd, write)
+            entry.writing = write
+
+    def _send(self, entry, data):
+        '''Sends data to the server, what the socket doesn't take now is
+        sent when it becomes writable.'''
+        conn = entry.conn
+        if conn.compressor:
+            data = conn._deflate(data)
+        entry.output += data
+        self._flush(entry)
+
+    def _flush(self, entry):
+        while entry.output:
+            sent = entry.conn._send_some(entry.output)
+            if not sent:
+                break
+            entry.output = entry.output[sent:]
+        self._watch(entry)
+
+    def _fill(self, entry):
+        '''Reads the data available on the socket to the reader buffer.
+
+        @return: false if there was nothing to read.
+        '''
+        try:
+            if not entry.conn.reader.fill():
+                raise IMAP4.Abort('socket error: EOF')
+        except ssl.SSLError, val:
+            if val.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                # Renegotiation, read again when the socket is writable
+                entry.want_write = True
+                self._watch(entry)
+            elif val.args[0] != ssl.SSL_ERROR_WANT_READ:
+                raise
+            return False
+        except socket.error, val:
+            if val.args[0] not in WOULD_BLOCK:
+                raise
+            return False
+        return True
+
+    def _ready(self, entry):
+        '''The socket is readable or writable.'''
+        try:
+            if entry.want_write:
+                entry.want_write = False
+                self._watch(entry)
+            if entry.output:
+                self._flush(entry)
+        except CONNECTION_ERRORS, val:
+            self._drop(entry, str(val))
+            return
+        self._read(entry)
+
+    ##
+    # Responses
+    ##
+
+    def _read(self, entry):
+        '''Reads from the server and handles the complete responses, the
+        incomplete ones are left on the buffer until the rest arrives.'''
+        conn = entry.conn
+        reader = conn.reader
+        try:
+            while self._fill(entry):
+                while reader.has_response():
+                    self._handle(entry, conn._get_response())
+                    if entry.fd not in self.connections:
+                        return
+                if not conn.data_pending():
+                    break
+        except CONNECTION_ERRORS, val:
+            if entry.fd in self.connections:
+                self._drop(entry, str(val))
+
+    def _handle(self, entry, resp):
+        if isinstance(resp, dict):
+            self._handle_tagged(entry, resp)
+        elif resp[:1] == '+':
+            if entry.state == 'STARTING':
+                if entry.next == 'remove':
+                    self._done(entry)
+                else:
+                    entry.state = 'IDLE'
+                    entry.started = time.time()
+        elif resp:
+            self._handle_untagged(entry, resp)
+
+    def _handle_tagged(self, entry, resp):
+        conn = entry.conn
+        if entry.next == 'remove':
+            self._unregister(entry)
+            conn.state = 'SELECTED'
+            conn.socket().settimeout(entry.timeout)
+            conn.reader.resize()
+            if entry.removed:
+                entry.removed(conn)
+        elif resp['status'] != 'OK' and entry.state == 'STARTING':
+            self._drop(entry, 'IDLE failed: %s' % resp['message'])
+        else:
+            # Renewal, or the server ended the IDLE
+            entry.next = None
+            self._idle(entry)
+
+    def _handle_untagged(self, entry, line):
+        mo = untagged_re.match(line)
+        if not mo:
+            return
+        name = mo.group('name').upper()
+        if name == 'OK':
+            return
+
+        number = mo.group('number')
+        if number is not None:
+            number = int(number)
+        data = mo.group('data')
+        if name == 'FETCH' and data:
+            data = FetchParser(data)
+        elif name == 'STATUS' and data:
+            # NOTIFY event on other mailbox
+            response = scan_sexp(data)
+            it = iter(response[1])
+            data = (response[0], dict(zip(it, it)))
+        self._deliver(entry, name, number, data)
+
+    def _deliver(self, entry, name, number, data):
+        try:
+            entry.callback(entry.conn, name, number, data)
+        except Exception:
+            # Keep the hub running
+            traceback.print_exc()
@@ -0,0 +1,556 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+
+'''Asynchronous IMAP client, built on the asyncore/asynchat modules.
+
+A single thread can drive a large number of connections, each connection is
+a channel on the asyncore socket map. The commands never block, they return
+a L{PendingCommand<imaplibii.imapll.PendingCommand>} handle. A callback can
+be specified for each command, it's called with the handle when the command
+completes.
+
+Usage example::
+
+    from imaplibii.imapasync import IMAP4PAsync, loop
+
+    def new_mail(line):
+        print line
+
+    def selected(handle):
+        print handle.result()
+        M.idle(new_mail)
+
+    def logged_in(handle):
+        M.select('INBOX', callback = selected)
+
+    def connected(M):
+        M.login('user', 'some pass', callback = logged_in)
+
+    M = IMAP4PAsync('imap.example.com', callback = connected)
+    loop()
+
+The L{result<imaplibii.imapll.PendingCommand.result>} method of a handle can
+also be called before the command completes, the asyncore loop is run until
+the response is read.
+'''
+
+# Global imports
+import asyncore, asynchat
+import socket
+
+# Local imports
+import imapll
+from imapll import IMAP4, PendingCommand, literal_size
+from imapll import IMAP4_PORT, CRLF, D_SERVER, D_CLIENT
+from imapp import IMAP4P
+from infolog import InfoLog
+from utils import LiteralString, MessageArray
+
+# Constants
+
+LOOP_TIMEOUT = 30.0 #: Timeout of each poll on the asyncore loop
+
+def loop(timeout = LOOP_TIMEOUT, map = None, count = None):
+    '''Runs the asyncore loop.
+
+    poll is used instead of select, so we aren't limited to FD_SETSIZE
+    connections.
+    '''
+    asyncore.loop(timeout, True, map, count)
+
+class IMAP4Channel(asynchat.async_chat):
+    '''Reads the server lines, and the literals in them, from the socket.
+
+    The literals are read using integer terminators. When a line is complete
+    it's handed to the connection.
+    '''
+    def __init__(self, connection, map = None):
+        asynchat.async_chat.__init__(self, map = map)
+        self.connection = connection
+        self.set_terminator(CRLF)
+
+        self.buffer = []
+        self.reset_line()
+
+    def reset_line(self):
+        self.pieces = []
+        self.literals = []
+        self.lenght = 0
+        self.in_literal = False
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self.buffer)
+        self.buffer = []
+
+        if self.in_literal:
+            # The literal was read, the rest of the line follows
+            self.pieces.append(data)
+            self.lenght += len(data)
+            self.in_literal = False
+            self.set_terminator(CRLF)
+            return
+
+        if __debug__:
+            if imapll.Debug & D_SERVER:
+                print 'S: %s<cr><lf>' % data
+
+        # Verify if a literal is comming
+        size = literal_size(data)
+        if size is not None:
+            self.literals.append( (self.lenght + data.rfind('{'), size) )
+            self.pieces.extend( (data, CRLF) )
+            self.lenght += len(data) + 2
+            if size:
+                self.in_literal = True
+                self.set_terminator(size)
+            return
+
+        if self.literals:
+            self.pieces.append(data)
+            self.lenght += len(data)
+            data = LiteralString(''.join(self.pieces),
+                [ (self.lenght - start, size)
+                  for start, size in self.literals ])
+            self.reset_line()
+
+        self.connection._handle_line(data)
+
+    def handle_connect(self):
+        pass
+
+    def handle_close(self):
+        self.close()
+        self.connection._handle_close()
+
+class IMAP4Async(IMAP4):
+    '''Non blocking IMAP client.
+
+    Like the L{IMAP4<imaplibii.imapll.IMAP4>} class, no attempt is made to
+    parse the server responses, the responses are passed to parse_command.
+    The read and readline methods are not available, the data is read by the
+    asyncore loop.
+
+    The untagged responses that aren't related to a command, and the
+    untagged responses read in IDLE state, are passed to the unsolicited
+    callable, one at a time.
+    '''
+    def __init__(self, host, port=IMAP4_PORT, parse_command = None,
+            callback = None, unsolicited = None, map = None):
+        '''
+        @param callback: called with this instance as argument when the
+        server greeting is read.
+        @param unsolicited: called with the untagged responses that aren't
+        related to a command.
+        @param map: asyncore socket map.
+        '''
+        # Connection
+        self.host = host
+        self.port = port
+        self.map = map
+        self.connected = False
+
+        self._new_session()
+
+        # State of the connection:
+        self.state = 'LOGOUT'
+        self.welcome = None
+        self.callback = callback
+
+        if parse_command:
+            self.parse_command = parse_command
+        else:
+            self.parse_command = self.dummy_parse_command
+
+        if unsolicited:
+            self.unsolicited = unsolicited
+        else:
+            self.unsolicited = self.dummy_unsolicited
+
+        # Open the connection to the server
+        self.open( host, port )
+
+    def open(self, host=None, port=None):
+        '''Starts a non blocking connection to "host:port"'''
+        if not host:
+            host = self.host
+        if not port:
+            port = self.port
+
+        af, socktype, proto, canonname, sa = socket.getaddrinfo(host, port,
+            socket.AF_UNSPEC, socket.SOCK_STREAM)[0]
+
+        self.channel = IMAP4Channel(self, self.map)
+        self.channel.create_socket(af, socktype)
+        self.channel.connect(sa)
+        self.connected = True
+
+    def read(self, size):
+        raise self.Error('read is not available on asynchronous connections')
+
+    def readline(self):
+        raise self.Error('readline is not available on asynchronous '
+            'connections')
+
+    def send(self, data):
+        '''Queues data to be sent to the server.'''
+        if __debug__:
+            if imapll.Debug & D_CLIENT:
+                print 'C: %s' % data.replace(CRLF,'<cr><lf>')
+        if not self.connected:
+            raise self.Abort('socket error: not connected')
+        self.channel.push(data)
+
+    def start_compression(self, level = None):
+        raise self.Error('compression is not available on asynchronous '
+            'connections')
+
+    def shutdown(self):
+        '''Close the connection.'''
+        self.channel.close()
+        self.connected = False
+
+    def socket(self):
+        return self.channel.socket
+
+    def send_command(self, command, callback = None):
+        '''Send a command to the server, without waiting for the response.
+
+        @param command: command to be sent to the server, without the tag and
+        the final CRLF.
+        @param callback: if specified, it's called with the handle as argument
+        when the command completes.
+
+        @return: a L{PendingCommand<imaplibii.imapll.PendingCommand>}
+        instance.
+        '''
+        tag = self._tag_command(command)
+        handle = PendingCommand(self, tag, command, callback)
+
+        # Check for literals, the pieces after a synchronizing literal are
+        # sent when the server requests a continuation
+        pieces = self._literal_pieces(command)
+        for piece in pieces[1:]:
+            self.continuation_data.push(piece)
+
+        self.pending.append(handle)
+        self.send('%s %s%s' % (tag, pieces[0], CRLF))
+
+        return handle
+
+    def pipeline(self, commands, callback = None):
+        '''Send severall commands, see L{send_command<send_command>}.'''
+        return [ self.send_command(command, callback) for command in commands ]
+
+    def _read_pipeline(self, handle):
+        '''Runs the asyncore loop until the handle is completed.'''
+        while not handle.completed:
+            if not self.connected:
+                raise self.Abort('socket error: EOF')
+            loop(map = self.map, count = 1)
+
+    def wait_welcome(self):
+        '''Runs the asyncore loop until the server greeting is read.'''
+        while self.welcome is None:
+            if not self.connected:
+                raise self.Abort('socket error: EOF')
+            loop(map = self.map, count = 1)
+        return self.welcome
+
+    def dummy_unsolicited(self, line):
+        '''Passes the unsolicited responses to parse_command.'''
+        self.parse_command(None, { 'tagged' : {},
+                                   'untagged' : [line] })
+
+    ##
+    # asyncore events
+    ##
+
+    def _handle_line(self, line):
+        '''Called by the channel with each complete line.'''
+        if self.welcome is None:
+            self.welcome = line
+            self._check_welcome()
+            if self.callback:
+                self.callback(self)
+            return
+
+        # The IDLE continuation request
+        if ((line[:2] == '+ ' or line == '+') and self.pending and
+            self.pending[-1].command == 'IDLE'):
+            self.state = 'IDLE'
+            return
+
+        resp = self._classify_line(line)
+        if isinstance(resp, dict):
+            for i, pending in enumerate(self.pending):
+                if pending.tag == resp['tag']:
+                    break
+            else:
+                raise self.Abort('unexpected tagged response: %s' % line)
+            del self.pending[i]
+            pending._complete(resp)
+        elif resp is None:
+            # We've sent a continuation
+            pass
+        elif self.pending and self.state != 'IDLE':
+            self.pending[0].response['untagged'].append(resp)
+        else:
+            self.unsolicited(resp)
+
+    def _handle_close(self):
+        '''Called when the connection is closed, the pending commands are
+        aborted.
+        '''
+        self.connected = False
+        self.state = 'LOGOUT'
+
+        pending, self.pending = self.pending, []
+        for handle in pending:
+            handle._abort(self.Abort('socket error: connection closed'))
+
+class IMAP4PAsync(IMAP4P):
+    '''Asynchronous version of L{IMAP4P<imaplibii.imapp.IMAP4P>}.
+
+    The commands return a L{PendingCommand<imaplibii.imapll.PendingCommand>}
+    handle. Its L{result<imaplibii.imapll.PendingCommand.result>} method
+    returns the same as the corresponding IMAP4P method, or raises the same
+    exception.
+
+    Only the most used commands are available, any other command can be
+    sent with L{command<command>}.
+    '''
+    def __init__(self,
+            host,
+            port = IMAP4_PORT,
+            infolog = None,
+            lazy_fetch = False,
+            structure_cache = None,
+            callback = None,
+            map = None ):
+        '''
+        @param callback: called with this instance as argument when the
+        server greeting is read.
+        @param map: asyncore socket map.
+        '''
+        self.connect_callback = callback
+        self.idle_callback = None
+        self.map = map
+
+        if infolog is None:
+            infolog = InfoLog()
+
+        IMAP4P.__init__(self, host, port, infolog = infolog,
+            autologout = False, lazy_fetch = lazy_fetch,
+            structure_cache = structure_cache)
+
+    def _transport(self, host, port, ssl, stream, keyfile, certfile):
+        return IMAP4Async( host = host, port = port,
+            parse_command = self.parse_command,
+            callback = self._connected,
+            unsolicited = self._unsolicited,
+            map = self.map )
+
+    def _connected(self, transport):
+        self.welcome = transport.welcome
+        self.infolog.addEntry('WELCOME', self.welcome)
+        if self.connect_callback:
+            self.connect_callback(self)
+
+    def _unsolicited(self, line):
+        self.parse_command(None, { 'tagged' : {},
+                                   'untagged' : [line] })
+        if self.state == 'IDLE' and self.idle_callback:
+            self.idle_callback(line)
+
+    ##
+    # Command processing
+    ##
+
+    def command(self, name, args = None, callback = None, uid = False,
+            key = None, initial = None, done = None):
+        '''Sends a command.
+
+        @param name: Valid IMAP4 command.
+        @param args: Command arguments.
+        @param callback: called with the handle when the command completes.
+        @param uid: if true, the UID version of the command is used.
+        @param key: the result of the command is <instance>.sstatus[key],
+        if not specified the result is <instance>.sstatus.
+        @param initial: if specified, <instance>.sstatus[key] is set to
+        a copy of this value before the responses are read.
+        @param done: called with no arguments if the command was successfull,
+        before the result is taken.
+
+        @return: a L{PendingCommand<imaplibii.imapll.PendingCommand>}
+        instance.
+        '''
+        # Verifies if it's a valid command
+        self._test_command(name)
+        command = name
+        if uid:
+            self._test_command('UID')
+            command = 'UID %s' % name
+
+        # Composes the command
+        if args:
+            command = '%s %s' % ( command, args )
+
+        def complete(handle):
+            if not handle.exc_info:
+                if not self._checkok(handle.tag, handle.parsed):
+                    error = self.Error('Error in command %s - %s' % (command,
+                        handle.parsed['tagged'][handle.tag]['message']))
+                    handle.exc_info = (self.Error, error, None)
+                else:
+                    if done:
+                        done()
+                    if key:
+                        handle.parsed = self.sstatus.get(key)
+                    else:
+                        handle.parsed = self.sstatus
+
+            # The next command gets a fresh result
+            if initial is not None:
+                self.sstatus[key] = type(initial)(initial)
+
+            if callback:
+                callback(handle)
+
+        if initial is not None and key not in self.sstatus:
+            self.sstatus[key] = type(initial)(initial)
+
+        return self.send_command(command, complete)
+
+    ##
+    # IMAP Commands
+    ##
+
+    def capability(self, callback = None):
+        '''Fetch capabilities list from server.'''
+        return self.command('CAPABILITY', callback = callback,
+            key = 'capability')
+
+    def has_capability(self, capability):
+        '''Since we can't block, the capabilities must have been read
+        already.
+        '''
+        return capability in self.capabilities
+
+    def login(self, user, password, callback = None):
+        '''Identify client using plaintext password.'''
+        def done():
+            self.state = 'AUTH'
+
+        return self.command('LOGIN', '%s \"%s\"' % (user, password),
+            callback, done = done)
+
+    def logout(self, callback = None):
+        self.state = 'LOGOUT'
+        return self.command('LOGOUT', callback = callback)
+
+    def noop(self, callback = None):
+        return self.command('NOOP', callback = callback)
+
+    def list(self, directory='', pattern='*', callback = None):
+        return self.command('LIST', '"%s" "%s"' % ( directory, pattern ),
+            callback, key = 'list_response', initial = [])
+
+    def select(self, folder, readonly = False, callback = None):
+        '''Selects a folder'''
+        if readonly:
+            name = 'EXAMINE'
+        else:
+            name = 'SELECT'
+
+        def done():
+            self.sstatus['current_folder']['name'] = folder
+            self.state = 'SELECTED'
+
+            if self.structure_cache is not None:
+                self._check_uidvalidity(folder,
+                    self.sstatus['current_folder'].get('UIDVALIDITY'))
+
+        self.sstatus['current_folder'] = {}
+
+        return self.command(name, '"%s"' % folder, callback,
+            key = 'current_folder', done = done)
+
+    def examine(self, folder, callback = None):
+        return self.select(folder, True, callback)
+
+    def status(self, mailbox, names, callback = None):
+        return self.command('STATUS', '"%s" %s' % (mailbox, names), callback,
+            key = 'status_response', initial = {})
+
+    def search(self, criteria, charset = None, callback = None, uid = False):
+        '''Search mailbox for matching messages'''
+        if charset:
+            args = 'CHARSET %s %s' % ( charset, criteria)
+        else:
+            args = '%s' % criteria
+
+        return self.command('SEARCH', args, callback, uid,
+            key = 'search_response', initial = MessageArray())
+
+    def search_uid(self, criteria, charset = None, callback = None):
+        return self.search(criteria, charset, callback, True)
+
+    def fetch(self, message_list, message_parts = '(FLAGS)', callback = None,
+            uid = False):
+        '''Fetch (parts of) messages.
+
+        The message list must fit on a single command line.
+        '''
+        message_set, = self._message_sets(message_list,
+            len('UID FETCH  %s' % message_parts))
+
+        return self.command('FETCH', '%s %s' % (message_set, message_parts),
+            callback, uid, key = 'fetch_response', initial = {})
+
+    def fetch_uid(self, message_list, message_parts = '(FLAGS)',
+            callback = None):
+        return self.fetch(message_list, message_parts, callback, True)
+
+    def idle(self, callback, done_callback = None):
+        '''Initiate IDLE mode.
+
+        @param callback: called with each untagged response sent by the
+        server while in IDLE state. The response was already parsed, and
+        <instance>.sstatus updated, when the callback is called.
+        @param done_callback: called with the handle when the IDLE command
+        completes, after L{done<done>}.
+        '''
+        name = 'IDLE'
+        if not self.has_capability(name):
+            raise self.Abort('Server does not support the IDLE extension')
+
+        self.idle_callback = callback
+
+        return self.command(name, callback = done_callback)
@@ -35,6 +35,7 @@ COMMANDS = {
         'CAPABILITY':   ('NONAUTH', 'AUTH', 'SELECTED', 'LOGOUT'),
         'CHECK':        ('SELECTED',),
         'CLOSE':        ('SELECTED',),
+        'COMPRESS':     ('AUTH', 'SELECTED'),
         'COPY':         ('SELECTED',),
         'CREATE':       ('AUTH', 'SELECTED'),
         'DELETE':       ('AUTH', 'SELECTED'),
@@ -57,6 +58,7 @@ COMMANDS = {
         'MYRIGHTS':     ('AUTH', 'SELECTED'),
         'NAMESPACE':    ('AUTH', 'SELECTED'),
         'NOOP':         ('NONAUTH', 'AUTH', 'SELECTED', 'LOGOUT'),
+        'NOTIFY':       ('AUTH', 'SELECTED'),
         'PARTIAL':      ('SELECTED',),                            # NB: obsolete
         'PROXYAUTH':    ('AUTH',),
         'RENAME':       ('AUTH', 'SELECTED'),
@@ -75,6 +77,32 @@ COMMANDS = {
         'UNSUBSCRIBE':  ('AUTH', 'SELECTED'),
         }
 
+# Commands that can be sent again, on a new connection, if the connection is
+# lost before their response arrives. The non UID FETCH isn't here, the
+# message numbers can change between sessions.
+IDEMPOTENT = ('CAPABILITY',
+              'EXAMINE',
+              'GETACL',
+              'GETANNOTATION',
+              'GETQUOTA',
+              'GETQUOTAROOT',
+              'LIST',
+              'LISTRIGHTS',
+              'LSUB',
+              'MYRIGHTS',
+              'NAMESPACE',
+              'NOOP',
+              'SEARCH',
+              'SELECT',
+              'SORT',
+              'STATUS',
+              'THREAD',
+              'UID FETCH',
+              'UID SEARCH',
+              'UID SORT',
+              'UID THREAD',
+             )
+
 # Addicional status messages returned on the tagged or untagged responses:
 # 'OK','NO','BAD', 'PREAUTH', 'BYE'
 STATUS = ('ALERT',
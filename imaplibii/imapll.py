@@ -35,14 +35,15 @@ standard python IMAP client module) by Piers Lauder.
 '''
 
 # Global imports
-import socket, random, re, ssl
-from threading import Timer
+import socket, random, re, ssl, sys, os, errno, zlib, time, traceback
+from threading import Timer, Thread, current_thread
+from Queue import Queue, Empty
 import pprint
 from subprocess import PIPE, Popen
-from platform import system
 
 # Local imports
-from utils import Int2AP, ContinuationRequests
+from utils import Int2AP, ContinuationRequests, LiteralString, makeTagged
+from utils import LiteralHandle
 
 # Constants
 
@@ -54,13 +55,419 @@ Debug = 0
 #Debug = D_SERVER | D_CLIENT
 
 MAXCOMLEN = 48      #: Max command len to store on the tagged_commands dict
+LITERAL_CHUNK = 65536 #: Max size of the literal chunks written to a sink
+READ_BUFFER = 65536 #: Initial size of the read buffer
+DIRECT_READ = 16384 #: Literals from this size on are read to their own buffer
+SINK_THRESHOLD = 1048576 #: Literals from this size on are written to the sink
 
 IMAP4_PORT = 143    #: Default IMAP port
 IMAP4_SSL_PORT = 993 #: Default IMAP SSL port
 CRLF = '\r\n'
 
-literal_re = re.compile('.*{(?P<size>\d+)}$')
-send_literal_re = re.compile('.*{(?P<size>\d+)}\r\n')
+LITERALMINUS_MAX = 4096 #: Max size of a non synchronizing LITERAL- literal
+
+IDLE_WINDOW = 0.1   #: Initial coalescing window for the IDLE responses (s)
+IDLE_MIN_WINDOW = 0.01 #: Min coalescing window (s)
+IDLE_MAX_WINDOW = 3.0 #: Max coalescing window (s)
+IDLE_WINDOW_FACTOR = 2 #: Window size, in average gaps between responses
+IDLE_GAP_WEIGHT = 0.2 #: Weight of each new gap on the average
+
+COMPRESS_LEVEL = 6  #: zlib compression level used with COMPRESS=DEFLATE
+
+send_literal_re = re.compile(r'{(?P<size>\d+)}\r\n')
+
+def split_literals(command):
+    '''Splits a command on its literals.
+
+    For instance::
+
+        >>> split_literals('APPEND INBOX {5}\\r\\nHello {3}\\r\\nabc')
+        ['APPEND INBOX {5}', 'Hello {3}', 'abc']
+
+    The literal contents aren't searched for literal specifications.
+
+    @param command: command with literals in the form {<size>}CRLF<data>
+
+    @return: list of command pieces, all the pieces except the last end with a
+    literal specification, {<size>}, the pieces after the first start with the
+    literal data.
+    '''
+    pieces = []
+    start = pos = 0
+    while True:
+        lt = send_literal_re.search(command, pos)
+        if not lt:
+            break
+        pieces.append(command[start:lt.end()-2])
+        start = lt.end()
+        pos = start + int(lt.group('size'))
+    pieces.append(command[start:])
+    return pieces
+
+def literal_size(line):
+    '''Checks if a line ends with a literal specification, {<size>}.
+
+    Only the end of the line is examined.
+
+    @param line: line read from the server, without the final CRLF.
+
+    @return: the literal size or None if the line doesn't end with a literal.
+    '''
+    if line[-1:] != '}':
+        return None
+
+    size = line[line.rfind('{')+1:-1]
+    if size.isdigit():
+        return int(size)
+    return None
+
+class Reader(object):
+    '''Buffered reader built on recv_into.
+
+    The data is read from the server to a preallocated buffer, which grows
+    when a line or a small literal doesn't fit on it and shrinks back once
+    it's consumed.
+    The lines and the small literals are sliced from the buffer using a
+    memoryview. The literals of DIRECT_READ octets or more are received
+    straight into a buffer of their own size, see L{read_into<read_into>}.
+    '''
+    def __init__(self, recv_into, size = READ_BUFFER):
+        '''
+        @param recv_into: callable, it gets a writable buffer and returns the
+        number of bytes read to it, 0 on EOF.
+        @param size: initial size of the buffer.
+        '''
+        self.recv_into = recv_into
+        self.size = size    # Size the buffer shrinks back to
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First byte not consumed
+        self.end = 0    # End of the data read
+
+    def _recv(self, view):
+        while True:
+            try:
+                return self.recv_into(view)
+            except (socket.error, OSError), val:
+                if val.args[0] != errno.EINTR:
+                    raise
+
+    def _make_room(self, size):
+        '''Makes room on the buffer for 'size' bytes after start.'''
+        if self.start + size <= len(self.buffer):
+            return
+
+        if self.start:
+            # Move the data not consumed to the begining of the buffer
+            data = self.view[self.start:self.end].tobytes()
+            self.buffer[:len(data)] = data
+            self.start, self.end = 0, len(data)
+
+        if size > len(self.buffer):
+            del self.view
+            self.buffer.extend(bytearray(max(size, 2 * len(self.buffer)) -
+                len(self.buffer)))
+            self.view = memoryview(self.buffer)
+
+    def fill(self):
+        '''Reads more data from the server to the buffer. Only one read is
+        made, so it doesn't block if the socket is readable.
+
+        @return: false on EOF.
+        '''
+        if self.start == self.end:
+            self.start = self.end = 0
+        else:
+            self._make_room(self.end - self.start + 1)
+
+        size = self._recv(self.view[self.end:])
+        if not size:
+            return False
+        self.end += size
+        return True
+
+    def has_line(self):
+        '''@return: true if there's a complete line on the buffer.'''
+        return self.buffer.find('\n', self.start, self.end) != -1
+
+    def has_response(self):
+        '''@return: true if there's a complete response on the buffer, the
+        lines with all their literals.'''
+        buffer = self.buffer
+        pos = self.start
+        while True:
+            eol = buffer.find('\n', pos, self.end)
+            if eol == -1:
+                return False
+            # The line ends with '{<size>}\r\n' if a literal follows
+            if eol - pos < 4 or buffer[eol-2:eol-1] != '}':
+                return True
+            size = buffer[buffer.rfind('{', pos, eol)+1:eol-2]
+            if not size.isdigit():
+                return True
+            pos = eol + 1 + int(size)
+
+    def resize(self, size = READ_BUFFER):
+        '''Reallocates the buffer with 'size' bytes, or the size of the data
+        not consumed if it's bigger. The connections that spend most of their
+        time idle can use a small buffer. The buffer shrinks back to 'size'
+        after reading a line or a literal that didn't fit on it.
+        '''
+        data = self.view[self.start:self.end].tobytes()
+        del self.view
+        self.size = size
+        self.buffer = bytearray(max(size, len(data)))
+        self.buffer[:len(data)] = data
+        self.view = memoryview(self.buffer)
+        self.start, self.end = 0, len(data)
+
+    def readline(self):
+        '''@return: a line, with the final LF, or '' on EOF.'''
+        pos = self.buffer.find('\n', self.start, self.end)
+        if pos != -1:
+            line = self.view[self.start:pos+1].tobytes()
+            self.start = pos + 1
+            return line
+
+        scanned = self.end - self.start
+        while True:
+            # The buffer may be compacted, keep the relative position
+            if not self.fill():
+                return ''
+            pos = self.buffer.find('\n', self.start + scanned, self.end)
+            if pos != -1:
+                break
+            scanned = self.end - self.start
+
+        line = self.view[self.start:pos+1].tobytes()
+        self.start = pos + 1
+        if len(self.buffer) > self.size:
+            # A long line made the buffer grow
+            self.resize(self.size)
+        return line
+
+    def read(self, size):
+        '''@return: a string with 'size' bytes, less on EOF.'''
+        start = self.start
+        if self.end - start < size:
+            if size >= DIRECT_READ:
+                data = bytearray(size)
+                del data[self.read_into(memoryview(data)):]
+                return str(data)
+
+            self._make_room(size)
+            while self.end - self.start < size:
+                if not self.fill():
+                    break
+            start = self.start
+
+        data = self.view[start:start+size].tobytes()
+        self.start = start + len(data)
+        if len(self.buffer) > self.size:
+            self.resize(self.size)
+        return data
+
+    def read_into(self, view):
+        '''Fills a writable buffer: the bytes on the buffer are copied to it,
+        the rest is received straight into it.
+
+        @param view: a writable buffer, for instance a memoryview.
+
+        @return: the number of bytes read, less than len(view) on EOF.
+        '''
+        size = len(view)
+        got = min(size, self.end - self.start)
+        view[:got] = self.view[self.start:self.start+got]
+        self.start += got
+
+        while got < size:
+            read = self._recv(view[got:])
+            if not read:
+                break
+            got += read
+        return got
+
+    def take_buffered(self):
+        '''Empties the buffer.
+
+        @return: the data read from the server and not yet consumed.
+        '''
+        data = self.view[self.start:self.end].tobytes()
+        self.start = self.end = 0
+        return data
+
+class IdleDispatcher(object):
+    '''Delivers the untagged responses received in IDLE state.
+
+    The reader thread queues the responses with L{put<put>}, a single
+    dispatcher thread takes them from the queue and calls the callback.
+
+    Some servers send a burst of responses for a single change (Exchange
+    sends five), the responses that arrive within the coalescing window of
+    the previous one are delivered together. The window follows the gaps
+    observed inside the bursts: it's IDLE_WINDOW_FACTOR times the moving
+    average of the gaps up to twice the current window, so a response that
+    just missed a burst makes the window grow. The gaps between bursts aren't
+    counted.
+    '''
+    def __init__(self, callback, window = IDLE_WINDOW,
+            min_window = IDLE_MIN_WINDOW, max_window = IDLE_MAX_WINDOW):
+        '''
+        @param callback: called, from the dispatcher thread, with a response
+        dict ({'tagged': {}, 'untagged': [...]}) for each burst.
+        @param window: initial coalescing window, in seconds.
+        @param min_window: the window never gets smaller than this.
+        @param max_window: the window never gets bigger than this.
+        '''
+        self.callback = callback
+        self.window = window
+        self.min_window = min_window
+        self.max_window = max_window
+
+        self.gap = float(window) / IDLE_WINDOW_FACTOR # Average gap
+        self.last_event = None
+        self.queue = Queue()
+        self.thread = None
+
+    def put(self, line):
+        '''Queues a response, it's safe to call from any thread.'''
+        self.queue.put( (time.time(), line) )
+
+    def start(self):
+        '''Starts the dispatcher thread, if it isn't running.'''
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = Thread(target = self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        '''Stops the dispatcher thread, after delivering the queued
+        responses. Waits for the thread, unless called from it (from the
+        callback), so that a following L{start<start>} gets a new one.'''
+        thread = self.thread
+        if thread is None or not thread.is_alive():
+            return
+        self.queue.put(None)
+        if thread is not current_thread():
+            thread.join()
+
+    def _observe(self, when):
+        '''Adapts the window to the gap since the previous response.'''
+        if self.last_event is not None:
+            gap = when - self.last_event
+            if gap <= 2 * self.window:
+                self.gap += IDLE_GAP_WEIGHT * (gap - self.gap)
+                self.window = min(self.max_window, max(self.min_window,
+                    IDLE_WINDOW_FACTOR * self.gap))
+        self.last_event = when
+
+    def _run(self):
+        get = self.queue.get
+        while True:
+            item = get()
+            if item is None:
+                return
+
+            # Collect the burst
+            burst = []
+            while item is not None:
+                when, line = item
+                self._observe(when)
+                burst.append(line)
+
+                timeout = when + self.window - time.time()
+                try:
+                    if timeout > 0:
+                        item = get(True, timeout)
+                    else:
+                        item = get(False)
+                except Empty:
+                    break
+
+            self._dispatch(burst)
+            if item is None:
+                return
+
+    def _dispatch(self, burst):
+        try:
+            self.callback({ 'tagged': {}, 'untagged': burst })
+        except Exception:
+            # Keep the dispatcher running
+            traceback.print_exc()
+
+class PendingCommand(object):
+    '''Handle for a command sent with L{IMAP4.pipeline<IMAP4.pipeline>}.
+
+    The server response is only read when it's needed, either when
+    L{result<result>} is called, or while reading the response to another
+    command.
+
+    Attributes:
+
+        - tag: the tag used on the command;
+        - command: the command, as sent to the server;
+        - response: the response dict, it gets the untagged responses as
+          they arrive;
+        - callback: if not None, it's called with the handle as argument as
+          soon as the command is completed.
+    '''
+    def __init__(self, connection, tag, command, callback = None):
+        self.connection = connection
+        self.tag = tag
+        self.command = command
+        self.callback = callback
+
+        self.response = { 'tagged' : {},
+                          'untagged' : [] }
+        self.completed = False
+        self.parsed = None
+        self.exc_info = None
+
+    def done(self):
+        '''@return: True if the tagged response was already read.'''
+        return self.completed
+
+    def _complete(self, tagged):
+        '''Called when the tagged response is read, the response is passed
+        to parse_command.
+        '''
+        self.response['tagged'][self.tag] = tagged
+        self.completed = True
+        try:
+            self.parsed = self.connection.parse_command(self.tag,
+                self.response)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+        if self.callback:
+            self.callback(self)
+
+    def _abort(self, error):
+        '''Called when the command can't be completed, for instance because
+        the connection was closed.
+        '''
+        self.completed = True
+        self.exc_info = (error.__class__, error, None)
+
+        if self.callback:
+            self.callback(self)
+
+    def result(self):
+        '''Waits for the command completion.
+
+        @return: the server response filtred by parse_command. If
+        parse_command raised an exception, it is raised again here.
+        '''
+        if not self.completed:
+            self.connection._read_pipeline(self)
+
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.parsed
+
+    def __repr__(self):
+        return '<PendingCommand %s %s%s>' % (self.tag, self.command,
+            self.completed and ' (done)' or '')
 
 class IMAP4(object):
     '''Bare bones IMAP client.
@@ -93,9 +500,8 @@ class IMAP4(object):
                                       'command': 'LOGOUT'
             }}}
 
-    It's very easy to transform this class so that we can send severall
-    commands to the server in paralel. Maybe in the future we can
-    implement this.
+    Severall commands can be sent to the server in a single write with
+    L{pipeline<pipeline>}, this saves a round trip per command.
 
     Usage example::
 
@@ -124,6 +530,25 @@ class IMAP4(object):
         self.host = host
         self.port = port
 
+        self._new_session()
+
+        # Open the connection to the server
+        self.open( host, port )
+
+        # State of the connection:
+        self.state = 'LOGOUT'
+
+        self.welcome = self._get_response()
+
+        if parse_command:
+            self.parse_command = parse_command
+        else:
+            self.parse_command = self.dummy_parse_command
+
+        self._check_welcome()
+
+    def _new_session(self):
+        '''Initializes the tags and the command queues of the session.'''
         # Create unique tag for this session,
         # and compile tagged response matcher.
         self.tagpre = Int2AP(random.randint(4096, 65535))
@@ -135,19 +560,39 @@ class IMAP4(object):
         self.tagged_commands = {}
         self.continuation_data = ContinuationRequests()
 
-        # Open the connection to the server
-        self.open( host, port )
+        # Pipelined commands waiting for a response, in the order they
+        # were sent
+        self.pending = []
 
-        # State of the connection:
-        self.state = 'LOGOUT'
+        # Non synchronizing literals supported by the server, None,
+        # 'LITERAL+' or 'LITERAL-' (RFC 7888)
+        self.nonsync_literals = None
 
-        self.welcome = self._get_response()
+        # The literals with sink_threshold octets or more are written to
+        # literal_sink, see _get_line
+        self.literal_sink = None
+        self.sink_threshold = SINK_THRESHOLD
 
-        if parse_command:
-            self.parse_command = parse_command
-        else:
-            self.parse_command = self.dummy_parse_command
+        # Called with the first line of each response, it can return a
+        # scanner to which the response is fed as it arrives, see
+        # _get_response
+        self.response_scanner = None
+
+        # Delivers the responses received in IDLE state, created on the
+        # first IDLE
+        self.idle_dispatcher = None
 
+        # DEFLATE compression (RFC 4978), see start_compression
+        self.compressor = None
+        self.decompressor = None
+        self.compress_stats = { 'sent': 0, 'sent_compressed': 0,
+            'received': 0, 'received_compressed': 0 }
+
+        # Time of the last data sent, used to skip needless keepalives
+        self.last_activity = time.time()
+
+    def _check_welcome(self):
+        '''Sets the connection state from the server greeting.'''
         if 'PREAUTH' in self.welcome:
             self.state = 'AUTH'
         elif 'OK' in self.welcome:
@@ -214,31 +659,12 @@ class IMAP4(object):
 
         return sock
 
-    def _read(self, size, read_from, rettype=str):
-        """
-        Abstracted version of read.
-        Contains fixes for ssl and Darwin
-        """
-        # sslobj.read() sometimes returns < size bytes
-        data = bytearray()
-        read = 0
-        if (system() == 'Darwin') and (size>0):
-            # This is a hack around Darwin's implementation of realloc() (which
-            # Python uses inside the socket code). On Darwin, we split the
-            # message into 100k chunks, which should be small enough - smaller
-            # might start seriously hurting performance ...
-            # this is taken from OfflineIMAP
-            to_read = lambda s,r: min(s-r,8192)
-        else:
-            to_read = lambda s,r: s-r
-        while len(data) < size:
-            #data = read_from.read(size-read)
-            data.extend( read_from.read(to_read(size,read)) )
-            #read = len(data)
-
-        if type(data) is not rettype:
-            data = rettype(data)
-        return data
+    def _recv_into(self, buffer):
+        '''Reads data from the server to buffer.
+
+        @return: the number of bytes read, 0 on EOF.
+        '''
+        return self.sock.recv_into(buffer)
 
     ##
     # Overridable methods
@@ -256,20 +682,30 @@ class IMAP4(object):
         '''
 
         self.sock = self._open(host, port)
-        self.file = self.sock.makefile('rb')
+        self.reader = Reader(self._recv_into)
 
     def read(self, size):
         '''Read 'size' bytes from remote.'''
         if __debug__:
             if Debug & D_SERVER:
                 print 'S: Read %d bytes from the server.' % size
-        #Use the abstracted _read method for consistancy.
-        #return self._read(size, self.file)
-        return self.file.read(size)
+        data = self.reader.read(size)
+        if len(data) < size:
+            raise self.Abort('socket error: EOF')
+        return data
+
+    def read_into(self, view):
+        '''Read len(view) bytes from remote to the writable buffer view (see
+        L{Reader.read_into<Reader.read_into>}).'''
+        if __debug__:
+            if Debug & D_SERVER:
+                print 'S: Read %d bytes from the server.' % len(view)
+        if self.reader.read_into(view) < len(view):
+            raise self.Abort('socket error: EOF')
 
     def readline(self):
         '''Read line from remote.'''
-        line = self.file.readline()
+        line = self.reader.readline()
         if not line:
             raise self.Abort('socket error: EOF')
         if __debug__:
@@ -277,19 +713,37 @@ class IMAP4(object):
                 print 'S: %s' % line.replace(CRLF,'<cr><lf>')
         return line
 
+    def _sendall(self, data):
+        '''Sends all the data to the server.'''
+        self.sock.sendall(data)
+
+    def _send_some(self, data):
+        '''Sends as much data as the socket takes, on non blocking sockets.
+
+        @return: the number of bytes sent, 0 if the socket can't take more.
+        '''
+        try:
+            return self.sock.send(data)
+        except socket.error, val:
+            if val.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+
     def send(self, data):
         '''Send data to remote.'''
         if __debug__:
             if Debug & D_CLIENT:
                 print 'C: %s' % data.replace(CRLF,'<cr><lf>')
+        self.last_activity = time.time()
+        if self.compressor:
+            data = self._deflate(data)
         try:
-            self.sock.sendall(data)
-        except (socket.error, OSError), val:
-            raise self.abort('socket error: %s' % val)
+            self._sendall(data)
+        except (socket.error, IOError, OSError), val:
+            raise self.Abort('socket error: %s' % val)
 
     def shutdown(self):
         '''Close I/O established in "open".'''
-        self.file.close()
         self.sock.close()
 
     def socket(self):
@@ -309,6 +763,88 @@ class IMAP4(object):
         '''
         self.continuation_data.push( obj )
 
+    ##
+    # Compression, RFC 4978
+    ##
+
+    def start_compression(self, level = COMPRESS_LEVEL):
+        '''Starts the DEFLATE compression of the connection.
+
+        Must be called right after the tagged OK response to a
+        'COMPRESS DEFLATE' command. From then on the data read from and sent
+        to the server goes through raw zlib streams. The compressor is
+        flushed with Z_SYNC_FLUSH at the end of each send, so each command
+        reaches the server without waiting for more data.
+
+        The byte counts, compressed and uncompressed, are kept on
+        <instance>.compress_stats.
+
+        @param level: zlib compression level.
+        '''
+        if self.compressor:
+            raise self.Error('Compression already active')
+
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+
+        # Whatever was read past the OK response is already compressed
+        self.inflate_input = self.reader.take_buffered()
+        self.compress_stats['received_compressed'] += len(self.inflate_input)
+        self.inflate_buffer = bytearray(READ_BUFFER)
+        self.reader.recv_into = self._inflate_into
+
+    def data_pending(self):
+        '''@return: true if there's data already read from the socket that
+        didn't reach the reader buffer yet (compression, SSL). In this case
+        the socket may not be readable, but the reader can be filled.
+        '''
+        return bool(self.decompressor and (self.inflate_input or
+            self.decompressor.unconsumed_tail))
+
+    def _deflate(self, data):
+        '''Compresses data to be sent to the server.'''
+        stats = self.compress_stats
+        stats['sent'] += len(data)
+        data = (self.compressor.compress(data) +
+            self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        stats['sent_compressed'] += len(data)
+        return data
+
+    def _inflate_into(self, buffer):
+        '''Reads and decompresses data from the server to buffer.
+
+        The decompressed data that doesn't fit on the buffer is kept on the
+        decompressor (unconsumed_tail) for the next call.
+
+        @return: the number of bytes read, 0 on EOF.
+        '''
+        stats = self.compress_stats
+        size = len(buffer)
+        while True:
+            data = self.decompressor.unconsumed_tail
+            if not data:
+                data, self.inflate_input = self.inflate_input, ''
+            if not data:
+                read = self._recv_into(self.inflate_buffer)
+                if not read:
+                    return 0
+                stats['received_compressed'] += read
+                data = str(self.inflate_buffer[:read])
+            data = self.decompressor.decompress(data, size)
+            if data:
+                buffer[:len(data)] = data
+                stats['received'] += len(data)
+                return len(data)
+
+    def compression_ratio(self):
+        '''@return: (sent, received) compressed to uncompressed ratios, 1.0
+        when nothing went through the compressor.
+        '''
+        stats = self.compress_stats
+        return (float(stats['sent_compressed']) / (stats['sent'] or 1) or 1.0,
+            float(stats['received_compressed']) / (stats['received'] or 1)
+            or 1.0)
+
     ##
     # SEND/RECEIVE commands from the server
     ##
@@ -322,6 +858,11 @@ class IMAP4(object):
             - <instance>.tagged_commands[tag] - contains the first MAXCOMLEN
               of the command;
 
+        The command can also be a list of strings and
+        L{StreamLiteral<imaplibii.utils.StreamLiteral>} instances, the literal
+        specifications are added before each literal and the literal data is
+        sent in chunks, see L{_send_streamed<_send_streamed>}.
+
         @param command: command to be sent to the server, without the tag and
         the final CRLF.
         @param read_resp: it true, automatically reads the server response.
@@ -331,80 +872,143 @@ class IMAP4(object):
             - tag: the tag used on the sent command;
             - response from the server to the sent command (only if read_resp);
         '''
-        tag = self._new_tag()
-
-        # Do not store the complete command on tagged_commands
-        if len(command) > MAXCOMLEN:
-            tagcommand = command[:MAXCOMLEN] + ' ...'
+        # The pipelined commands must be completed first, we don't want to
+        # mix their responses with the response to this command. The server
+        # can complete them in any order.
+        while self.pending:
+            self.pending[-1].result()
+
+        if isinstance(command, basestring):
+            tag = self._tag_command(command)
+
+            # Check for literals, the pieces after a synchronizing literal are
+            # sent when the server requests a continuation
+            pieces = self._literal_pieces(command)
+            for piece in pieces[1:]:
+                self.continuation_data.push(piece)
+
+            # Send the command to the server
+            self.send('%s %s%s' % (tag, pieces[0], CRLF))
         else:
-            tagcommand = command
-
-        # Check for a literal:
-        lt = send_literal_re.search(command)
-        if lt:
-            # If there are any additional command arguments, the literal octets
-            # are followed by a space and those arguments (from RFC3501 sec 7.5)
-            self.continuation_data.push(command[lt.end():])
-            command = command[:lt.end()-2]
-
-        # Send the command to the server
-        self.tagged_commands[tag] = tagcommand
-        self.send('%s %s%s' % (tag, command, CRLF))
+            tag = self._tag_command(''.join( part if isinstance(part,
+                basestring) else '{%d}' % part.size for part in command ))
+            self._send_streamed(tag, command)
 
         if read_resp:
             return tag, self.read_responses(tag)
         else:
             return tag
 
+    def pipeline(self, commands, callback = None):
+        '''Send severall commands to the server in a single write, without
+        waiting for the responses.
+
+        Example::
+
+            handles = M.pipeline(['STATUS INBOX (MESSAGES)',
+                                  'STATUS Sent (MESSAGES)'])
+            for handle in handles:
+                response = handle.result()
+
+        The untagged responses are routed to the oldest command still
+        waiting for its tagged response, so the server order is kept. The
+        response to each command is passed to L{parse_command<parse_command>}
+        as soon as the command completes.
+
+        Commands with synchronizing literals can't be pipelined, since the
+        server must acknowledge the literal before the rest of the command is
+        sent. If the server supports non synchronizing literals (LITERAL+ or
+        LITERAL-) the commands with literals can be pipelined.
+
+        @param commands: list of commands, without tag and final CRLF.
+        @param callback: if specified, it's called with the handle as argument
+        when each command completes.
+
+        @return: list of L{PendingCommand<PendingCommand>}, one for each
+        command.
+        '''
+        handles = []
+        data = []
+        for command in commands:
+            pieces = self._literal_pieces(command)
+            if len(pieces) > 1:
+                raise self.Error('Can\'t pipeline a command with a literal: %s'
+                    % command[:MAXCOMLEN])
+
+            tag = self._tag_command(command)
+            handles.append(PendingCommand(self, tag, command, callback))
+            data.append('%s %s%s' % (tag, pieces[0], CRLF))
+
+        self.pending.extend(handles)
+        self.send(''.join(data))
+
+        return handles
+
+    def _read_pipeline(self, handle):
+        '''Reads the server responses until the pipelined command handle is
+        completed.
+        '''
+        while not handle.completed:
+            if not self.pending:
+                raise self.Error('Command %s is not pending' % handle.tag)
+
+            resp = self._get_response()
+            if isinstance(resp, dict):
+                for i, pending in enumerate(self.pending):
+                    if pending.tag == resp['tag']:
+                        break
+                else:
+                    raise self.Abort('unexpected tagged response: %s' %
+                        makeTagged(resp))
+                del self.pending[i]
+                pending._complete(resp)
+            elif resp is not None:
+                self.pending[0].response['untagged'].append(resp)
+
     def _read_resp_loop(self, response):
         '''
         Modified read_responses loop meant for IDLE.
 
         The idea is to keep reading data from the server until we know we
         have all of the data that was requested by our last command.
-        
+
         The problem with this is it doesn't quite work for IDLE notification.
         We want updates from IDLE to go into the dispatcher NOW, not 30 minutes
-        later when we end IDLE mode.
+        later when we end IDLE mode. The untagged responses received in IDLE
+        state are handed to the connection L{IdleDispatcher<IdleDispatcher>},
+        which calls L{idle_dispatch<idle_dispatch>} for each burst.
         '''
-        data_release = None
-        resp_buffer = { 'tagged' : {},
-                        'untagged' : [] }
+        dispatcher = None
 
         while self.tagged_commands:
             # If we have responses to read we should get them
             # from the server up until there are no more responses
             resp = self._get_response()
 
-            # This little gem is necessary for Exchange.
-            # Unlike sane imap servers like Gmail, when something
-            # is done to cause an IDLE notification to go off
-            # Exchange isn't satisified with sending out just one
-            # message, no! It has to send out 5 :(
-            if self.state == 'IDLE':
-                try: data_release.cancel()
-                except AttributeError:
-                    pass #quack!
-
-            resp_buffer = self._build_read_resp(resp, resp_buffer)
-
-            if self.state == 'IDLE':
-                data_release = Timer(3, self._idle_dispatch, (resp_buffer,))
-                            #TODO: may be interesting to do heuristics one day
-                            # on the timer value so it can change to suit its env.
-                data_release.start()
-
-        response = resp_buffer
+            if self.state == 'IDLE' and isinstance(resp, str):
+                if dispatcher is None:
+                    dispatcher = self._get_idle_dispatcher()
+                    dispatcher.start()
+                dispatcher.put(resp)
+            else:
+                response = self._build_read_resp(resp, response)
+
+        if dispatcher is not None:
+            dispatcher.stop()
+
         return response
 
-    def _idle_dispatch(self, response):
-        try:
-            return self.idle_dispatch(response)
-        finally:
-            response['tagged'].clear()
-            del response['untagged'][:]
+    def _get_idle_dispatcher(self):
+        '''The dispatcher is kept with the connection, this way its window
+        adapts to the server.'''
+        if self.idle_dispatcher is None:
+            self.idle_dispatcher = IdleDispatcher(self.idle_dispatch)
+        return self.idle_dispatcher
 
     def idle_dispatch(self, response):
+        '''Called from the dispatcher thread with the responses received in
+        IDLE state, override it.
+        '''
         #TODO: replace the print statements below with NotImplemented exception.
         print 'Not implemented!'
         print '(got %s response tho, btw)' % str(response)
@@ -503,23 +1107,229 @@ class IMAP4(object):
         self.tagnum += 1
         return tag
 
-    def _get_line(self):
-        '''Gets a line from the server. If the line contains a literal in it,
-        it will recurse until we have read a complete line.
+    def _literal_pieces(self, command):
+        '''Splits a command on its synchronizing literals.
+
+        The literals are made non synchronizing, {<size>+}, when the server
+        supports it (LITERAL+, or LITERAL- for the literals up to
+        LITERALMINUS_MAX octets). Those literals are sent inline.
+
+        @return: list of command pieces, the first piece is sent with the
+        command, the others must be sent as continuations. If the
+        command has additional arguments after a literal, the literal octets
+        are followed by a space and those arguments (from RFC3501 sec 7.5).
+        '''
+        pieces = split_literals(command)
+        if len(pieces) == 1:
+            return pieces
+
+        result = []
+        current = pieces[0]
+        for piece in pieces[1:]:
+            if self._nonsync(literal_size(current)):
+                current = '%s+}%s%s' % (current[:-1], CRLF, piece)
+            else:
+                result.append(current)
+                current = piece
+        result.append(current)
+
+        return result
+
+    def _nonsync(self, size):
+        '''Checks if a literal can be sent as a non synchronizing literal.'''
+        return (self.nonsync_literals == 'LITERAL+' or
+            (self.nonsync_literals == 'LITERAL-' and
+             size <= LITERALMINUS_MAX))
+
+    def _send_streamed(self, tag, parts):
+        '''Sends a command with streamed literals.
+
+        The parts up to the first synchronizing literal are sent right away,
+        the others are sent by continuation callables when the server
+        requests them. The non synchronizing literals are sent inline.
+
+        @param tag: the command tag.
+        @param parts: list of strings and StreamLiteral instances.
+        '''
+        groups = [ ['%s ' % tag] ]
+        for part in parts:
+            if isinstance(part, basestring):
+                groups[-1].append(part)
+            elif self._nonsync(part.size):
+                groups[-1].extend( ('{%d+}%s' % (part.size, CRLF), part) )
+            else:
+                groups[-1].append('{%d}' % part.size)
+                groups.append([ part ])
+
+        for group in groups[1:]:
+            self.continuation_data.push(
+                lambda challenge, group = group: self._send_parts(group))
+
+        self.send(self._send_parts(groups[0]) + CRLF)
+
+    def _send_parts(self, parts):
+        '''Sends command parts, the literals are sent chunk by chunk.
+
+        @return: the text after the last literal, it's not sent so that the
+        caller can send it together with the final CRLF.
+        '''
+        text = []
+        for part in parts:
+            if isinstance(part, basestring):
+                text.append(part)
+            else:
+                if text:
+                    self.send(''.join(text))
+                    text = []
+                sent = 0
+                for chunk in part:
+                    self.send(chunk)
+                    sent += len(chunk)
+                if sent != part.size:
+                    # The server is waiting for the rest of the literal
+                    raise self.Abort('Literal size changed while sending: '
+                        '%d instead of %d' % (sent, part.size))
+        return ''.join(text)
+
+    def _tag_command(self, command):
+        '''Returns a new tag, and stores the command on tagged_commands.'''
+        tag = self._new_tag()
+
+        # Do not store the complete command on tagged_commands
+        if len(command) > MAXCOMLEN:
+            self.tagged_commands[tag] = command[:MAXCOMLEN] + ' ...'
+        else:
+            self.tagged_commands[tag] = command
+
+        return tag
+
+    def _get_line(self, line = None):
+        '''Gets a line from the server. If the line contains literals in it,
+        they are read and the line is assembled with them.
+
+        The lines and the literals are collected on a single buffer, the
+        literals are received straight into it. When there are literals the
+        line is returned as a L{LiteralString<LiteralString>}, which records
+        the position of each literal.
+
+        If <instance>.literal_sink is set, the literals with sink_threshold
+        octets or more are written to the sink, see
+        L{_sink_literal<_sink_literal>}.
+
+        @param line: the first line of the response, with the final CRLF, if
+        it was already read.
         '''
         # Read a line from the server
-        line = self.readline()[:-2]
+        if line is None:
+            line = self.readline()
+        line = line[:-2]
 
         # Verify if a literal is comming
-        lt = literal_re.match(line)
-        if lt:
-            # read 'size' bytes from the server and append them to
-            # the line read and read the rest of the line
-            size = int(lt.group('size'))
-            literal = self.read(size)
-            line += CRLF + literal + self._get_line()
+        size = literal_size(line)
+        if size is None:
+            return line
 
-        return line
+        data = bytearray()
+        end = 0     # End of the response on the buffer
+        literals = []
+        handles = []
+        while size is not None:
+            start = line.rfind('{')
+            if self.literal_sink is not None and size >= self.sink_threshold:
+                # The literal is replaced by an empty one
+                handles.append( (end + start, self._sink_literal(size)) )
+                line = line[:start] + '{0}'
+                size = 0
+            literals.append( (end + start, size) )
+            line += CRLF
+
+            # Room for the line, the literal and the lines that follow
+            if end + len(line) + size > len(data):
+                grown = bytearray(max(end + len(line) + size + DIRECT_READ,
+                    2 * len(data)))
+                grown[:end] = memoryview(data)[:end]
+                data = grown
+            data[end:end+len(line)] = line
+            end += len(line)
+
+            if size:
+                # read 'size' bytes from the server straight to the buffer,
+                # the literal is followed by the rest of the line
+                self.read_into(memoryview(data)[end:end+size])
+                end += size
+
+            line = self.readline()[:-2]
+            size = literal_size(line)
+
+        data[end:] = line
+        lenght = len(data)
+        return LiteralString(data,
+            [ (lenght - start, size) for start, size in literals ],
+            [ (lenght - start, handle) for start, handle in handles ])
+
+    def _sink_literal(self, size):
+        '''Writes a literal to <instance>.literal_sink, in chunks of at most
+        LITERAL_CHUNK octets.
+
+        The sink can be a writable object (all the literals are written to
+        it) or a callable, called with the literal size, that returns the
+        object where the literal is written.
+
+        @return: a L{LiteralHandle<LiteralHandle>}.
+        '''
+        sink = self.literal_sink
+        if not hasattr(sink, 'write'):
+            sink = sink(size)
+
+        try:
+            offset = sink.tell()
+        except (AttributeError, IOError):
+            offset = None
+
+        left = size
+        while left:
+            chunk = self.read(min(left, LITERAL_CHUNK))
+            sink.write(chunk)
+            left -= len(chunk)
+
+        return LiteralHandle(sink, offset, size)
+
+    def scan_response(self, scanner, line = None):
+        '''Reads a complete server response, feeding it to an incremental
+        scanner as it arrives.
+
+        Unlike L{_get_line<_get_line>}, the response is never assembled in
+        memory, the lines and the literals are passed to the scanner as soon
+        as they're read from the server. The scanner can process the complete top level
+        elements while the rest of the response is still being transfered.
+
+        The literals that go to <instance>.literal_sink (see
+        L{_sink_literal<_sink_literal>}) are skipped on the scanner, their
+        L{LiteralHandle<imaplibii.utils.LiteralHandle>} takes their place.
+
+        @param scanner: an incremental scanner, for instance a
+        L{SexpScanner<imaplibii.sexp.SexpScanner>} instance.
+        @param line: the first line of the response, with the final CRLF, if
+        it was already read.
+
+        @return: the scanner.
+        '''
+        while True:
+            if line is None:
+                line = self.readline()
+            scanner.feed(line)
+
+            # Verify if a literal is comming
+            size = literal_size(line[:-2])
+            if size is None:
+                return scanner
+            line = None
+
+            if self.literal_sink is not None and size >= self.sink_threshold:
+                scanner.skip_literal(self._sink_literal(size))
+                continue
+
+            scanner.feed(self.read(size))
 
     def _get_response(self):
         '''This method is called from within L{read_responses<read_responses>},
@@ -533,10 +1343,23 @@ class IMAP4(object):
               continaution response will be poped from the continuation queue.
               If we don't have a prepared continuation, we'll try to cancel the
               command by sending a '*'.
-        '''
-        # Read a line from the server
-        line = self._get_line()
 
+        If <instance>.response_scanner returns a scanner for the first line
+        of the response, the response is fed to it as it arrives (see
+        L{scan_response<scan_response>}) and None is returned.
+        '''
+        line = self.readline()
+        if self.response_scanner is not None:
+            scanner = self.response_scanner(line)
+            if scanner is not None:
+                self.scan_response(scanner, line)
+                return None
+        return self._classify_line(self._get_line(line))
+
+    def _classify_line(self, line):
+        '''Classifies a complete line (with the literals) read from the
+        server, see L{_get_response<_get_response>}.
+        '''
         # Verify whether it's a tagged or untagged response:
         tg = self.tagre.match(line)
         if tg:
@@ -581,7 +1404,6 @@ class IMAP4_SSL(IMAP4):
         certfile = None,
         parse_command=None):
 
-        self.readbuf = bytearray()
         self.keyfile = keyfile
         self.certfile = certfile
         IMAP4.__init__(self, host=host, port=port, parse_command=parse_command)
@@ -594,41 +1416,25 @@ class IMAP4_SSL(IMAP4):
         """
         self.sock = self._open(host, port)
         self.sslobj = ssl.wrap_socket(self.sock, self.keyfile, self.certfile)
-        self.file = self.sslobj.makefile('rb')
+        self.reader = Reader(self._recv_into)
 
-    def bad_read(self, size, rettype=str):
-        """Read 'size' bytes from remote."""
-        if __debug__:
-            if Debug & D_SERVER:
-                print 'S: Read %d bytes from the server.' % size
-        #data = self._read(size, self.sslobj, rettype=rettype)
-        #return data
-        return self.sslobj.read(size)
-
-    def bad_readline(self, rettype=str):
-        """Read line from remote."""
-        while 1:
-            self.readbuf.extend( self.read(1024, bytearray) )
-            nlidx = self.readbuf.find('\n')
-            if nlidx != -1:
-                line = self.readbuf[:nlidx+1]
-                del self.readbuf[:nlidx+1]
-                if type(line) is not rettype:
-                    line = rettype(line)
-                if __debug__:
-                    if Debug & D_SERVER:
-                        print 'S: %s' % line.replace(CRLF,'<cr><lf>')
-                return line
+    def _recv_into(self, buffer):
+        return self.sslobj.recv_into(buffer)
 
-    def send(self, data):
-        '''Send data to remote.'''
-        if __debug__:
-            if Debug & D_CLIENT:
-                print 'C: %s' % data.replace(CRLF,'<cr><lf>')
+    def data_pending(self):
+        return self.sslobj.pending() > 0 or IMAP4.data_pending(self)
+
+    def _sendall(self, data):
+        self.sslobj.sendall(data)
+
+    def _send_some(self, data):
         try:
-            self.sslobj.sendall(data)
-        except (socket.error, OSError), val:
-            raise self.abort('socket error: %s' % val)
+            return self.sslobj.send(data)
+        except ssl.SSLError, val:
+            if val.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                    ssl.SSL_ERROR_WANT_WRITE):
+                return 0
+            raise
 
     def old_send(self, data):
         """Send data to remote."""
@@ -688,34 +1494,18 @@ class IMAP4_stream(IMAP4):
         '''
         self.host = None
         self.port = None
-        self.file = None
         p = Popen(self.command, shell=True, stdin=PIPE, stdout=PIPE,
                           close_fds=True)
         self.writefile, self.readfile =  (p.stdin, p.stdout)
         self.sock = p
+        self.reader = Reader(self._recv_into)
 
-    def read(self, size):
-        '''Read 'size' bytes from remote.'''
-        if __debug__:
-            if Debug & D_SERVER:
-                print 'S: Read %d bytes from the server.' % size
-        return self.readfile.read(size)
+    def _recv_into(self, buffer):
+        data = os.read(self.readfile.fileno(), len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
 
-    def readline(self):
-        '''Read line from remote.'''
-        line = self.readfile.readline()
-        if not line:
-            raise self.Abort('socket error: EOF')
-        if __debug__:
-            if Debug & D_SERVER:
-                print 'S: %s' % line.replace(CRLF,'<cr><lf>')
-        return line
-
-    def send(self, data):
-        '''Send data to remote.'''
-        if __debug__:
-            if Debug & D_CLIENT:
-                print 'C: %s' % data.replace(CRLF,'<cr><lf>')
+    def _sendall(self, data):
         self.writefile.write(data)
         self.writefile.flush()
 
@@ -36,17 +36,22 @@ appropriate data which will be return at the command end.
 
 # Global imports
 import re
+import sys
+import time
+import random
 import socket
 import select
 from threading import Timer
 
 # Local imports
-from imapll import IMAP4, IMAP4_SSL, IMAP4_stream
+from imapll import IMAP4, IMAP4_SSL, IMAP4_stream, SINK_THRESHOLD
 import imapll
 from infolog import InfoLog
-from imapcommands import COMMANDS, STATUS
-from utils import makeTagged, unquote, Internaldate2tuple, shrink_fetch_list
-from parsefetch import FetchParser
+from imapcommands import COMMANDS, STATUS, IDEMPOTENT
+from utils import makeTagged, unquote, Internaldate2tuple
+from utils import LiteralString, MessageArray, parse_numbers, SequenceSet
+from utils import StreamLiteral
+from parsefetch import FetchParser, FetchScanner
 import parselist
 from sexp import scan_sexp
 
@@ -60,16 +65,20 @@ MAXLOG = 100
 CRLF = '\r\n'
 SP = ' '
 MAXCLILEN = 16384 # max command line lenght accepted by the IMAP server
+RECONNECT_ATTEMPTS = 5  # connection attempts before giving up
+RECONNECT_DELAY = 1     # seconds before the second attempt, doubled on each
+RECONNECT_MAX_DELAY = 30 # max seconds between attempts
+RECONNECT_JITTER = 0.1  # max random fraction added or taken to the delays
 
 # Regexp
 opt_respcode_re = re.compile(r'^\[(?P<code>[a-zA-Z0-9-]+)(?P<args>.*?)\].*$')
 response_re = re.compile(r'^(?P<code>[a-zA-Z0-9-]+)(?P<args>.*)$', re.MULTILINE)
 fetch_msgnum_re = re.compile(r'^(\d+) ')
+fetch_line_re = re.compile(r'^\* \d+ FETCH ', re.IGNORECASE)
 fetch_data_items_re = re.compile(r'^([a-zA-Z0-9\[\]<>\.]+) ')
 fetch_flags_re = re.compile(r'^\((.*?)\) ?')
 fetch_int_re = re.compile(r'^(\d+) ?')
 fetch_quoted_re = re.compile(r'^"(.*?)" ?')
-map_crlf_re = re.compile(r'\r\n|\r|\n')
 
 class IMAP4P(object):
     '''
@@ -104,9 +113,10 @@ class IMAP4P(object):
                         'sort_response': {},
                         'list_response': { 'mailbox_list': [],
                                            'hierarchy_delimiter': '' },
-                        'search_response': (),
-                        'sort_response': (),
+                        'search_response': MessageArray(),
+                        'sort_response': MessageArray(),
                         'status_response': {},
+                        'status_responses': {},
                         'fetch_response': {},
                         'acl_response': { 'mailbox': '',
                                           'acl': {} },
@@ -130,6 +140,26 @@ class IMAP4P(object):
         initiates the connection and authenticates for you, set the stream
         keyword to True and set host to the command that initiates the
         connection. The login command will not be needed either.
+
+        If lazy_fetch is true, the fetch responses are only converted when
+        accessed. For instance, an ENVELOPE is only decoded when we read it
+        from the response, see L{FetchParser<FetchParser>}.
+
+        The message body structures can be cached, pass an
+        L{LRUCache<imaplibii.utils.LRUCache>} instance as structure_cache. The cache is used
+        by L{fetch_uid<fetch_uid>}, see L{fetch_structure<fetch_structure>}.
+
+        If compress is true and the server supports COMPRESS=DEFLATE, the
+        connection is compressed after L{login<login>}, see
+        L{compress<compress>}.
+
+        If reconnect is true, when the connection is lost a new one is
+        opened, with up to RECONNECT_ATTEMPTS attempts and exponential
+        backoff. The authentication, compression, NOTIFY and selected
+        mailbox are restored, and the command is sent again if it's
+        idempotent (see imapcommands.IDEMPOTENT). The other commands raise
+        Abort, the session can be used on. The UID commands aren't sent
+        again if the UIDVALIDITY of the mailbox changed.
     '''
 
     class Error(Exception):
@@ -151,7 +181,11 @@ class IMAP4P(object):
             keyfile = None,
             certfile = None,
             infolog = InfoLog(MAXLOG),
-            autologout = True ):
+            autologout = True,
+            lazy_fetch = False,
+            structure_cache = None,
+            compress = False,
+            reconnect = False ):
 
         # First initialize all vars
         # Server status
@@ -164,6 +198,30 @@ class IMAP4P(object):
         self.as_uid = None
         self.as_sort = None
 
+        # If true, the fetch data items are only converted when accessed
+        self.lazy_fetch = lazy_fetch
+
+        # BODYSTRUCTURE cache, the keys are (mailbox, UIDVALIDITY, UID)
+        self.structure_cache = structure_cache
+        self.cache_uidvalidity = {}
+
+        # If true, COMPRESS=DEFLATE is negotiated after login
+        self.compress_deflate = compress
+
+        # NOTIFY (RFC5465) event callbacks, by mailbox name, the None key
+        # holds the callback for the other mailboxes
+        self.notify_callbacks = {}
+
+        # Resilient mode, the session state to restore after reconnecting
+        # is kept on session_state: 'auth', 'compress', 'notify' and
+        # 'mailbox'
+        self.reconnect = reconnect
+        self.reconnect_attempts = RECONNECT_ATTEMPTS
+        self.reconnect_delay = RECONNECT_DELAY
+        self.reconnect_max_delay = RECONNECT_MAX_DELAY
+        self.reconnecting = False
+        self.session_state = {}
+
         # Choose the right connection, and then connect to the server
         self.autologout = autologout
         if not port:
@@ -171,18 +229,11 @@ class IMAP4P(object):
                 port = IMAP4_SSL_PORT
             else:
                 port = IMAP4_PORT
+        self.transport_args = (host, port, ssl, stream, keyfile, certfile)
 
         try:
-            if stream:
-                self.__IMAP4 = IMAP4_stream( host,
-                            parse_command = self.parse_command )
-            elif ssl:
-                self.__IMAP4 = IMAP4_SSL( host = host, port = port,
-                    keyfile = keyfile, certfile = certfile,
-                    parse_command = self.parse_command )
-            else:
-                self.__IMAP4 = IMAP4( host = host, port = port,
-                    parse_command = self.parse_command )
+            self.__IMAP4 = self._transport(host, port, ssl, stream, keyfile,
+                certfile)
             self.connected = True
         except socket.gaierror:
             self.connected = False
@@ -194,7 +245,25 @@ class IMAP4P(object):
         #self.send_command = self.__IMAP4.send_command
         #self.state = self.__IMAP4.state
 
-        self.infolog.addEntry('WELCOME', self.welcome)
+        # The asynchronous connections get the greeting later
+        if self.welcome is not None:
+            self.infolog.addEntry('WELCOME', self.welcome)
+
+    def _transport(self, host, port, ssl, stream, keyfile, certfile):
+        '''Creates the low level connection to the server.
+
+        @return: an L{IMAP4<imaplibii.imapll.IMAP4>} instance.
+        '''
+        if stream:
+            return IMAP4_stream( host,
+                        parse_command = self.parse_command )
+        elif ssl:
+            return IMAP4_SSL( host = host, port = port,
+                keyfile = keyfile, certfile = certfile,
+                parse_command = self.parse_command )
+        else:
+            return IMAP4( host = host, port = port,
+                parse_command = self.parse_command )
 
 
     def _get_state(self):
@@ -246,6 +315,8 @@ class IMAP4P(object):
         '''Untagged response handling'''
 
         for untagged in untagged_response:
+            literals = getattr(untagged, 'literals', None)
+            handles = getattr(untagged, 'handles', ())
             untagged = untagged[2:]
             # get the response type
             resp = response_re.match(untagged)
@@ -265,6 +336,11 @@ class IMAP4P(object):
                 except:
                     pass
 
+                # Keep the literal positions, they're relative to the end
+                # of the response
+                if literals:
+                    args = LiteralString(args, literals, handles)
+
                 # Call handler function based on the response type
                 method_name = code.replace('.', '_')+'_response'
                 meth = getattr(self, method_name, self.default_response)
@@ -344,11 +420,23 @@ class IMAP4P(object):
         if not self.capabilities:
             self.capabilities = self.sstatus['capability']
 
+        # Use non synchronizing literals if possible
+        if 'LITERAL+' in self.sstatus['capability']:
+            self.__IMAP4.nonsync_literals = 'LITERAL+'
+        elif 'LITERAL-' in self.sstatus['capability']:
+            self.__IMAP4.nonsync_literals = 'LITERAL-'
+        else:
+            self.__IMAP4.nonsync_literals = None
+
     def EXISTS_response(self, code, args):
         self.sstatus['current_folder']['EXISTS'] = int(args)
+        if self.notify_callbacks:
+            self._notify_selected(code, int(args))
 
     def EXPUNGE_response(self, code, args):
         self.sstatus['current_folder']['expunge_list'].append(int(args))
+        if self.notify_callbacks:
+            self._notify_selected(code, int(args))
 
     def FETCH_response(self, code, args):
         # Message number
@@ -360,13 +448,39 @@ class IMAP4P(object):
         msg_num = int(fresp.groups()[0])
 
         # Parse the response:
-        response = FetchParser(args[fresp.end():])
+        if isinstance(args, LiteralString):
+            args = args.tail(fresp.end())
+        else:
+            args = args[fresp.end():]
+        self._fetch_parsed(msg_num, FetchParser(args, self.lazy_fetch))
+
+    def _fetch_parsed(self, msg_num, response):
         if response.has_key('UID'):
             # If UIDPLUS capability, index mes by uid
             self.sstatus['fetch_response'][response['UID']] = response
         else:
             self.sstatus['fetch_response'][msg_num] = response
 
+        if self.notify_callbacks:
+            self._notify_selected('FETCH', (msg_num, response))
+
+    def _scan_fetch(self, line):
+        '''Response scanner of the transport while fetching, see
+        L{IMAP4._get_response<imaplibii.imapll.IMAP4._get_response>}. The
+        FETCH responses that carry literals are scanned as they're read from
+        the server, each one is parsed as soon as it's complete, while the
+        following ones are still arriving.
+
+        A FETCH response without literals is a single line, complete as soon
+        as it's read, it's left to L{FETCH_response<FETCH_response>}, where
+        the usual layouts take the fast path of
+        L{fetch_data_items<imaplibii.parsefetch.fetch_data_items>}.
+        '''
+        if (fetch_line_re.match(line) and
+            imapll.literal_size(line[:-2]) is not None):
+            return FetchScanner(self._fetch_parsed, self.lazy_fetch)
+        return None
+
     def FLAGS_response(self, code, args):
         args = tuple( args[1:-1].split() )
         self.sstatus['current_folder'][code.upper()] =  args
@@ -388,8 +502,11 @@ class IMAP4P(object):
         else:
             hierarchy_delimiter = None
 
-        self.sstatus['list_response'].append( parselist.Mailbox(
-            name, attributes, hierarchy_delimiter ))
+        mailbox = parselist.Mailbox( name, attributes, hierarchy_delimiter )
+        self.sstatus['list_response'].append( mailbox )
+
+        if self.notify_callbacks:
+            self._notify(name, code, mailbox)
 
     LSUB_response = LIST_response
 
@@ -421,12 +538,10 @@ class IMAP4P(object):
         self.sstatus['current_folder']['RECENT'] = int(args)
 
     def SEARCH_response(self, code, args):
-        self.sstatus['search_response'] = tuple([ int(Xi)
-            for Xi in args.split()])
+        self.sstatus['search_response'] = MessageArray(parse_numbers(args))
 
     def SORT_response(self, code, args):
-        self.sstatus['sort_response'] = tuple([ int(Xi)
-            for Xi in args.split() ])
+        self.sstatus['sort_response'] = MessageArray(parse_numbers(args))
 
     def THREAD_response(self, code, args):
         response = scan_sexp( args )
@@ -436,8 +551,37 @@ class IMAP4P(object):
         response = scan_sexp(args)
         it = iter(response[1])
 
-        self.sstatus['status_response'] = dict(zip(it, it))
-        self.sstatus['status_response']['mailbox'] = response[0]
+        status = dict(zip(it, it))
+        status['mailbox'] = response[0]
+        self.sstatus['status_response'] = status
+
+        # The status of each mailbox, see status_mailboxes. A later response
+        # for the same mailbox updates the items it carries.
+        statuses = self.sstatus.setdefault('status_responses', {})
+        statuses.setdefault(str(response[0]), {}).update(status)
+
+        if self.notify_callbacks:
+            it = iter(response[1])
+            self._notify(response[0], code, dict(zip(it, it)))
+
+    ##
+    # NOTIFY event routing
+    ##
+
+    def _notify(self, mailbox, name, data):
+        '''Calls the NOTIFY callback of a mailbox.'''
+        callback = self.notify_callbacks.get(mailbox,
+            self.notify_callbacks.get(None))
+        if callback:
+            callback(mailbox, name, data)
+
+    def _notify_selected(self, name, data):
+        self._notify(self.sstatus['current_folder'].get('name'), name, data)
+
+    def _idle_notify(self, response):
+        '''Parses the responses received in IDLE, from the IDLE dispatcher
+        thread, so that the NOTIFY events reach the callbacks.'''
+        self._parse_untagged(None, response['untagged'])
 
     ##
     # Command processing
@@ -465,14 +609,17 @@ class IMAP4P(object):
         # Verifies if it's a valid command
         self._test_command(name)
 
-        # Composes the command
-        if args:
+        # Composes the command, the arguments can be a list with streamed
+        # literals (see IMAP4.send_command)
+        if isinstance(args, list):
+            command = [ '%s ' % name ] + args
+        elif args:
             command = '%s %s' % ( name, args )
         else:
             command = name
 
         # Sends the command to the server, and parses the response
-        tag, response = self.send_command(command)
+        tag, response = self._send_command(name, command)
 
         # Checks if the command was successfull
         if self._checkok(tag, response):
@@ -481,19 +628,176 @@ class IMAP4P(object):
             raise self.Error('Error in command %s - %s' % (name,
                 response['tagged'][tag]['message']))
 
+    def _send_command(self, name, command):
+        '''Sends a command, on resilient mode the command is sent again on
+        a new connection if the connection is lost.'''
+        try:
+            return self.send_command(command)
+        except (IMAP4.Abort, self.Abort, socket.error):
+            exc_info = sys.exc_info()
+            if not self._recover(name):
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+        return self.send_command(command)
+
+    def processPipeline(self, name, args_list, uid = False, callback = None):
+        '''Processes severall commands of the same type, pipelined in a
+        single write to the server.
+
+        @param name: Valid IMAP4 command.
+        @param args_list: list of command arguments, one command is sent for
+        each item.
+        @param uid: if true, the UID version of the command is used.
+        @param callback: called with the L{PendingCommand
+        <imaplibii.imapll.PendingCommand>} handle, after the response to each
+        command is parsed.
+
+        @return: <instance>.sstatus
+        '''
+        # Verifies if it's a valid command
+        self._test_command(name)
+        if uid:
+            self._test_command('UID')
+            name = 'UID %s' % name
+
+        commands = [ '%s %s' % (name, args) for args in args_list ]
+        try:
+            return self._run_pipeline(name, commands, callback)
+        except (IMAP4.Abort, self.Abort, socket.error):
+            exc_info = sys.exc_info()
+            if not self._recover(name):
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+        return self._run_pipeline(name, commands, callback)
+
+    def _run_pipeline(self, name, commands, callback):
+        handles = self.pipeline(commands, callback)
+
+        # Checks if the commands were successfull
+        for handle in handles:
+            response = handle.result()
+            if not self._checkok(handle.tag, response):
+                raise self.Error('Error in command %s - %s' % (name,
+                    response['tagged'][handle.tag]['message']))
+
+        return self.sstatus
+
     ##
-    # IMAP Commands
+    # Reconnection
     ##
 
-    def append(self, mailbox, message, flags=None, date_time=None):
+    def _recover(self, name):
+        '''Called when the connection is lost while running a command. On
+        resilient mode a new connection is opened.
+
+        @param name: command name, 'UID <name>' for the UID commands.
+
+        @return: True if the command can be sent again.
         '''
+        if not self.reconnect or self.reconnecting or \
+                name in ('LOGIN', 'AUTHENTICATE', 'LOGOUT'):
+            return False
+
+        if self.session_state.get('auth', True) is None:
+            raise self.Abort('Connection lost, can\'t reconnect: the '
+                'AUTHENTICATE authobject can only be used once')
+
+        same_uids = self._reconnect()
+
+        return name in IDEMPOTENT and (same_uids or
+            not name.startswith('UID '))
+
+    def _reconnect(self):
+        '''Opens a new connection, and restores the session state. The
+        attempts are spaced with exponential backoff, from reconnect_delay
+        to reconnect_max_delay seconds.
+
+        @return: True if the selected mailbox UIDVALIDITY didn't change.
         '''
+        self.reconnecting = True
+        delay = self.reconnect_delay
+        error = None
+
+        # The fetch sink and scanner settings are kept by the transport
+        literal_sink = self.__IMAP4.literal_sink
+        sink_threshold = self.__IMAP4.sink_threshold
+        response_scanner = self.__IMAP4.response_scanner
+        try:
+            for attempt in range(self.reconnect_attempts):
+                if attempt:
+                    time.sleep(delay * random.uniform(1 - RECONNECT_JITTER,
+                        1 + RECONNECT_JITTER))
+                    delay = min(delay * 2, self.reconnect_max_delay)
 
-        name = 'APPEND'
+                try:
+                    self.__IMAP4.shutdown()
+                except (IMAP4.Abort, socket.error):
+                    pass
+
+                try:
+                    self.__IMAP4 = self._transport(*self.transport_args)
+                    self.connected = True
+                    self.welcome = self.__IMAP4.welcome
+                    self.infolog.addEntry('WELCOME', self.welcome)
+
+                    same_uids = self._replay()
+
+                    self.__IMAP4.literal_sink = literal_sink
+                    self.__IMAP4.sink_threshold = sink_threshold
+                    self.__IMAP4.response_scanner = response_scanner
+                    return same_uids
+                except (IMAP4.Abort, self.Abort, self.Error, socket.error), val:
+                    error = val
+
+            self.connected = False
+            raise self.Abort('Could not reconnect after %d attempts: %s' %
+                (self.reconnect_attempts, error))
+        finally:
+            self.reconnecting = False
+
+    def _replay(self):
+        '''Restores the session state on a new connection.
+
+        @return: True if the selected mailbox UIDVALIDITY didn't change.
+        '''
+        state = self.session_state
+
+        if 'auth' in state:
+            method, args = state['auth']
+            getattr(self, method)(*args)
+
+        # The capabilities usually change after the authentication, this
+        # also sets the transport nonsync_literals
+        self.capabilities = self.capability()
+
+        if 'compress' in state and self.__IMAP4.compressor is None:
+            self.compress(state['compress'])
+
+        if 'notify' in state:
+            self.processCommand('NOTIFY', state['notify'])
+        if self.notify_callbacks:
+            self._set_idle_dispatch(self._idle_notify)
+
+        if 'mailbox' in state:
+            folder, readonly = state['mailbox']
+            uidvalidity = self.sstatus.get('current_folder', {}).get(
+                'UIDVALIDITY')
+            self.select(folder, readonly)
+            return uidvalidity == \
+                self.sstatus['current_folder'].get('UIDVALIDITY')
+
+        return True
+
+    ##
+    # IMAP Commands
+    ##
 
-        message = map_crlf_re.sub('\r\n', message)
-        message = '{%d}%s%s' % (len(message), CRLF, message )
+    def _append_args(self, message, flags, date_time):
+        '''Composes the arguments of a message to append.
 
+        @return: list with the optional flags and date, and the message
+        literal.
+        '''
         aux_args = []
 
         if flags:
@@ -502,12 +806,71 @@ class IMAP4P(object):
         if date_time:
             aux_args.append(date_time)
 
-        aux_args = ' '.join(aux_args)
+        aux_args.append('')
 
-        if aux_args:
-            args = '"%s" %s %s' % (mailbox, aux_args, message)
-        else:
-            args = '"%s" %s' % (mailbox, message)
+        return [ ' '.join(aux_args), StreamLiteral(message) ]
+
+    def append(self, mailbox, message, flags=None, date_time=None):
+        '''Appends a message to a mailbox.
+
+        The message can be a string, a file like object or an iterable of
+        strings. The line ends are converted to CRLF and the message is sent
+        in chunks, it's never copied as a whole (see
+        L{StreamLiteral<imaplibii.utils.StreamLiteral>}).
+
+        @param mailbox: destination mailbox.
+        @param message: the message.
+        @param flags: flag list, for instance '(\\Seen)'.
+        @param date_time: internal date of the message, quoted.
+        '''
+
+        name = 'APPEND'
+
+        # We must know if the server supports non synchronizing literals
+        if not self.capabilities:
+            self.capability()
+
+        args = [ '"%s" ' % mailbox ] + self._append_args(message, flags,
+            date_time)
+
+        return self.processCommand( name, args )
+
+    def append_many(self, mailbox, messages, flags=None, date_time=None):
+        '''Appends severall messages to a mailbox.
+
+        If the server supports MULTIAPPEND (RFC3502) all the messages are
+        sent with a single command, and either all or none are appended.
+        Otherwise an APPEND is sent for each message.
+
+        http://www.ietf.org/rfc/rfc3502.txt
+
+        @param mailbox: destination mailbox.
+        @param messages: iterable of messages, see L{append<append>}. Each
+        item can also be a (message, flags, date_time) tuple.
+        @param flags: flags of the messages without their own flags.
+        @param date_time: internal date of the messages without their own
+        date.
+        '''
+
+        name = 'APPEND'
+
+        if not self.capabilities:
+            self.capability()
+
+        messages = [ item if isinstance(item, tuple)
+                     else (item, flags, date_time) for item in messages ]
+        if not messages:
+            return self.sstatus
+
+        if not self.has_capability('MULTIAPPEND'):
+            for message in messages:
+                self.append(mailbox, *message)
+            return self.sstatus
+
+        args = [ '"%s"' % mailbox ]
+        for message in messages:
+            args.append(' ')
+            args.extend(self._append_args(*message))
 
         return self.processCommand( name, args )
 
@@ -541,7 +904,18 @@ class IMAP4P(object):
         except:
             self.push_continuation(authobject)
 
-        return self.processCommand( name, mech )
+        self.processCommand( name, mech )
+
+        if self.reconnect:
+            if hasattr(authobject, 'next'):
+                # An iterator or generator can't be replayed, the
+                # reconnection is refused
+                self.session_state['auth'] = None
+            else:
+                self.session_state['auth'] = ('authenticate',
+                    (mech, authobject))
+
+        return self.sstatus
 
     def capability(self):
         '''Fetch capabilities list from server.
@@ -569,6 +943,7 @@ class IMAP4P(object):
 
         name = 'CLOSE'
 
+        self.session_state.pop('mailbox', None)
         try:
             self.processCommand( name )
         finally:
@@ -576,15 +951,48 @@ class IMAP4P(object):
 
         return self.sstatus
 
-    def copy(self, message_list, mailbox ):
+    def compress(self, level = imapll.COMPRESS_LEVEL):
+        '''Starts the DEFLATE compression of the connection, the server must
+        support the COMPRESS=DEFLATE capability (RFC4978).
+
+        http://www.ietf.org/rfc/rfc4978.txt
+
+        Once started the compression can't be stopped. The byte counts are
+        available on <instance>.compress_stats.
+
+        @param level: zlib compression level, from 1 (fastest) to 9 (best
+        compression).
+        '''
+
+        name = 'COMPRESS'
+
+        self.processCommand( name, 'DEFLATE' )
+        self.__IMAP4.start_compression(level)
+
+        if self.reconnect:
+            self.session_state['compress'] = level
+
+        return self.sstatus
+
+    def _copy(self, uid, message_list, mailbox ):
         '''Copy messages to mailbox'''
+        if uid:
+            process_command = self.processCommandUID
+        else:
+            process_command = self.processCommand
 
         name = 'COPY'
 
-        message_list = ','.join( '%s' % Xi for Xi in message_list)
-        args = ' %s "%s"' % (message_list, mailbox)
+        mailbox = '"%s"' % mailbox
+        for message_set in self._message_sets(message_list,
+            len('UID COPY  %s' % mailbox)):
+            process_command( name, '%s %s' % (message_set, mailbox) )
 
-        return self.processCommand( name, args )
+        return self.sstatus
+
+    def copy(self, message_list, mailbox ):
+        '''Copy messages to mailbox'''
+        return self._copy( False, message_list, mailbox )
 
     def create(self, mailbox):
         '''Create new mailbox.'''
@@ -633,7 +1041,8 @@ class IMAP4P(object):
 
         return self.processCommand( name )['current_folder']['expunge_list']
 
-    def _fetch(self, uid, message_list, message_parts='(FLAGS)' ):
+    def _fetch(self, uid, message_list, message_parts='(FLAGS)', sink = None,
+            sink_threshold = SINK_THRESHOLD ):
         '''Fetch (parts of) messages'''
         if uid:
             process_command = self.processCommandUID
@@ -648,56 +1057,42 @@ class IMAP4P(object):
         # IMAP server has a maximum lenght for the command line
         # so if the command line is bigger than a MAXCLILEN we
         # have to make severall fetch commands to complete the
-        # fetch.
-        if isinstance(message_list, list) or \
-           isinstance(message_list, tuple):
-            shrinked_list = shrink_fetch_list( message_list )
-            message_list = ','.join( '%s' % Xi for Xi in shrinked_list )
-
-            # Worst case cenario command lenght
-            command_len = len( 'UID FETCH %s %s' % (message_list,
-                message_parts)) + 2
-
-            if command_len > MAXCLILEN:
-                shrinked_list = list(shrinked_list)
-                len_overhead = len('UID FETCH %s' % (message_parts)) + 2
-                message_list = ''
-                result = {}
-                while shrinked_list:
-                    msg = '%s' % shrinked_list.pop()
-                    if len(message_list)+len(msg)+len_overhead <= MAXCLILEN:
-                        # Compose the partial message list
-                        message_list += ',%s' % msg
-                    else:
-                        # Make a partial fetch
-                        shrinked_list.append(msg)
-                        args = '%s %s' % (message_list.strip(','),
-                            message_parts)
-                        tmp_result = process_command(name,
-                            args)['fetch_response']
-
-                        # Merge the results:
-                        for key in tmp_result:
-                            result[key] = tmp_result[key]
-                        message_list = ''
-
-                if message_list:
-                    args = '%s %s' % (message_list.strip(','),
-                        message_parts)
-                    tmp_result = process_command(name,
-                        args)['fetch_response']
-                    for key in tmp_result:
-                        result[key] = tmp_result[key]
-
-                self.sstatus['fetch_response'] = result
-                return result
-
-        args = '%s %s' % (message_list,  message_parts)
-        return process_command(name, args)['fetch_response']
-
-    def fetch(self, message_list, message_parts='(FLAGS)' ):
-        '''Fetch (parts of) messages.'''
-        return self._fetch( False, message_list, message_parts )
+        # fetch. These are pipelined.
+        message_sets = self._message_sets(message_list,
+            len('UID FETCH  %s' % message_parts))
+
+        self.__IMAP4.literal_sink = sink
+        self.__IMAP4.sink_threshold = sink_threshold
+        self.__IMAP4.response_scanner = self._scan_fetch
+        try:
+            if len(message_sets) == 1:
+                process_command(name, '%s %s' % (message_sets[0],
+                    message_parts))
+            else:
+                self.processPipeline(name, [ '%s %s' % (message_set,
+                    message_parts) for message_set in message_sets ], uid)
+        finally:
+            self.__IMAP4.literal_sink = None
+            self.__IMAP4.response_scanner = None
+
+        return self.sstatus['fetch_response']
+
+    def fetch(self, message_list, message_parts='(FLAGS)', sink = None,
+            sink_threshold = SINK_THRESHOLD ):
+        '''Fetch (parts of) messages.
+
+        The big literals, for instance the BODY[] of a big message, can be
+        written to a sink instead of being read to memory. On the response
+        these literals are replaced by L{LiteralHandle
+        <imaplibii.utils.LiteralHandle>} instances.
+
+        @param sink: writable object (file, temporary file, mmap, ...), or
+        a callable that gets the literal size and returns a writable object.
+        @param sink_threshold: only the literals with this size or bigger
+        are written to the sink.
+        '''
+        return self._fetch( False, message_list, message_parts, sink,
+            sink_threshold )
 
     def getacl(self, mailbox):
         '''Get the ACLs for a mailbox.
@@ -714,6 +1109,106 @@ class IMAP4P(object):
 
         return self.processCommand( name, '"%s"' % mailbox )['acl_response']
 
+    def notify(self, events, status = False):
+        '''Requests the server to send events about mailboxes other than the
+        selected one (RFC5465). The server must support the NOTIFY
+        capability.
+
+        http://www.ietf.org/rfc/rfc5465.txt
+
+        Example::
+
+            M.notify([ ('SELECTED', ['MessageNew (UID FLAGS)',
+                                     'MessageExpunge', 'FlagChange']),
+                       ('PERSONAL', ['MessageNew', 'MessageExpunge']),
+                       (('SUBTREE', ['Lists']), None) ])
+
+        The events arrive as unsolicited STATUS, LIST, EXISTS, EXPUNGE and
+        FETCH responses, with any command or while in IDLE. Use
+        L{watch<watch>} to route them to callbacks.
+
+        @param events: list of (mailboxes, events) tuples. mailboxes is one
+        of 'SELECTED', 'SELECTED-DELAYED', 'INBOXES', 'PERSONAL',
+        'SUBSCRIBED' or a ('MAILBOXES', [names]) or ('SUBTREE', [names])
+        tuple. events is a list of event names, or None to receive no events
+        for those mailboxes.
+        @param status: if true, the server sends the STATUS of the mailboxes
+        right away.
+        '''
+        name = 'NOTIFY'
+
+        groups = []
+        for mailboxes, mailbox_events in events:
+            if not isinstance(mailboxes, basestring):
+                kind, names = mailboxes
+                mailboxes = '%s (%s)' % (kind,
+                    ' '.join( '"%s"' % mailbox for mailbox in names ))
+            if mailbox_events:
+                mailbox_events = '(%s)' % ' '.join(mailbox_events)
+            else:
+                mailbox_events = 'NONE'
+            groups.append('(%s %s)' % (mailboxes, mailbox_events))
+
+        if status:
+            groups.insert(0, 'STATUS')
+
+        args = 'SET %s' % ' '.join(groups)
+        self.processCommand( name, args )
+
+        if self.reconnect:
+            self.session_state['notify'] = args
+
+        return self.sstatus
+
+    def notify_none(self):
+        '''Stops all the NOTIFY events.'''
+        name = 'NOTIFY'
+
+        self.session_state.pop('notify', None)
+
+        return self.processCommand( name, 'NONE' )
+
+    def watch(self, mailbox, callback):
+        '''Sets the callback for the NOTIFY events of a mailbox.
+
+        The callback is called as callback(mailbox, name, data), where name
+        is the response name and data is:
+
+            - STATUS: dict with the status items;
+            - EXISTS, EXPUNGE: the message number;
+            - FETCH: (message number, L{FetchParser<FetchParser>});
+            - LIST: a L{Mailbox<imaplibii.parselist.Mailbox>}.
+
+        EXISTS, EXPUNGE and FETCH are routed to the callback of the selected
+        mailbox. The responses to our own commands reach the callbacks too.
+
+        While there are callbacks the responses received in
+        L{idle<idle>} are parsed, from the IDLE dispatcher thread, so they
+        reach the callbacks as they arrive.
+
+        @param mailbox: mailbox name, or None for the mailboxes without
+        their own callback.
+        @param callback: python callable.
+        '''
+        self.notify_callbacks[mailbox] = callback
+        self._set_idle_dispatch(self._idle_notify)
+
+    def unwatch(self, mailbox):
+        '''Removes the callback of a mailbox.'''
+        self.notify_callbacks.pop(mailbox, None)
+        if not self.notify_callbacks:
+            self._set_idle_dispatch(None)
+
+    def _set_idle_dispatch(self, callback):
+        '''Replaces the transport idle_dispatch, None restores it.'''
+        transport = self.__IMAP4
+        if callback is None:
+            transport.__dict__.pop('idle_dispatch', None)
+        else:
+            transport.idle_dispatch = callback
+        if transport.idle_dispatcher is not None:
+            transport.idle_dispatcher.callback = transport.idle_dispatch
+
     def idle(self):
         '''
         Initiate IDLE mode with the server for instant notification of new mail.
@@ -774,19 +1269,34 @@ class IMAP4P(object):
         except:
             raise self.Error('Could not login.')
 
+        if self.reconnect:
+            self.session_state['auth'] = ('login', (user, password))
+
+        if self.compress_deflate:
+            # The capabilities usually change after login
+            self.capabilities = self.capability()
+            if 'COMPRESS=DEFLATE' in self.capabilities:
+                self.compress()
+
         return self.sstatus
 
     def login_cram_md5(self, user, password):
         """ Force use of CRAM-MD5 authentication.
         """
         self.user, self.password = user, password
-        return self.authenticate('CRAM-MD5', self._CRAM_MD5_AUTH)
+        self.authenticate('CRAM-MD5', self._CRAM_MD5_AUTH)
+
+        if self.reconnect:
+            self.session_state['auth'] = ('login_cram_md5', (user, password))
+
+        return self.sstatus
 
     def logout(self):
         '''
         '''
         name = 'LOGOUT'
         self.state = 'LOGOUT'
+        self.session_state = {}
         return self.processCommand( name )
 
     def _CRAM_MD5_AUTH(self, challenge):
@@ -851,7 +1361,7 @@ class IMAP4P(object):
     def search(self, criteria, charset=None):
         '''Search mailbox for matching messages'''
         name = 'SEARCH'
-        self.sstatus['search_response'] = ()
+        self.sstatus['search_response'] = MessageArray()
         if charset:
             args = 'CHARSET %s %s' % ( charset, criteria)
         else:
@@ -874,6 +1384,13 @@ class IMAP4P(object):
         self.sstatus['current_folder']['name'] = folder
         self.state = 'SELECTED'
 
+        if self.reconnect:
+            self.session_state['mailbox'] = (folder, readonly)
+
+        if self.structure_cache is not None:
+            self._check_uidvalidity(folder,
+                self.sstatus['current_folder'].get('UIDVALIDITY'))
+
         return self.sstatus['current_folder']
 
     def examine(self, folder):
@@ -904,7 +1421,7 @@ class IMAP4P(object):
 
         name = 'SORT'
 
-        self.sstatus['sort_response'] = ()
+        self.sstatus['sort_response'] = MessageArray()
 
         return self.processCommand( name, '%s %s %s' % (program, charset,
             search_criteria))['sort_response']
@@ -915,9 +1432,36 @@ class IMAP4P(object):
         name = 'STATUS'
 
         self.sstatus['status_response'] = {}
+        self.sstatus['status_responses'] = {}
 
-        return self.processCommand( name, '"%s" %s' % (mailbox,
-            names))['status_response']
+        self.processCommand( name, '"%s" %s' % (mailbox, names))
+
+        return self.sstatus['status_responses'].get(mailbox,
+            self.sstatus['status_response'])
+
+    def status_mailboxes(self, mailboxes, names):
+        '''Requests the status of severall mailboxes. The STATUS commands
+        are pipelined, so this takes about one round trip.
+
+        @param mailboxes: list of mailbox names.
+        @param names: status data items, for instance '(MESSAGES UNSEEN)'.
+
+        @return: dict with the status_response of each mailbox, keyed by the
+        mailbox name.
+        '''
+        name = 'STATUS'
+
+        self.sstatus['status_response'] = {}
+        self.sstatus['status_responses'] = {}
+
+        self.processPipeline( name, [ '"%s" %s' % (mailbox, names)
+            for mailbox in mailboxes ] )
+
+        # The responses are matched by the mailbox name, the unsolicited
+        # STATUS responses (NOTIFY) can arrive in between
+        responses = self.sstatus['status_responses']
+        return dict( (mailbox, responses[mailbox]) for mailbox in mailboxes
+            if mailbox in responses )
 
     def store(self, message_set, command, flags):
         '''Alters flag dispositions for messages in mailbox.
@@ -947,15 +1491,23 @@ class IMAP4P(object):
         -FLAGS.SILENT <flag list>
         '''
 
+        return self._store( False, message_set, command, flags )
+
+    def _store(self, uid, message_set, command, flags):
+        if uid:
+            process_command = self.processCommandUID
+        else:
+            process_command = self.processCommand
+
         name = 'STORE'
 
-        flags = '(%s)' % ' '.join(flags)
+        args = '%s (%s)' % (command, ' '.join(flags))
 
-        if isinstance(message_set, list):
-            message_set = ','.join( '%s' % Xi for Xi in message_set)
+        for message_set in self._message_sets(message_set,
+            len('UID STORE  %s' % args)):
+            process_command( name, '%s %s' % (message_set, args) )
 
-        return self.processCommand( name, '%s %s %s' % (message_set,
-            command, flags ))
+        return self.sstatus
 
     def subscribe(self, mailbox):
         '''
@@ -995,6 +1547,7 @@ class IMAP4P(object):
         '''
         name = 'UNSELECT'
 
+        self.session_state.pop('mailbox', None)
         try:
             self.processCommand( name )
         finally:
@@ -1025,6 +1578,25 @@ class IMAP4P(object):
 
         return capability in self.capabilities
 
+    def _message_sets(self, message_list, overhead):
+        '''Converts a message list to sequence set strings, short enough to
+        fit on the command line.
+
+        @param message_list: the messages, can be a string (used unmodified),
+        a L{SequenceSet<SequenceSet>} or any iterable of message numbers or
+        uids.
+        @param overhead: lenght of the rest of the command line.
+
+        @return: list of sequence set strings.
+        '''
+        if isinstance(message_list, basestring):
+            return [ message_list ]
+        if isinstance(message_list, (int, long)):
+            return [ '%d' % message_list ]
+        if not isinstance(message_list, SequenceSet):
+            message_list = SequenceSet(message_list)
+        return list(message_list.chunks(MAXCLILEN - overhead - 2))
+
     ## UID commands
     def processCommandUID( self, name, args ):
         '''Process commands using the UID alternatives
@@ -1035,7 +1607,7 @@ class IMAP4P(object):
         command = 'UID %s %s' % (name, args)
 
         # Sends the command to the server, and parses the response
-        tag, response = self.send_command(command)
+        tag, response = self._send_command('UID %s' % name, command)
 
         # Checks if the command was successfull
         if self._checkok(tag, response):
@@ -1048,27 +1620,111 @@ class IMAP4P(object):
         '''Alters flag dispositions for messages in mailbox UID version.
         '''
 
-        name = 'STORE'
+        return self._store( True, message_set, command, flags )
 
-        flags = '(' + ' '.join(flags) + ')'
+    def copy_uid(self, message_list, mailbox ):
+        '''Copy messages to mailbox, UID version.'''
+        return self._copy( True, message_list, mailbox )
 
-        if isinstance(message_set, list):
-            message_set = shrink_fetch_list( message_set )
-            message_set = ','.join( '%s' % Xi for Xi in message_set)
-        args = '%s %s %s' % (message_set, command, flags )
+    def fetch_uid(self, message_list, message_parts='(FLAGS)', sink = None,
+            sink_threshold = SINK_THRESHOLD ):
+        '''Fetch (parts of) messages, UID version.
 
-        result = self.processCommandUID( name, args)
+        If we have a structure cache and only the BODYSTRUCTURE (and the UID)
+        is requested, the cached structures are used, see
+        L{fetch_structure<fetch_structure>}.
+
+        The big literals can be written to a sink, see L{fetch<fetch>}.
+        '''
+        if self.structure_cache is not None:
+            items = set( message_parts.strip('()').upper().split() )
+            if items in ( set(['BODYSTRUCTURE']),
+                          set(['BODYSTRUCTURE', 'UID']) ) and \
+               not isinstance(message_list, basestring):
+                return self.fetch_structure( message_list )
+
+        result = self._fetch( True, message_list, message_parts, sink,
+            sink_threshold )
+        self._cache_structures(result)
         return result
 
-    def fetch_uid(self, message_list, message_parts='(FLAGS)' ):
-        '''Fetch (parts of) messages, UID version.'''
-        return self._fetch( True, message_list, message_parts )
+    def fetch_structure(self, message_list):
+        '''Fetch the BODYSTRUCTURE of the messages, using the structure cache.
+
+        The body structure of a message never changes, so if it's already on
+        the cache we don't have to fetch it again. Only the messages not
+        found on the cache are requested to the server.
+
+        @param message_list: iterable of uids, integers or strings.
+
+        @return: dict, with the uids as keys, of dicts with the 'UID' and
+        'BODYSTRUCTURE' data items. The same plain dicts are returned whether
+        the structures come from the cache or from the server.
+        '''
+        # The cache keys, as the fetch responses, have integer uids
+        message_list = [ int(uid) for uid in message_list ]
+
+        result = {}
+        key = self._cache_key()
+        if key is None:
+            misses = message_list
+        else:
+            misses = []
+            for uid in message_list:
+                structure = self.structure_cache.get( key + (uid,) )
+                if structure is None:
+                    misses.append(uid)
+                else:
+                    result[uid] = { 'UID': uid, 'BODYSTRUCTURE': structure }
+
+        if misses:
+            fetched = self._fetch( True, misses, '(UID BODYSTRUCTURE)' )
+            self._cache_structures(fetched)
+            for response in fetched.itervalues():
+                if 'BODYSTRUCTURE' in response and 'UID' in response:
+                    result[response['UID']] = { 'UID': response['UID'],
+                        'BODYSTRUCTURE': response['BODYSTRUCTURE'] }
+
+        self.sstatus['fetch_response'] = result
+        return result
+
+    def _cache_key(self):
+        '''Cache key prefix for the selected mailbox, (mailbox, UIDVALIDITY).
+        None if there's no cache or we don't know the UIDVALIDITY.
+        '''
+        if self.structure_cache is None:
+            return None
+        folder = self.sstatus.get('current_folder', {})
+        if folder.get('UIDVALIDITY') is None or 'name' not in folder:
+            return None
+        return ( folder['name'], folder['UIDVALIDITY'] )
+
+    def _cache_structures(self, fetch_response):
+        '''Stores the body structures found on a fetch response.'''
+        key = self._cache_key()
+        if key is None:
+            return
+        for uid, response in fetch_response.iteritems():
+            if 'BODYSTRUCTURE' in response and 'UID' in response:
+                self.structure_cache.set( key + (response['UID'],),
+                    response['BODYSTRUCTURE'],
+                    getattr(response, 'raw_size', 0) )
+
+    def _check_uidvalidity(self, mailbox, uidvalidity):
+        '''If the UIDVALIDITY of a mailbox changed, its cached structures are
+        discarded.'''
+        old = self.cache_uidvalidity.get(mailbox)
+        if old is not None and old != uidvalidity:
+            for key in self.structure_cache.keys():
+                if key[0] == mailbox:
+                    self.structure_cache.discard(key)
+        self.cache_uidvalidity[mailbox] = uidvalidity
 
     def search_uid(self, criteria, charset=None):
         '''SEARCH command UID version'''
 
         name = 'SEARCH'
-        self.sstatus['search_response'] = ()
+        self.sstatus['search_response'] = MessageArray()
         if charset:
             args = 'CHARSET %s %s' % (charset, criteria)
         else:
@@ -1080,7 +1736,7 @@ class IMAP4P(object):
         extension.
         '''
         name = 'SORT'
-        self.sstatus['sort_response'] = ()
+        self.sstatus['sort_response'] = MessageArray()
         args = '%s %s %s' % (program, charset, search_criteria)
         return self.processCommandUID(name, args)['sort_response']
 
@@ -29,8 +29,12 @@
 '''
 
 # Imports
+import re
+from collections import MutableMapping, KeysView, ItemsView, ValuesView
+
 from utils import getUnicodeHeader, getUnicodeMailAddr, envelopedate2datetime
-from sexp import scan_sexp
+from sexp import scan_sexp, scan_element, SError, SexpScanner
+from imapcommands import FETCHRESP
 
 # Body structure
 
@@ -349,22 +353,231 @@ class Envelope( dict ):
         '''Returns a list with the first and last names'''
         return self.short_mail_list(self['env_from'])
 
-class FetchParser( dict ):
+# Fast path for the fetch responses
+
+# The data items we know about, followed by the value
+fetch_item_re = re.compile(r'(%s) ' % '|'.join(FETCHRESP))
+
+# Precompiled value parsers for the usual data items. If the value doesn't
+# match, it's scanned as a generic s-exp element.
+fetch_number_re = re.compile(r'(\d+)(?=[ )])')
+fetch_flags_re = re.compile(r'\(([^()"{\[\t\r\n]*)\)')
+fetch_quoted_re = re.compile(r'"([^"\\]*)"')
+
+# ENVELOPE, only quoted strings and NIL are accepted
+NSTRING = r'(?:"[^"\\]*(?:\\"[^"\\]*)*"|NIL)'
+ADDRESS = r'\(%s %s %s %s\)' % ((NSTRING,) * 4)
+ADDRESS_LIST = r'(NIL|\((?:%s ?)+\))' % ADDRESS
+fetch_address_re = re.compile(r'\((%s) (%s) (%s) (%s)\)' % ((NSTRING,) * 4))
+fetch_envelope_re = re.compile(r'\((%s) (%s) %s %s %s %s %s %s (%s) (%s)\)' % (
+    NSTRING, NSTRING, ADDRESS_LIST, ADDRESS_LIST, ADDRESS_LIST, ADDRESS_LIST,
+    ADDRESS_LIST, ADDRESS_LIST, NSTRING, NSTRING))
+
+def nstring(value):
+    if value == 'NIL':
+        return None
+    return value[1:-1]
+
+def address_list(value):
+    if value == 'NIL':
+        return None
+    return [ [ None if Xi == 'NIL' else Xi[1:-1] for Xi in address ]
+             for address in fetch_address_re.findall(value) ]
+
+def flag_list(mo):
+    '''The flags are atoms, converted the way scan_sexp does.'''
+    return [ int(Xi) if Xi.isdigit() else None if Xi == 'NIL' else Xi
+             for Xi in mo.group(1).split() ]
+
+def envelope_value(mo):
+    value = mo.groups()
+    return [ nstring(value[0]), nstring(value[1]) ] + \
+           [ address_list(Xi) for Xi in value[2:8] ] + \
+           [ nstring(value[8]), nstring(value[9]) ]
+
+FETCH_VALUES = {
+    'UID': (fetch_number_re, lambda mo: int(mo.group(1))),
+    'RFC822.SIZE': (fetch_number_re, lambda mo: int(mo.group(1))),
+    'FLAGS': (fetch_flags_re, flag_list),
+    'INTERNALDATE': (fetch_quoted_re, lambda mo: mo.group(1)),
+    'ENVELOPE': (fetch_envelope_re, envelope_value),
+    }
+
+def fetch_data_items(text):
+    '''Single pass parser for the usual fetch responses.
+
+    The usual message list fetch, for instance
+    '(UID FLAGS RFC822.SIZE INTERNALDATE ENVELOPE)', has a fixed layout, the
+    data items are the ones in L{FETCHRESP<imaplibii.imapcommands.FETCHRESP>}
+    and their values have a regular layout. These values are extracted
+    directly with precompiled regular expressions, the others (BODYSTRUCTURE,
+    literals, ...) go through the s-exp scanner.
+
+    @param text: fetch response without the message number, for instance
+    '(UID 10 FLAGS (\Seen))'.
+
+    @return: dict with the data items as returned by the server, or None if
+    the response doesn't have the expected layout. In this case the
+    generic parser must be used.
+    '''
+    if text[:1] != '(':
+        return None
+
+    result = {}
+    pos = 1
+    item_match = fetch_item_re.match
+
+    while True:
+        item = item_match(text, pos)
+        if not item:
+            return None
+        name = item.group(1)
+        pos = item.end()
+
+        value = None
+        if name in FETCH_VALUES:
+            value_re, conv = FETCH_VALUES[name]
+            value = value_re.match(text, pos)
+
+        if value:
+            result[name] = conv(value)
+            pos = value.end()
+        else:
+            try:
+                result[name], pos = scan_element(text, pos)
+            except SError:
+                return None
+
+        char = text[pos:pos+1]
+        if char == ')':
+            break
+        elif char != ' ':
+            return None
+        pos += 1
+
+    if text[pos+1:].strip():
+        return None
+
+    return result
+
+def scan_data_items(text):
+    '''Generic fetch response parser.
+
+    @param text: fetch response without the message number.
+
+    @return: dict with the data items as returned by the server.
+    '''
+    it = iter(scan_sexp(text)[0])
+    return dict(zip(it,it))
+
+class FetchParser( MutableMapping ):
     '''This class parses the fetch response (already as a python dict) and
     further processes.
+
+    In lazy mode the data items are kept as returned by the server, they're
+    converted only when they're accessed for the first time. This way we
+    don't spend time decoding envelopes or building body structures that
+    will never be used.
+
+    The data items are kept on a private dict and every accessor of the
+    mapping goes through __getitem__, so a lazy data item is converted
+    whatever the way it's reached (dict(response), ==, items(), ...).
     '''
 
-    def __init__(self, result):
-        # Scan the message and make it a dict
-        it = iter(scan_sexp(result)[0])
-        result = dict(zip(it,it))
+    def __init__(self, result, lazy = False):
+        '''
+        @param result: the fetch response, without the message number, or
+        its list of data items already scanned (see
+        L{FetchScanner<FetchScanner>}).
+        @param lazy: if true, the data items are converted on first access.
+        '''
+        if isinstance(result, list):
+            # The scanner sets the response lenght
+            self.raw_size = 0
+            it = iter(result)
+            items = dict(zip(it,it))
+        else:
+            # Lenght of the response, a rough estimate of the parsed size
+            self.raw_size = len(result)
+
+            # Scan the message and make it a dict, we try first the fast path
+            items = fetch_data_items(result)
+            if items is None:
+                items = scan_data_items(result)
+
+        self.__items = items
 
-        dict.__init__(self, result )
+        # Data items still waiting to be converted
+        self.pending_items = set()
 
-        for data_item in self:
-            method_name = data_item + '_data_item'
-            meth = getattr(self, method_name, self.default_data_item )
-            self[data_item] = meth( self[data_item] )
+        for data_item in items:
+            if lazy:
+                if hasattr(self, data_item + '_data_item'):
+                    self.pending_items.add(data_item)
+            else:
+                self.convert_data_item(data_item)
+
+    def convert_data_item(self, data_item):
+        '''Converts a data item, as returned by the server, to its python
+        representation.
+        '''
+        method_name = data_item + '_data_item'
+        meth = getattr(self, method_name, self.default_data_item )
+        self.__items[data_item] = meth( self.__items[data_item] )
+        self.pending_items.discard(data_item)
+
+    def convert_all(self):
+        '''Converts all the pending data items'''
+        for data_item in list(self.pending_items):
+            self.convert_data_item(data_item)
+
+    # Mapping interface, the lazy data items are converted before being
+    # returned. The other methods (get, items, values, pop, setdefault,
+    # popitem, ==, ...) are derived from these by MutableMapping.
+
+    def __getitem__(self, key):
+        if key in self.pending_items:
+            self.convert_data_item(key)
+        return self.__items[key]
+
+    def __setitem__(self, key, value):
+        self.pending_items.discard(key)
+        self.__items[key] = value
+
+    def __delitem__(self, key):
+        self.pending_items.discard(key)
+        del self.__items[key]
+
+    def __iter__(self):
+        return iter(self.__items)
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __contains__(self, key):
+        return key in self.__items
+
+    has_key = __contains__
+
+    def __repr__(self):
+        self.convert_all()
+        return repr(self.__items)
+
+    def copy(self):
+        '''@return: a dict with the converted data items.'''
+        self.convert_all()
+        return dict(self.__items)
+
+    def viewkeys(self):
+        return KeysView(self)
+
+    def viewitems(self):
+        return ItemsView(self)
+
+    def viewvalues(self):
+        return ValuesView(self)
+
+    # Data item conversion
 
     def default_data_item(self, data_item):
         return data_item
@@ -377,6 +590,33 @@ class FetchParser( dict ):
     def ENVELOPE_data_item(self, envelope ):
         return Envelope(envelope)
 
+class FetchScanner(SexpScanner):
+    '''Incremental scanner of a FETCH response, '* <n> FETCH (<data items>)'.
+
+    The response is fed as it's read from the server, see
+    L{IMAP4.scan_response<imaplibii.imapll.IMAP4.scan_response>}. As soon as
+    the data items list is complete the callback is called with the message
+    number and the L{FetchParser<FetchParser>} of the data items, the
+    response is never assembled or scanned again.
+    '''
+    def __init__(self, callback, lazy = False):
+        '''
+        @param callback: called with (message number, FetchParser instance).
+        @param lazy: passed to the FetchParser.
+        '''
+        SexpScanner.__init__(self, self._scanned)
+        self.fetch_callback = callback
+        self.lazy = lazy
+        self.msg_num = None
+
+    def _scanned(self, element):
+        if isinstance(element, list):
+            response = FetchParser(element, self.lazy)
+            response.raw_size = self.size
+            self.fetch_callback(self.msg_num, response)
+        elif isinstance(element, int):
+            self.msg_num = element
+
 if __name__ == '__main__':
     from imaplib2.imapp import IMAP4P
 
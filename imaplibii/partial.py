@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+
+'''Resumable download of big messages, or message parts, using partial
+fetches, BODY.PEEK[<section>]<<origin>.<size>>.
+
+The message is requested in chunks, if the connection is lost the download
+goes on, on a new connection, from the last chunk received. The chunks can
+also be requested on severall connections at the same time.
+
+Usage example::
+
+    from imaplibii.pool import IMAP4PPool
+    from imaplibii.partial import PartialDownloader
+
+    pool = IMAP4PPool()
+    downloader = PartialDownloader.from_pool(pool, 'imap.example.com',
+        'user', 'some pass', 'INBOX', 1234, section = '2')
+
+    with open('attachment', 'wb') as sink:
+        downloader.download(sink, workers = 4)
+'''
+
+# Global imports
+import sys
+import time
+import socket
+from threading import Thread, Lock
+from Queue import Queue, Empty
+
+# Local imports
+from imapp import IMAP4P
+from imapll import IMAP4
+from parsefetch import BODYERROR
+
+# Constants
+
+CHUNK_SIZE = 1048576    #: Octets requested on each partial fetch
+RETRIES = 5             #: Max consecutive connection errors on a chunk
+RETRY_DELAY = 1         #: Seconds to wait before reconnecting
+
+#: Errors after which the session is dropped and the chunk retried
+CONNECTION_ERRORS = (IMAP4P.Abort, IMAP4.Abort, socket.error)
+
+class DownloadError(Exception):
+    '''The download can't be completed'''
+    pass
+
+class PartialDownloader(object):
+    '''Downloads a message, or a message part, in chunks.
+
+    The sessions are obtained from the connect callable and returned with
+    the release callable, this way the downloader can be used with single
+    sessions or with an L{IMAP4PPool<imaplibii.pool.IMAP4PPool>} (see
+    L{from_pool<from_pool>}).
+
+    The progress is kept on <instance>.offset, the number of octets written
+    without gaps from the beginning of the part. A download interrupted by
+    an error can be resumed calling L{download<download>} again, or by a new
+    downloader created with that offset.
+    '''
+    def __init__(self, connect, mailbox, uid, section = '', release = None,
+            offset = 0, chunk_size = CHUNK_SIZE, retries = RETRIES,
+            retry_delay = RETRY_DELAY):
+        '''
+        @param connect: callable that returns a logged in
+        L{IMAP4P<imaplibii.imapp.IMAP4P>} instance.
+        @param mailbox: mailbox where the message is.
+        @param uid: message uid.
+        @param section: body section, for instance '2' or '1.TEXT', the
+        empty string for the complete message.
+        @param release: callable, called with (session, failed) when the
+        downloader no longer needs a session. failed is true after a
+        connection error. By default the sessions are logged out.
+        @param offset: octets already downloaded.
+        @param chunk_size: octets requested on each fetch.
+        @param retries: max connection errors in a row before giving up.
+        @param retry_delay: seconds to wait before reconnecting.
+        '''
+        self.connect = connect
+        self.release = release or self._logout
+        self.mailbox = mailbox
+        self.uid = int(uid)
+        self.section = section
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self.offset = offset
+        self.size = None            # Part size, None if unknown
+        self.uidvalidity = None
+
+        self.lock = Lock()
+        self.completed = {}         # offset: lenght, chunks after a gap
+
+    @classmethod
+    def from_pool(cls, pool, host, user, password, mailbox, uid, section = '',
+            port = None, ssl = False, **kwargs):
+        '''Creates a downloader that takes the sessions from a pool.
+
+        @param pool: an L{IMAP4PPool<imaplibii.pool.IMAP4PPool>} instance.
+        @param kwargs: further arguments to the constructor.
+        '''
+        def connect():
+            return pool.get(host, user, password, port, ssl)
+
+        def release(session, failed):
+            pool.release(session, discard = failed)
+
+        return cls(connect, mailbox, uid, section, release = release,
+            **kwargs)
+
+    def _logout(self, session, failed):
+        try:
+            if not failed:
+                session.logout()
+            session.shutdown()
+        except CONNECTION_ERRORS:
+            pass
+
+    ##
+    # Sessions
+    ##
+
+    def _open(self):
+        '''Gets a session with the mailbox selected, read only.'''
+        session = self.connect()
+        try:
+            session.examine(self.mailbox)
+            uidvalidity = session.sstatus['current_folder'].get('UIDVALIDITY')
+        except:
+            self.release(session, True)
+            raise
+
+        if self.uidvalidity is None:
+            self.uidvalidity = uidvalidity
+        elif uidvalidity != self.uidvalidity:
+            # The uids were reassigned, this may be other message
+            self.release(session, False)
+            raise DownloadError('The UIDVALIDITY of %s changed' %
+                self.mailbox)
+
+        return session
+
+    def _retry(self, slot, action):
+        '''Calls action with a session, on a connection error the session is
+        dropped and the action is retried on a new session.
+
+        @param slot: list with the session to use as its single item, None
+        to open a new one. The item is replaced when the session is.
+        @param action: callable, gets the session as argument.
+
+        @return: the action result.
+        '''
+        failures = 0
+        while True:
+            try:
+                if slot[0] is None:
+                    slot[0] = self._open()
+                return action(slot[0])
+            except CONNECTION_ERRORS, val:
+                session, slot[0] = slot[0], None
+                if session is not None:
+                    self.release(session, True)
+                failures += 1
+                if failures > self.retries:
+                    raise DownloadError('Giving up after %d connection '
+                        'errors: %s' % (failures, val))
+                time.sleep(self.retry_delay)
+
+    ##
+    # Fetches
+    ##
+
+    def _fetch_size(self, session):
+        '''@return: the size of the part, None if it can't be known.'''
+        uid = str(self.uid)
+        if not self.section:
+            response = session.fetch_uid(uid, '(RFC822.SIZE)')
+        else:
+            response = session.fetch_uid(uid, '(BODYSTRUCTURE)')
+
+        if self.uid not in response:
+            raise DownloadError('Message %d not found on %s' % (self.uid,
+                self.mailbox))
+
+        if not self.section:
+            return response[self.uid]['RFC822.SIZE']
+
+        try:
+            part = response[self.uid]['BODYSTRUCTURE'].find_part(self.section)
+            return part.body_fld_octets
+        except (BODYERROR, AttributeError):
+            # Multipart, or a section like HEADER or TEXT
+            return None
+
+    def _fetch_chunk(self, session, offset, size):
+        '''@return: the part octets from offset, at most size octets.'''
+        response = session.fetch_uid(str(self.uid), '(BODY.PEEK[%s]<%d.%d>)' %
+            (self.section, offset, size))
+
+        if self.uid not in response:
+            raise DownloadError('Message %d not found on %s' % (self.uid,
+                self.mailbox))
+
+        for name, value in response[self.uid].iteritems():
+            if name.startswith('BODY['):
+                return value or ''
+        return ''
+
+    def _write(self, sink, offset, data):
+        '''Writes a chunk and updates the offset.'''
+        with self.lock:
+            if hasattr(sink, 'seek'):
+                sink.seek(offset)
+            sink.write(data)
+
+            self.completed[offset] = len(data)
+            while self.offset in self.completed:
+                lenght = self.completed.pop(self.offset)
+                if not lenght:
+                    break
+                self.offset += lenght
+
+    ##
+    # Download
+    ##
+
+    def download(self, sink, workers = 1):
+        '''Downloads the part, from <instance>.offset to the end.
+
+        @param sink: writable object, the chunks are written on their offset
+        if it has a seek method. It must be seekable if workers > 1.
+        @param workers: number of sessions used at the same time. Only used
+        if the part size is known.
+
+        @return: the part size.
+        '''
+        slot = [ None ]
+        try:
+            size = self._retry(slot, self._fetch_size)
+            if size is not None:
+                self.size = size
+
+            if workers > 1 and self.size is not None:
+                self._download_parallel(slot, sink, workers)
+            else:
+                self._download_sequential(slot, sink)
+        finally:
+            if slot[0] is not None:
+                self.release(slot[0], False)
+
+        return self.size
+
+    def _download_sequential(self, slot, sink):
+        while self.size is None or self.offset < self.size:
+            offset = self.offset
+            size = self.chunk_size
+            if self.size is not None:
+                size = min(size, self.size - offset)
+
+            data = self._retry(slot,
+                lambda session: self._fetch_chunk(session, offset, size))
+            self._write(sink, offset, data)
+
+            if len(data) < size:
+                # End of the part
+                self.size = self.offset
+
+    def _download_parallel(self, slot, sink, workers):
+        chunks = Queue()
+        for offset in xrange(self.offset, self.size, self.chunk_size):
+            chunks.put(offset)
+
+        # The first worker takes our session
+        slots = [ [ slot[0] ] ] + [ [ None ] for i in range(workers - 1) ]
+        slot[0] = None
+
+        errors = []
+        threads = []
+        for worker_slot in slots:
+            thread = Thread(target = self._worker,
+                args = (worker_slot, chunks, sink, errors))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+        if self.offset < self.size:
+            # The part is smaller than announced
+            self.size = self.offset
+
+    def _worker(self, slot, chunks, sink, errors):
+        '''Fetches chunks until the queue is empty.'''
+        try:
+            while not errors:
+                try:
+                    offset = chunks.get_nowait()
+                except Empty:
+                    break
+                size = min(self.chunk_size, self.size - offset)
+
+                data = self._retry(slot,
+                    lambda session: self._fetch_chunk(session, offset, size))
+                self._write(sink, offset, data)
+        except:
+            errors.append(sys.exc_info())
+
+        if slot[0] is not None:
+            self.release(slot[0], False)
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+
+'''Change notification by polling, for servers without IDLE.
+
+The L{MailboxPoller<MailboxPoller>} watches severall mailboxes of an
+account on a single session. The selected mailbox is polled with NOOP, the
+others with STATUS, the STATUS commands of a round are pipelined.
+
+Each mailbox has its own interval: it's shortened when the mailbox changes
+and grows, up to max_interval, while it doesn't. So busy mailboxes are
+polled often and quiet ones seldom, but no change takes more than
+max_interval seconds to be noticed. The intervals are jittered, this way
+many pollers started at the same time don't hit the server together.
+
+Usage example::
+
+    from imaplibii.poller import MailboxPoller
+
+    def changed(mailbox, status, previous):
+        print '%s: %d messages' % (mailbox, status['MESSAGES'])
+
+    M = IMAP4P('imap.example.com', autologout = False)
+    M.login(user, password)
+
+    poller = MailboxPoller(M, changed)
+    for mailbox in ('INBOX', 'Lists', 'Sent'):
+        poller.watch(mailbox)
+    poller.start()
+'''
+
+# Global imports
+import time
+import random
+import socket
+import traceback
+from threading import Thread, Lock, Event
+
+# Local imports
+from imapll import IMAP4
+from imapp import IMAP4P
+
+# Constants
+
+POLL_INTERVAL = 60          #: Initial interval of each mailbox (s)
+POLL_MIN_INTERVAL = 15      #: Min interval (s)
+POLL_MAX_INTERVAL = 10 * 60 #: Max interval, bounds the notification latency
+POLL_BACKOFF = 1.5          #: Interval factor after a poll without changes
+POLL_SPEEDUP = 0.5          #: Interval factor after a poll with changes
+POLL_JITTER = 0.1           #: Max random fraction added or taken to the
+                            #  intervals
+POLL_BATCH = 0.25           #: Fraction of its interval a mailbox can be
+                            #  polled early, to join a round
+POLL_ITEMS = '(MESSAGES UIDNEXT UNSEEN)' #: STATUS items requested
+
+#: Errors that stop the poller thread
+POLL_ERRORS = (IMAP4.Abort, IMAP4.Error, IMAP4P.Abort, IMAP4P.Error,
+    socket.error)
+
+class PolledMailbox(object):
+    '''Poll state of a mailbox.'''
+    __slots__ = ('name', 'callback', 'interval', 'due', 'status', 'polls',
+        'changes')
+
+    def __init__(self, name, callback, interval, due):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.due = due          # Time of the next poll
+        self.status = None      # Last status
+        self.polls = 0
+        self.changes = 0
+
+class MailboxPoller(object):
+    '''Polls the mailboxes of an account.
+
+    The callbacks are called as::
+
+        callback(mailbox, status, previous)
+
+    Where status is the STATUS response dict, with the POLL_ITEMS items, and
+    previous the status on the last poll. The callbacks aren't called on the
+    first poll of a mailbox, it's taken as reference.
+
+    The selected mailbox is polled with NOOP (RFC3501 advises against
+    STATUS on it), its status dict has the 'MESSAGES' item and the
+    'EXPUNGE' list and 'FETCH' dict of the responses received.
+
+    The session can't be used by other threads while the poller runs.
+    '''
+    def __init__(self, session, callback = None, interval = POLL_INTERVAL,
+            min_interval = POLL_MIN_INTERVAL,
+            max_interval = POLL_MAX_INTERVAL, backoff = POLL_BACKOFF,
+            speedup = POLL_SPEEDUP, jitter = POLL_JITTER, batch = POLL_BATCH,
+            items = POLL_ITEMS, on_error = None):
+        '''
+        @param session: logged in L{IMAP4P<imaplibii.imapp.IMAP4P>} instance.
+        @param callback: default callback of the mailboxes.
+        @param interval: initial interval of each mailbox, in seconds.
+        @param min_interval: the interval isn't shortened below this.
+        @param max_interval: the interval doesn't grow beyond this.
+        @param backoff: the interval is multiplied by this after a poll
+        without changes.
+        @param speedup: the interval is multiplied by this after a poll with
+        changes.
+        @param jitter: max fraction of the interval randomly added or taken.
+        @param batch: mailboxes due within this fraction of their interval
+        are polled on the current round.
+        @param items: STATUS data items requested.
+        @param on_error: called with (poller, exception) when the poller
+        thread stops because of an error.
+        '''
+        self.session = session
+        self.callback = callback
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.speedup = speedup
+        self.jitter = jitter
+        self.batch = batch
+        self.items = items
+        self.on_error = on_error
+
+        self.lock = Lock()
+        self.mailboxes = {}     # name: PolledMailbox
+        self.rounds = 0
+
+        self.thread = None
+        self.running = False
+        self.wakeup = Event()
+
+    def __len__(self):
+        return len(self.mailboxes)
+
+    ##
+    # Mailboxes
+    ##
+
+    def watch(self, mailbox, callback = None):
+        '''Starts polling a mailbox, the first poll is on the next round.'''
+        with self.lock:
+            self.mailboxes[mailbox] = PolledMailbox(mailbox,
+                callback or self.callback, self.interval, time.time())
+        self.wakeup.set()
+
+    def unwatch(self, mailbox):
+        with self.lock:
+            self.mailboxes.pop(mailbox, None)
+
+    def next_poll(self):
+        '''@return: seconds to the next poll, None if no mailbox is
+        watched.'''
+        with self.lock:
+            if not self.mailboxes:
+                return None
+            return max(0, min( polled.due for polled in
+                self.mailboxes.itervalues() ) - time.time())
+
+    ##
+    # Polling
+    ##
+
+    def poll(self):
+        '''Runs a round, polls the mailboxes due.
+
+        @return: seconds to the next poll, None if no mailbox is watched.
+        '''
+        now = time.time()
+        with self.lock:
+            due = [ polled for polled in self.mailboxes.itervalues()
+                if polled.due - polled.interval * self.batch <= now ]
+        if not due:
+            return self.next_poll()
+
+        selected = None
+        if self.session.state == 'SELECTED':
+            selected = self.session.sstatus['current_folder'].get('name')
+        others = [ polled.name for polled in due if polled.name != selected ]
+
+        statuses = {}
+        if others:
+            statuses = self._status(others)
+        if selected is not None and len(others) < len(due):
+            statuses[selected] = self._poll_selected()
+
+        self.rounds += 1
+        now = time.time()
+        for polled in due:
+            status = statuses.get(polled.name)
+            if status is not None:
+                status = dict(status)
+                status.pop('mailbox', None)
+            self._update(polled, status, now)
+
+        return self.next_poll()
+
+    def _status(self, mailboxes):
+        '''Pipelined STATUS of the mailboxes. If one of the commands fails,
+        for instance because the mailbox was deleted, they are sent again one
+        by one, the failed mailboxes are left out.'''
+        try:
+            return self.session.status_mailboxes(mailboxes, self.items)
+        except IMAP4P.Error:
+            pass
+
+        statuses = {}
+        for mailbox in mailboxes:
+            try:
+                statuses[mailbox] = self.session.status(mailbox, self.items)
+            except IMAP4P.Error:
+                pass
+        return statuses
+
+    def _poll_selected(self):
+        folder = self.session.sstatus['current_folder']
+        folder['expunge_list'] = []
+        self.session.sstatus['fetch_response'] = {}
+
+        self.session.noop()
+
+        return { 'MESSAGES': folder.get('EXISTS'),
+            'EXPUNGE': folder['expunge_list'],
+            'FETCH': self.session.sstatus['fetch_response'] }
+
+    def _changed(self, polled, status):
+        previous = polled.status
+        if previous is None:
+            return False
+        if status.get('EXPUNGE') or status.get('FETCH'):
+            return True
+        return any( status[name] != previous.get(name) for name in status
+            if name not in ('EXPUNGE', 'FETCH') )
+
+    def _update(self, polled, status, now):
+        '''Adapts the mailbox interval and calls the callback.'''
+        polled.polls += 1
+        changed = status is not None and self._changed(polled, status)
+
+        if changed:
+            polled.changes += 1
+            polled.interval = max(self.min_interval,
+                polled.interval * self.speedup)
+        else:
+            polled.interval = min(self.max_interval,
+                polled.interval * self.backoff)
+        polled.due = now + polled.interval * (1 +
+            random.uniform(-self.jitter, self.jitter))
+
+        previous = polled.status
+        if status is not None:
+            polled.status = status
+        if changed and polled.callback:
+            try:
+                polled.callback(polled.name, status, previous)
+            except Exception:
+                traceback.print_exc()
+
+    ##
+    # Thread
+    ##
+
+    def start(self):
+        '''Runs the poller on a new thread.'''
+        self.running = True
+        self.thread = Thread(target = self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def serve_forever(self):
+        self.running = True
+        try:
+            while self.running:
+                timeout = self.poll()
+                self.wakeup.wait(timeout)
+                self.wakeup.clear()
+        except POLL_ERRORS, val:
+            self.running = False
+            if self.on_error:
+                self.on_error(self, val)
+            else:
+                raise
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+
+'''Thread safe pool of logged in L{IMAP4P<imaplibii.imapp.IMAP4P>}
+sessions.
+
+Opening a session costs severall round trips (greeting, capabilities,
+login), the pool keeps the sessions open to be reused.
+
+Usage example::
+
+    from imaplibii.pool import IMAP4PPool
+
+    pool = IMAP4PPool(max_connections = 4)
+
+    with pool.session('imap.example.com', 'user', 'some pass') as M:
+        M.select('INBOX')
+        print M.search('UNSEEN')
+
+The sessions are created with autologout=False, the pool logs them out when
+they're evicted.
+'''
+
+# Global imports
+import time
+import socket
+import hashlib
+from threading import Condition
+from contextlib import contextmanager
+
+# Local imports
+from imapp import IMAP4P, MAXLOG, IMAP4_PORT, IMAP4_SSL_PORT
+from imapll import IMAP4
+from infolog import InfoLog
+
+# Constants
+
+POOL_SIZE = 4       #: Max connections per server
+CHECK_AFTER = 60    #: Seconds idle before a session is checked with NOOP
+MAX_IDLE = 1800     #: Seconds idle before a session is evicted
+
+#: Errors that leave a session unusable, the connection errors are raised by
+#: the low level IMAP4 instance
+SESSION_ERRORS = (IMAP4P.Error, IMAP4P.Abort, IMAP4.Error, IMAP4.Abort,
+    socket.error)
+
+class PoolExhausted(Exception):
+    '''There are no free sessions on the pool'''
+    pass
+
+class IMAP4PPool(object):
+    '''Pool of IMAP4P sessions, keyed by (host, port, ssl, user).
+
+    A session is taken from the pool with L{get<get>} and must be returned
+    with L{release<release>}, or the L{session<session>} context manager can
+    be used.
+    '''
+    def __init__(self, max_connections = POOL_SIZE, check_after = CHECK_AFTER,
+            max_idle = MAX_IDLE, timeout = None, **kwargs):
+        '''
+        @param max_connections: max connections, in use or idle, per key.
+        @param check_after: a session idle for more than this number of
+        seconds is checked with a NOOP before being handed out.
+        @param max_idle: a session idle for more than this number of seconds
+        is logged out.
+        @param timeout: default time to wait for a free session, None waits
+        forever.
+        @param kwargs: further arguments to the IMAP4P constructor, for
+        instance lazy_fetch or structure_cache.
+        '''
+        self.max_connections = max_connections
+        self.check_after = check_after
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.kwargs = kwargs
+
+        self.lock = Condition()
+        self.idle = {}      # key: [(session, last used), ...]
+        self.count = {}     # key: number of open sessions
+        self.passwords = {} # key: password digest
+        self.keys = {}      # id(session): (key, password digest)
+
+    def _key(self, host, port, ssl, user):
+        if not port:
+            port = ssl and IMAP4_SSL_PORT or IMAP4_PORT
+        return (host, port, bool(ssl), user)
+
+    def _digest(self, password):
+        return hashlib.sha1(password).hexdigest()
+
+    def _close(self, session):
+        '''Logs out a session, the errors are ignored.'''
+        try:
+            if session.state != 'LOGOUT':
+                session.logout()
+            session.shutdown()
+        except SESSION_ERRORS:
+            pass
+
+    def _open(self, key, password):
+        '''Opens and logs in a new session.'''
+        host, port, ssl, user = key
+        session = IMAP4P(host, port, ssl = ssl, autologout = False,
+            infolog = InfoLog(MAXLOG), **self.kwargs)
+        try:
+            session.login(user, password)
+        except:
+            self._close(session)
+            raise
+        return session
+
+    def get(self, host, user, password, port = None, ssl = False,
+            block = True, timeout = None):
+        '''Gets a logged in session.
+
+        @param block: if false, and the pool is exhausted, L{PoolExhausted}
+        is raised immediately.
+        @param timeout: max time to wait for a free session, if not specified
+        the pool default is used.
+
+        @return: an IMAP4P instance.
+        '''
+        key = self._key(host, port, ssl, user)
+        digest = self._digest(password)
+        if timeout is None:
+            timeout = self.timeout
+
+        while True:
+            session, last_used = self._take(key, digest, block, timeout)
+
+            if session is None:
+                # A new connection was reserved for us
+                try:
+                    session = self._open(key, password)
+                except:
+                    self._forget(key)
+                    raise
+                self.lock.acquire()
+                try:
+                    self.passwords[key] = digest
+                    self.keys[id(session)] = (key, digest)
+                finally:
+                    self.lock.release()
+                return session
+
+            if time.time() - last_used < self.check_after:
+                return session
+
+            # Check if the session is still alive
+            try:
+                session.noop()
+                return session
+            except SESSION_ERRORS:
+                self.release(session, discard = True)
+
+    def _take(self, key, digest, block, timeout):
+        '''Takes an idle session from the pool, or reserves a new connection.
+
+        @return: (session, last used), session is None if a new connection
+        must be opened.
+        '''
+        evicted = []
+        self.lock.acquire()
+        try:
+            if self.passwords.get(key, digest) != digest:
+                # Don't hand out the sessions opened with a different
+                # password, the password must be checked by the server
+                evicted.extend( session for session, last_used
+                    in self.idle.pop(key, []) )
+                self.count[key] = self.count.get(key, 0) - len(evicted)
+                del self.passwords[key]
+
+            deadline = timeout is not None and time.time() + timeout
+            while True:
+                idle = self.idle.get(key)
+                now = time.time()
+                while idle:
+                    session, last_used = idle.pop()
+                    if now - last_used > self.max_idle:
+                        evicted.append(session)
+                        self.count[key] -= 1
+                    else:
+                        return session, last_used
+
+                if self.count.get(key, 0) < self.max_connections:
+                    self.count[key] = self.count.get(key, 0) + 1
+                    return None, now
+
+                if not block:
+                    raise PoolExhausted('No free sessions for %s@%s:%s' %
+                        (key[3], key[0], key[1]))
+                if deadline:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise PoolExhausted('Timeout waiting for a session '
+                            'for %s@%s:%s' % (key[3], key[0], key[1]))
+                    self.lock.wait(remaining)
+                else:
+                    self.lock.wait()
+        finally:
+            self.lock.release()
+            for session in evicted:
+                self._close_evicted(session)
+
+    def _forget(self, key, session = None):
+        '''Frees a connection slot.'''
+        self.lock.acquire()
+        try:
+            self.count[key] -= 1
+            if session is not None:
+                self.keys.pop(id(session), None)
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def _close_evicted(self, session):
+        self.lock.acquire()
+        try:
+            self.keys.pop(id(session), None)
+        finally:
+            self.lock.release()
+        self._close(session)
+
+    def release(self, session, discard = False):
+        '''Returns a session to the pool.
+
+        @param discard: if true, the session is logged out instead of
+        being reused. The sessions that aren't connected are always
+        discarded.
+        '''
+        self.lock.acquire()
+        try:
+            key, digest = self.keys[id(session)]
+            if (discard or not session.connected or
+                session.state in ('LOGOUT', 'NONAUTH') or
+                self.passwords.get(key) != digest):
+                discard = True
+            else:
+                self.idle.setdefault(key, []).append( (session, time.time()) )
+                self.lock.notify()
+        finally:
+            self.lock.release()
+
+        if discard:
+            self._forget(key, session)
+            self._close(session)
+
+    @contextmanager
+    def session(self, host, user, password, port = None, ssl = False,
+            block = True, timeout = None):
+        '''Context manager, gets a session and returns it to the pool at the
+        end. If the connection fails, the session is discarded.
+        '''
+        session = self.get(host, user, password, port, ssl, block, timeout)
+        try:
+            yield session
+        except (IMAP4P.Abort, IMAP4.Abort, socket.error):
+            self.release(session, discard = True)
+            raise
+        except:
+            self.release(session)
+            raise
+        else:
+            self.release(session)
+
+    def prune(self):
+        '''Logs out the sessions idle for more than max_idle seconds.'''
+        evicted = []
+        self.lock.acquire()
+        try:
+            now = time.time()
+            for key, idle in self.idle.items():
+                fresh = [ item for item in idle
+                          if now - item[1] <= self.max_idle ]
+                evicted.extend( item[0] for item in idle
+                                if now - item[1] > self.max_idle )
+                self.count[key] -= len(idle) - len(fresh)
+                self.idle[key] = fresh
+            if evicted:
+                self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+        for session in evicted:
+            self._close_evicted(session)
+
+    def close(self):
+        '''Logs out all the idle sessions.'''
+        self.lock.acquire()
+        try:
+            evicted = []
+            for key, idle in self.idle.items():
+                evicted.extend( item[0] for item in idle )
+                self.count[key] -= len(idle)
+            self.idle.clear()
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+        for session in evicted:
+            self._close_evicted(session)
@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+
+'''Keepalives and IDLE refreshes for many connections.
+
+The timers of all the connections are kept on a hierarchical
+L{TimerWheel<TimerWheel>}, served by a single thread. Scheduling and
+cancelling a timer take constant time, so thousands of connections don't
+need thousands of threading.Timer threads.
+
+The L{KeepaliveScheduler<KeepaliveScheduler>} uses the wheel to:
+
+    - enable the TCP keepalive on the registered connections sockets;
+    - send NOOP on the connections that have been quiet for a while, so that
+    NAT boxes and servers don't drop them;
+    - end and restart IDLE before the 30 minutes server timeout (RFC2177).
+
+Usage example::
+
+    from imaplibii.scheduler import KeepaliveScheduler
+
+    scheduler = KeepaliveScheduler()
+
+    M = IMAP4P('imap.example.com', autologout = False)
+    M.login(user, password)
+    M.select('INBOX')
+    scheduler.register(M)
+
+    # On other thread scheduler.stop_idle(M) ends this
+    scheduler.idle(M)
+'''
+
+# Global imports
+import math
+import time
+import socket
+import traceback
+from threading import Thread, Lock, Event
+from Queue import Queue
+
+# Local imports
+from imapll import IMAP4
+from imapp import IMAP4P
+
+# Constants
+
+WHEEL_TICK = 1.0        #: Wheel resolution (s)
+WHEEL_SLOTS = 64        #: Slots on each wheel level
+WHEEL_LEVELS = 4        #: Wheel levels, the range is WHEEL_SLOTS**WHEEL_LEVELS
+                        #  ticks, later timers are cascaded until due
+
+NOOP_INTERVAL = 5 * 60  #: Seconds without traffic before NOOP is sent
+IDLE_REFRESH = 29 * 60  #: Seconds before the IDLE is restarted (RFC2177)
+KEEPALIVE_WORKERS = 4   #: Threads sending the NOOP and DONE commands
+
+#: Errors that drop a connection from the scheduler
+CONNECTION_ERRORS = (IMAP4.Abort, IMAP4P.Abort, socket.error)
+
+class WheelTimer(object):
+    '''A scheduled call, returned by L{TimerWheel.schedule}.'''
+    __slots__ = ('wheel', 'expires', 'callback', 'args', 'bucket')
+
+    def __init__(self, wheel, expires, callback, args):
+        self.wheel = wheel
+        self.expires = expires  # Tick on which the timer is due
+        self.callback = callback
+        self.args = args
+        self.bucket = None      # Wheel slot holding the timer
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+    def active(self):
+        return self.bucket is not None
+
+class TimerWheel(object):
+    '''Hierarchical timing wheel.
+
+    Level 0 has a slot per tick, each slot of level n covers WHEEL_SLOTS
+    slots of level n - 1. A timer is put on the lowest level its delay fits
+    in, when the lower level wraps around the timers of the next slot of the
+    upper level are cascaded down. This way a timer is moved at most
+    WHEEL_LEVELS times and both scheduling and cancelling are O(1).
+
+    The callbacks are called from the wheel thread, they should return
+    quickly.
+    '''
+    def __init__(self, tick = WHEEL_TICK, slots = WHEEL_SLOTS,
+            levels = WHEEL_LEVELS):
+        '''
+        @param tick: wheel resolution in seconds, the timers are due on the
+        first tick after their delay.
+        @param slots: slots on each level.
+        @param levels: number of levels.
+        '''
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheel = [ [ set() for i in range(slots) ]
+            for level in range(levels) ]
+
+        self.lock = Lock()
+        self.origin = time.time()
+        self.current = 0        # Ticks processed
+        self.count = 0          # Scheduled timers
+
+        self.thread = None
+        self.running = False
+        self.wakeup = Event()
+
+    def __len__(self):
+        return self.count
+
+    ##
+    # Timers
+    ##
+
+    def schedule(self, delay, callback, *args):
+        '''Calls callback(*args) after delay seconds.
+
+        @return: L{WheelTimer<WheelTimer>} instance, can be cancelled.
+        '''
+        with self.lock:
+            expires = max(self.current + 1,
+                int(math.ceil((time.time() + delay - self.origin) / self.tick)))
+            timer = WheelTimer(self, expires, callback, args)
+            self._insert(timer)
+            self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        '''Cancels a timer, does nothing if it was already called.'''
+        with self.lock:
+            if timer.bucket is not None:
+                timer.bucket.discard(timer)
+                timer.bucket = None
+                self.count -= 1
+
+    def _insert(self, timer):
+        delta = timer.expires - self.current
+        span = 1
+        for level in range(self.levels):
+            if delta < span * self.slots or level == self.levels - 1:
+                break
+            span *= self.slots
+        bucket = self.wheel[level][(timer.expires // span) % self.slots]
+        bucket.add(timer)
+        timer.bucket = bucket
+
+    def _advance(self):
+        '''Moves the wheel a tick.
+
+        @return: the timers due.
+        '''
+        self.current += 1
+        span = 1
+        for level in range(1, self.levels):
+            span *= self.slots
+            if self.current % span:
+                break
+            # The level below wrapped around, cascade the next slot
+            index = (self.current // span) % self.slots
+            bucket = self.wheel[level][index]
+            self.wheel[level][index] = set()
+            for timer in bucket:
+                self._insert(timer)
+
+        index = self.current % self.slots
+        due = self.wheel[0][index]
+        self.wheel[0][index] = set()
+        for timer in due:
+            timer.bucket = None
+        self.count -= len(due)
+        return due
+
+    ##
+    # Thread
+    ##
+
+    def start(self):
+        '''Runs the wheel on a new thread.'''
+        self.running = True
+        self.thread = Thread(target = self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def serve_forever(self):
+        self.running = True
+        while self.running:
+            self.wakeup.wait(self.run_pending())
+
+    def run_pending(self):
+        '''Calls the timers due.
+
+        @return: seconds to the next tick.
+        '''
+        with self.lock:
+            now = (time.time() - self.origin) // self.tick
+            due = []
+            while self.current < now:
+                due.extend(self._advance())
+
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                # Keep the wheel running
+                traceback.print_exc()
+
+        return max(0, self.origin + (self.current + 1) * self.tick -
+            time.time())
+
+class KeepaliveEntry(object):
+    '''Timers of a connection.'''
+    __slots__ = ('conn', 'noop', 'refresh', 'idling', 'in_idle', 'lock')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.noop = None        # NOOP timer
+        self.refresh = None     # IDLE refresh timer
+        self.idling = False     # True until stop_idle
+        self.in_idle = False    # True while on KeepaliveScheduler.idle
+        self.lock = Lock()      # Serializes the NOOP and DONE commands
+
+class KeepaliveScheduler(object):
+    '''Keeps the registered connections alive.
+
+    The NOOP and DONE commands are sent from a few worker threads. A
+    connection is only sent NOOP when it's not in IDLE, hasn't a command
+    waiting for its response and hasn't sent anything for noop_interval
+    seconds. Even so the NOOP may collide with a command sent by other
+    thread at that moment, the connections used by several threads should be
+    registered with noop_interval None.
+    '''
+    def __init__(self, wheel = None, noop_interval = NOOP_INTERVAL,
+            idle_refresh = IDLE_REFRESH, workers = KEEPALIVE_WORKERS,
+            tcp_keepalive = True, on_error = None):
+        '''
+        @param wheel: L{TimerWheel<TimerWheel>} instance, by default a new
+        one is created and started.
+        @param noop_interval: seconds without traffic before NOOP is sent,
+        None to never send NOOP.
+        @param idle_refresh: seconds in IDLE before it's restarted.
+        @param workers: number of threads sending the commands.
+        @param tcp_keepalive: if true the TCP keepalive is enabled on the
+        registered connections.
+        @param on_error: called with (connection, exception) when a
+        keepalive fails, the connection is unregistered.
+        '''
+        self.own_wheel = wheel is None
+        if self.own_wheel:
+            wheel = TimerWheel()
+            wheel.start()
+        self.wheel = wheel
+        self.noop_interval = noop_interval
+        self.idle_refresh = idle_refresh
+        self.tcp_keepalive = tcp_keepalive
+        self.on_error = on_error
+
+        self.lock = Lock()
+        self.entries = {}       # id(connection): KeepaliveEntry
+
+        self.tasks = Queue()
+        self.workers = []
+        for i in range(workers):
+            thread = Thread(target = self._worker)
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    def __len__(self):
+        return len(self.entries)
+
+    ##
+    # Connections
+    ##
+
+    def register(self, conn, noop_interval = False):
+        '''Starts the keepalives of a connection.
+
+        @param conn: L{IMAP4P<imaplibii.imapp.IMAP4P>} or
+        L{IMAP4<imaplibii.imapll.IMAP4>} instance.
+        @param noop_interval: overrides the scheduler noop_interval for this
+        connection.
+        '''
+        with self.lock:
+            entry = self.entries.get(id(conn))
+            if entry is None:
+                entry = self.entries[id(conn)] = KeepaliveEntry(conn)
+
+        if self.tcp_keepalive:
+            try:
+                conn._set_sock_keepalive()
+            except (socket.error, AttributeError):
+                # IMAP4_stream, or TCP options not available on this system
+                pass
+
+        if noop_interval is False:
+            noop_interval = self.noop_interval
+        if noop_interval is not None:
+            self._schedule_noop(entry, noop_interval)
+        return entry
+
+    def unregister(self, conn):
+        '''Cancels the timers of a connection. Doesn't end the IDLE, see
+        L{stop_idle<stop_idle>}.'''
+        with self.lock:
+            entry = self.entries.pop(id(conn), None)
+        if entry is not None:
+            for timer in (entry.noop, entry.refresh):
+                if timer is not None:
+                    timer.cancel()
+
+    def stop(self):
+        '''Stops the workers, and the wheel if it's ours. The connections
+        are left as they are.'''
+        for thread in self.workers:
+            self.tasks.put(None)
+        for thread in self.workers:
+            thread.join()
+        self.workers = []
+        if self.own_wheel:
+            self.wheel.stop()
+
+    ##
+    # NOOP
+    ##
+
+    def _schedule_noop(self, entry, delay):
+        entry.noop = self.wheel.schedule(delay, self._noop_due, entry, delay)
+
+    def _noop_due(self, entry, interval):
+        '''Wheel thread.'''
+        if id(entry.conn) not in self.entries:
+            return
+        conn = entry.conn
+        quiet = time.time() - getattr(conn, 'last_activity', 0)
+
+        if conn.state in ('IDLE', 'LOGOUT') or conn.tagged_commands:
+            self._schedule_noop(entry, interval)
+        elif quiet < interval:
+            # There was traffic meanwhile, no need to send NOOP yet
+            self._schedule_noop(entry, interval - quiet)
+        else:
+            self.tasks.put( (self._noop, entry, interval) )
+
+    def _noop(self, entry, interval):
+        '''Worker thread.'''
+        conn = entry.conn
+        try:
+            with entry.lock:
+                if conn.state not in ('IDLE', 'LOGOUT') and \
+                        not conn.tagged_commands:
+                    if isinstance(conn, IMAP4P):
+                        conn.noop()
+                    else:
+                        conn.send_command('NOOP')
+        finally:
+            # A NO or BAD response doesn't end the keepalives, a connection
+            # error unregisters the connection
+            if id(conn) in self.entries:
+                self._schedule_noop(entry, interval)
+
+    ##
+    # IDLE
+    ##
+
+    def idle(self, conn):
+        '''Keeps an L{IMAP4P<imaplibii.imapp.IMAP4P>} connection in IDLE
+        until L{stop_idle<stop_idle>} is called, the IDLE is restarted every
+        idle_refresh seconds. The responses are delivered by the connection
+        idle_dispatch.
+
+        The connection is registered if it isn't.
+        '''
+        entry = self.entries.get(id(conn)) or self.register(conn)
+        entry.idling = True
+        entry.in_idle = True
+        try:
+            while entry.idling:
+                entry.refresh = self.wheel.schedule(self.idle_refresh,
+                    self._refresh_due, entry)
+                try:
+                    conn.idle()
+                finally:
+                    entry.refresh.cancel()
+        finally:
+            entry.in_idle = False
+
+    def stop_idle(self, conn):
+        '''Ends the IDLE of a connection started with L{idle<idle>}. Returns
+        at once, idle returns when the server completes the IDLE.'''
+        entry = self.entries.get(id(conn))
+        if entry is not None:
+            entry.idling = False
+            self._refresh_due(entry)
+
+    def _refresh_due(self, entry):
+        if entry.conn.state == 'IDLE':
+            self.tasks.put( (self._done, entry) )
+        elif entry.in_idle:
+            # The server hasn't accepted the IDLE yet
+            entry.refresh = self.wheel.schedule(self.wheel.tick,
+                self._refresh_due, entry)
+
+    def _done(self, entry):
+        '''Worker thread.'''
+        with entry.lock:
+            if entry.conn.state == 'IDLE':
+                entry.conn.done()
+
+    ##
+    # Workers
+    ##
+
+    def _worker(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            method, entry = task[0], task[1]
+            try:
+                method(*task[1:])
+            except CONNECTION_ERRORS, val:
+                self.unregister(entry.conn)
+                if self.on_error:
+                    try:
+                        self.on_error(entry.conn, val)
+                    except Exception:
+                        traceback.print_exc()
+            except Exception:
+                traceback.print_exc()
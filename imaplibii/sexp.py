@@ -26,12 +26,17 @@
 #
 
 # Global imports
-import re, string
+import re
+from collections import deque
 
 # Regexp
-literal_re = re.compile(r'^{(\d+)}\r\n')
-simple_re = re.compile(r'^([^ ()\[]+\[[^\]]+\]|[^ ()]+)')
-quoted_re = re.compile(r'^"((?:[^"\\]|\\")*?)"')
+#
+# The expressions are not anchored, they're always used with an explicit start
+# position (pattern.match(text, pos)). This way we never have to slice the
+# text being scanned and the scanner runs in linear time.
+literal_re = re.compile(r'{(\d+)}\r\n')
+simple_re = re.compile(r'([^ ()\[]+\[[^\]]+\](?:<\d+>)?|[^ ()]+)')
+quoted_re = re.compile(r'"([^"\\]*(?:\\"[^"\\]*)*)"')
 
 # Errors
 class SError(Exception): pass
@@ -42,92 +47,354 @@ def scan_sexp(text):
     This is a non-recursive version. It uses the lists property of assigning
     only by reference to assemble the s-exp.
 
+    The regular expressions are matched in place, at the current position, so
+    the text is never copied and the scan time is linear in the text lenght.
+
     @param text: text to be scanned.
     @type  text: s-exp string
 
     @return result: s-exp in a python list.
     '''
+    return _scan(text, 0, False)[0]
+
+def scan_element(text, pos = 0):
+    '''Scans a single s-exp element, starting at a given position.
+
+    @param text: text to be scanned.
+    @type  text: s-exp string
+
+    @param pos: position where the element starts.
+
+    @return: (element, end) where end is the position right after the
+    element.
+    '''
+    result, pos = _scan(text, pos, True)
+    if not result:
+        raise SError('No element found')
+    return result[0], pos
+
+def _scan(text, pos, single):
+    '''Scanner used by L{scan_sexp<scan_sexp>} and
+    L{scan_element<scan_element>}.
+
+    @param single: if true, stops after the first top level element.
+
+    @return: (result, pos)
+    '''
 
     # Initialization
-    pos = 0
     lenght = len(text)
-    current = ''
     result = []
     cur_result = result
     level = [ cur_result ]
 
+    quoted_match = quoted_re.match
+    literal_match = literal_re.match
+    simple_match = simple_re.match
+
+    # Literal positions already known (see utils.LiteralString)
+    literals = getattr(text, 'literals', None)
+    if literals:
+        literals = dict( (lenght - offset, size) for offset, size in literals )
+    else:
+        literals = {}
+
+    # Literals written to a sink, the handle is used instead of the text
+    handles = getattr(text, 'handles', None)
+    if handles:
+        handles = dict( (lenght - offset, handle)
+                        for offset, handle in handles )
+    else:
+        handles = {}
+
     # Scanner
     while pos < lenght:
+        if single and result and len(level) == 1:
+            break
+
+        char = text[pos]
+
+        if char == ' ':
+            pos += 1
+
+        # Level handling, if we find a '(' we must add another list, if we
+        # find a ')' we must return to the previous list.
+        elif char == '(':
+            cur_result = []
+            level[-1].append(cur_result)
+            level.append(cur_result)
+            pos += 1
+
+        elif char == ')':
+            if len(level) < 2:
+                raise SError('Unexpected parenthesis at pos %d' % pos)
+            del level[-1]
+            cur_result = level[-1]
+            pos += 1
 
         # Quoted literal:
-        if text[pos] == '"':
-            quoted = quoted_re.match(text[pos:])
+        elif char == '"':
+            quoted = quoted_match(text, pos)
             if quoted:
-                cur_result.append( quoted.groups()[0] )
-                pos += quoted.end() - 1
+                cur_result.append( quoted.group(1) )
+                pos = quoted.end()
+            else:
+                pos += 1
 
         # Numbered literal:
-        elif text[pos] == '{':
-            lit = literal_re.match(text[pos:])
+        elif char == '{':
+            size = literals.get(pos)
+            if size is not None:
+                spec = '{%d}\r\n' % size
+                if text.startswith(spec, pos):
+                    start = pos + len(spec)
+                    if pos in handles:
+                        cur_result.append( handles[pos] )
+                    else:
+                        cur_result.append( text[ start:start+size ] )
+                    pos = start + size
+                    continue
+
+            lit = literal_match(text, pos)
             if lit:
-                 start = pos+lit.end()
-                 end = pos+lit.end()+int(lit.groups()[0])
-                 pos = end - 1
-                 cur_result.append( text[ start:end ] )
+                start = lit.end()
+                pos = start + int(lit.group(1))
+                cur_result.append( text[ start:pos ] )
+            else:
+                pos += 1
 
         # Simple literal
-        elif text[pos] not in '() ':
-            simple = simple_re.match(text[pos:])
-            if simple:
-                tmp = simple.groups()[0]
+        else:
+            simple = simple_match(text, pos)
+            tmp = simple.group(1)
+            if tmp.isdigit():
+                tmp = int(tmp)
+            elif tmp == 'NIL':
+                tmp = None
+            cur_result.append( tmp )
+            pos = simple.end()
+
+    return result, pos
+
+# Incremental scanner
+stream_simple_re = re.compile(r'([^ ()\r\n\[]+\[[^\]]+\](?:<\d+>)?|[^ ()\r\n]+)')
+SEPARATORS = ' \r\n'
+ATOM_END = SEPARATORS + '()'
+
+class SexpScanner(object):
+    '''Incremental S-Expression scanner.
+
+    The scanner can be fed with the server responses as they arrive, the
+    lines as returned by readline and the literals in as many chunks as
+    needed. Every top level element is made available as soon as it's
+    completed, this way we can process it while the rest of the response is
+    still on the wire.
+
+    The elements are the same produced by L{scan_sexp<scan_sexp>} with one
+    difference, CR and LF are handled as separators, since the line endings
+    reach the scanner unmodified.
+
+    Usage example::
+
+        scanner = SexpScanner()
+        scanner.feed('* 1 FETCH (UID 10 BODY[] {5}\\r\\n')
+        scanner.feed('12')
+        scanner.feed('345)\\r\\n')
+        for element in scanner:
+            print element
+
+    Instead of iterating over the scanner we can set a callback that will be
+    called with each completed top level element.
+    '''
+    def __init__(self, callback = None):
+        '''
+        @param callback: python callable called with each top level element,
+        if it's not defined the elements are queued and can be retrieved
+        iterating over the scanner.
+        '''
+        self.callback = callback
+        self.elements = deque()
+
+        self.level = [ [] ]
+        self.pending = ''       # Text that might be an incomplete token
+        self.literal_left = 0   # Literal octets still to be read
+        self.literal_parts = []
+        self.size = 0           # Octets fed
+
+    def __iter__(self):
+        '''Pops the completed top level elements.'''
+        while self.elements:
+            yield self.elements.popleft()
+
+    def _emit(self, element):
+        if len(self.level) > 1:
+            self.level[-1].append(element)
+        elif self.callback:
+            self.callback(element)
+        else:
+            self.elements.append(element)
+
+    def _feed_literal(self, data):
+        '''Adds data to the literal being read.
+
+        @return: the data following the literal.
+        '''
+        chunk = data[:self.literal_left]
+        self.literal_parts.append(chunk)
+        self.literal_left -= len(chunk)
+
+        if not self.literal_left:
+            literal = ''.join(self.literal_parts)
+            self.literal_parts = []
+            self._emit(literal)
+
+        return data[len(chunk):]
+
+    def skip_literal(self, element):
+        '''The literal being read was taken elsewhere, for instance written
+        to a sink, the element is used in its place.
+
+        @param element: the element that replaces the literal, for instance
+        a L{LiteralHandle<imaplibii.utils.LiteralHandle>}.
+        '''
+        if not self.literal_left:
+            raise SError('No literal is being read')
+        self.literal_left = 0
+        self.literal_parts = []
+        self._emit(element)
+
+    def feed(self, data):
+        '''Scans a chunk of the server response.
+
+        @param data: a piece of the response, the chunks can be split at any
+        point.
+        @type  data: string
+        '''
+        self.size += len(data)
+
+        if self.literal_left:
+            data = self._feed_literal(data)
+            if not data:
+                return
+
+        if self.pending:
+            data = self.pending + data
+            self.pending = ''
+
+        pos = 0
+        lenght = len(data)
+        level = self.level
+
+        while pos < lenght:
+            char = data[pos]
+
+            if char in SEPARATORS:
+                pos += 1
+
+            elif char == '(':
+                level.append([])
+                pos += 1
+
+            elif char == ')':
+                if len(level) < 2:
+                    raise SError('Unexpected parenthesis')
+                element = level.pop()
+                self._emit(element)
+                pos += 1
+
+            elif char == '"':
+                quoted = quoted_re.match(data, pos)
+                if quoted:
+                    self._emit( quoted.group(1) )
+                    pos = quoted.end()
+                elif data.find('\n', pos) == -1:
+                    # The quoted string can continue on the next chunk
+                    self.pending = data[pos:]
+                    return
+                else:
+                    pos += 1
+
+            elif char == '{':
+                lit = literal_re.match(data, pos)
+                if lit:
+                    self.literal_left = int(lit.group(1))
+                    self.literal_parts = []
+                    if self.literal_left:
+                        data = self._feed_literal(data[lit.end():])
+                        if self.literal_left:
+                            return
+                        pos = 0
+                        lenght = len(data)
+                    else:
+                        self._emit('')
+                        pos = lit.end()
+                elif data.find('\n', pos) == -1:
+                    # Incomplete literal specification
+                    self.pending = data[pos:]
+                    return
+                else:
+                    pos += 1
+
+            else:
+                simple = stream_simple_re.match(data, pos)
+                tmp = simple.group(1)
+                end = simple.end()
+                if end == lenght or ((data[end] not in ATOM_END or
+                   ('[' in tmp and tmp[-1] != ']')) and
+                   data.find('\n', pos) == -1):
+                    # The atom might continue on the next chunk, for
+                    # instance 'BODY[1]' followed by '<0>'
+                    self.pending = data[pos:]
+                    return
                 if tmp.isdigit():
                     tmp = int(tmp)
                 elif tmp == 'NIL':
                     tmp = None
-                cur_result.append( tmp )
-                pos += simple.end() - 1
-
-        # Level handling, if we find a '(' we must add another list, if we
-        # find a ')' we must return to the previous list.
-        elif text[pos] == '(':
-            cur_result.append([])
-            cur_result = cur_result[-1]
-            level.append(cur_result)
+                self._emit( tmp )
+                pos = simple.end()
 
-        elif text[pos] == ')':
-            try:
-                cur_result = level[-2]
-                del level[-1]
-            except IndexError:
-                raise SError('Unexpected parenthesis at pos %d' % pos)
-
-        pos += 1
+    def close(self):
+        '''Signals the end of the data. Any pending atom is terminated.
 
-    return result
+        @return: the list of queued top level elements.
+        '''
+        if self.pending:
+            # Whatever is pending is complete now
+            self.feed(' ')
+        if self.literal_left or len(self.level) > 1 or self.pending:
+            raise SError('Incomplete s-exp')
+        return list(self)
 
 if __name__ == '__main__':
     from time import time
 
-    count = 1000
-    text = '(A NIL {5}\r\n12345 (D E))(F G)'
-    text = '266 FETCH (FLAGS (\Seen) UID 31608 INTERNALDATE "30-Jan-2008 02:48:01 +0000" RFC822.SIZE 4509 ENVELOPE ("Tue, 29 Jan 2008 14:00:24 +0000" "Aprenda as tXcnicas e os truques da cozinha mais doce..." (("Ediclube" NIL "ediclube" "sigmathis.info")) (("Ediclube" NIL "ediclube" "sigmathis.info")) ((NIL NIL "ediclube" "sigmathis.info")) ((NIL NIL "helder" "example.com")) NIL NIL NIL "<64360f85d83238281a27b921fd3e7eb3@localhost.localdomain>"))'
-    #text = 'AA 12341 NIL (A NIL "asdasd fffff\\"sdasd" {%d}\r\n%s (D E))(F G)' % ( count, '#' * count)
-    #text = 'A B (C NIL (D E))(F G)'
-    text = '99 FETCH (UID 100 RFC822.SIZE 2260 INTERNALDATE "26-Oct-2004 04:35:14 +0000" FLAGS (\Seen) BODY[HEADER.FIELDS (Message-ID)] {54}%s%s)' % ( '\r\n', 'S' * 54 )
-
-
-    itx = 300
-    rit = xrange(itx)
+    sample = ('266 FETCH (FLAGS (\\Seen) UID 31608 INTERNALDATE '
+        '"30-Jan-2008 02:48:01 +0000" RFC822.SIZE 4509 ENVELOPE '
+        '("Tue, 29 Jan 2008 14:00:24 +0000" "Aprenda as tXcnicas e os '
+        'truques da cozinha mais doce..." (("Ediclube" NIL "ediclube" '
+        '"sigmathis.info")) (("Ediclube" NIL "ediclube" "sigmathis.info")) '
+        '((NIL NIL "ediclube" "sigmathis.info")) ((NIL NIL "helder" '
+        '"example.com")) NIL NIL NIL '
+        '"<64360f85d83238281a27b921fd3e7eb3@localhost.localdomain>") '
+        'BODY[HEADER.FIELDS (Message-ID)] {54}\r\n%s) ' % ('S' * 54))
 
     print 'Test to the s-exp parser:'
     print
-
-    print 'Non Recursive (%d times):' % itx
-    a = time()
-    for i in rit:
-        scan_sexp(text)
-    b = time()
-    print 1000 * (b-a) / itx, 'ms/iter'
-    print itx, ' --> ', 1000 * (b-a) , 'ms'
+    print scan_sexp(sample)
     print
-    print scan_sexp(text)
+
+    # Scaling benchmark, the time per KB should stay constant as the input
+    # grows if the scanner is linear.
+    print '%10s %10s %10s %12s' % ('size', 'ms', 'MB/s', 'us/KB')
+    for size in (1 << 10, 10 << 10, 100 << 10, 1 << 20, 10 << 20):
+        text = sample * (size // len(sample) + 1)
+        itx = max(1, (1 << 20) // size)
+
+        a = time()
+        for i in xrange(itx):
+            scan_sexp(text)
+        b = time()
+
+        elapsed = (b - a) / itx
+        print '%10d %10.3f %10.2f %12.2f' % (len(text), 1000 * elapsed,
+            len(text) / elapsed / (1 << 20), 1e6 * elapsed / (len(text) / 1024.))
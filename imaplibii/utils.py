@@ -29,38 +29,65 @@
 '''
 
 # Global imports
-import time, datetime
+import time, datetime, calendar
 import re
+from array import array
+from bisect import bisect_left
+from itertools import imap, islice
+from operator import le
+from collections import OrderedDict
+from threading import Lock
+from tempfile import SpooledTemporaryFile
 from email.header import decode_header
 
+# Constants
+HEADER_CACHE_SIZE = 10000 #: Number of decoded headers to keep
+DATE_CACHE_SIZE = 10000 #: Number of parsed dates to keep
+SEND_CHUNK = 65536  #: Size of the chunks read from the streamed literals
+SPOOL_SIZE = 1048576 #: Streamed literals bigger than this are spooled to disk
+
+# Encoded words or 8 bit characters, if none is present the header doesn't
+# need decoding
+header_special_re = re.compile(r'=\?|[\x80-\xff]')
+
+# Line ends
+map_crlf_re = re.compile(r'\r\n|\r|\n')
+
 # Utility functions
-def getUnicodeHeader( header ):
-    '''Returns an unicode string with the content of the
-    header string.
+def decodeHeader( header ):
+    '''Decodes the RFC 2047 encoded words on a header, returns an utf-8
+    encoded string.
     '''
-    if not header: return ''
-
-    # Decode the header:
     header_list = []
 
-    for header in decode_header(header):
-        if not header[1]:
-            codec = 'iso-8859-1'
-        else:
-            codec = header[1]
-
+    for text, codec in decode_header(header):
         try:
-            text = unicode(header[0], codec).encode('utf-8')
-        except:
-            try:
-                text = unicode(header[0], 'iso-8859-1').encode('utf-8')
-            except:
-                raise
+            text = unicode(text, codec or 'iso-8859-1').encode('utf-8')
+        except (UnicodeDecodeError, LookupError):
+            text = unicode(text, 'iso-8859-1').encode('utf-8')
 
         header_list.append(text)
 
     return ' '.join(header_list)
 
+def getUnicodeHeader( header ):
+    '''Returns an unicode string with the content of the
+    header string.
+
+    The plain ASCII headers are returned unmodified, the others are decoded
+    and kept on a cache, since the sender names and subjects repeat a lot.
+    '''
+    if not header: return ''
+
+    if not header_special_re.search(header):
+        return header
+
+    text = header_cache.get(header)
+    if text is None:
+        text = decodeHeader(header)
+        header_cache.set(header, text)
+    return text
+
 def getUnicodeMailAddr( address_list ):
     '''Return an address list with the mail addresses
     '''
@@ -108,97 +135,96 @@ EnvelopeDate = re.compile(r'(?:(?P<week_day>[A-Z][a-z][a-z]), )?(?P<day>[ \d][0-
      r'(?P<zonen>[-+])(?P<zoneh>[0-9][0-9])(?P<zonem>[0-9][0-9]).*'
     )
 
-def envelopedate2datetime(resp):
-    '''Convert an envelope date to tuple
-
-    Returns Python time module tuple.
-    '''
-    if not resp:
-        return datetime.datetime.fromtimestamp(0)
-
-    mo = EnvelopeDate.match(resp)
-
-    if not mo:
-        return datetime.datetime.fromtimestamp(0)
+def _date2epoch(mo, month):
+    '''Converts a date regexp match to UTC epoch seconds.'''
+    mon = Mon2num.get(mo.group(month))
+    if mon is None:
+        return None
 
-    try:
-        mon = Mon2num[mo.group('month')]
-    except:
-        return datetime.datetime.fromtimestamp(0)
-    zonen = mo.group('zonen')
-
-    day = int(mo.group('day'))
-    year = int(mo.group('year'))
-    hour = int(mo.group('hour'))
-    min = int(mo.group('min'))
-    sec = int(mo.group('sec'))
-    zoneh = int(mo.group('zoneh'))
-    zonem = int(mo.group('zonem'))
-
-    # INTERNALDATE timezone must be subtracted to get UT
-
-    zone = (zoneh*60 + zonem)*60
-    if zonen == '-':
+    # The timezone must be subtracted to get UT
+    zone = (int(mo.group('zoneh'))*60 + int(mo.group('zonem')))*60
+    if mo.group('zonen') == '-':
         zone = -zone
 
-    tt = (year, mon, day, hour, min, sec, -1, -1, -1)
+    tt = (int(mo.group('year')), mon, int(mo.group('day')),
+          int(mo.group('hour')), int(mo.group('min')), int(mo.group('sec')),
+          0, 0, 0)
 
     try:
-        utc = time.mktime(tt)
-    except:
-        return datetime.datetime.fromtimestamp(0)
-
-    # Following is necessary because the time module has no 'mkgmtime'.
-    # 'mktime' assumes arg in local timezone, so adds timezone/altzone.
-
-    lt = time.localtime(utc)
-    if time.daylight and lt[-1]:
-        zone = zone + time.altzone
-    else:
-        zone = zone + time.timezone
+        return calendar.timegm(tt) - zone
+    except (ValueError, OverflowError):
+        return None
 
-    return datetime.datetime.fromtimestamp(utc - zone)
+def envelopedate2epoch(resp):
+    '''Convert an envelope date to UTC epoch seconds.
 
-def Internaldate2tuple(resp):
-    """Convert IMAP4 INTERNALDATE to UT.
+    There's no round trip through the local time zone, and the results are
+    cached by the date string.
 
-    Returns Python time module tuple.
-    """
-    mo = InternalDate.match(resp)
-    if not mo:
-        return None
+    Returns 0 if the date can't be parsed.
+    '''
+    if not resp:
+        return 0
 
-    mon = Mon2num[mo.group('mon')]
-    zonen = mo.group('zonen')
+    epoch = envelope_date_cache.get(resp)
+    if epoch is None:
+        mo = EnvelopeDate.match(resp)
+        epoch = mo and _date2epoch(mo, 'month') or 0
+        envelope_date_cache.set(resp, epoch)
+    return epoch
 
-    day = int(mo.group('day'))
-    year = int(mo.group('year'))
-    hour = int(mo.group('hour'))
-    min = int(mo.group('min'))
-    sec = int(mo.group('sec'))
-    zoneh = int(mo.group('zoneh'))
-    zonem = int(mo.group('zonem'))
+def internaldate2epoch(resp):
+    '''Convert IMAP4 INTERNALDATE to UTC epoch seconds.
 
-    # INTERNALDATE timezone must be subtracted to get UT
+    The results are cached by the date string.
 
-    zone = (zoneh*60 + zonem)*60
-    if zonen == '-':
-        zone = -zone
+    Returns None if the date can't be parsed.
+    '''
+    epoch = internal_date_cache.get(resp)
+    if epoch is None:
+        mo = InternalDate.match(resp)
+        epoch = mo and _date2epoch(mo, 'mon')
+        if epoch is None:
+            return None
+        internal_date_cache.set(resp, epoch)
+    return epoch
+
+def dates2array(dates, convert = envelopedate2epoch):
+    '''Converts a column of dates, for instance the envelope dates of all
+    the messages of a mailbox, to an array of UTC epoch seconds. The dates
+    that can't be parsed are converted to 0.
+
+    The array is compact and can be used to sort the messages on the
+    client::
+
+        epochs = dates2array(dates)
+        order = sorted(xrange(len(epochs)), key = epochs.__getitem__)
+
+    @param dates: iterable of date strings.
+    @param convert: date conversion function, L{envelopedate2epoch} or
+    L{internaldate2epoch}.
+
+    @return: array of integers.
+    '''
+    return array('l', ( convert(date) or 0 for date in dates ))
 
-    tt = (year, mon, day, hour, min, sec, -1, -1, -1)
+def envelopedate2datetime(resp):
+    '''Convert an envelope date to datetime
 
-    utc = time.mktime(tt)
+    Returns a naive datetime, in local time.
+    '''
+    return datetime.datetime.fromtimestamp(envelopedate2epoch(resp))
 
-    # Following is necessary because the time module has no 'mkgmtime'.
-    # 'mktime' assumes arg in local timezone, so adds timezone/altzone.
+def Internaldate2tuple(resp):
+    """Convert IMAP4 INTERNALDATE to UT.
 
-    lt = time.localtime(utc)
-    if time.daylight and lt[-1]:
-        zone = zone + time.altzone
-    else:
-        zone = zone + time.timezone
+    Returns Python time module tuple.
+    """
+    epoch = internaldate2epoch(resp)
+    if epoch is None:
+        return None
 
-    return time.localtime(utc - zone)
+    return time.localtime(epoch)
 
 def shrink_fetch_list( msg_list ):
     '''Shrinks the message list to use on the fetch command, consecutive msg_list
@@ -209,38 +235,216 @@ def shrink_fetch_list( msg_list ):
 
     @return: a list with the shrinked msg_list
     '''
-    tmp = []
-    msg_list = list(msg_list)
-    msg_list.sort()
-    last = msg_list[0]
-    anchor = 0
-
-    for msgn in msg_list[1:]:
-        if (last + 1) == msgn and not anchor:
-            anchor = last
-        elif anchor:
-            if (last + 1) != msgn:
-                if (anchor + 1) != last:
-                    tmp.append( '%d:%d' % (anchor, last) )
-                else:
-                    tmp.append( '%d' % anchor )
-                    tmp.append(  '%d' % last )
-                anchor = 0
-        else:
-            tmp.append( last )
+    return SequenceSet(msg_list).items()
 
-        last = msgn
+STAR = 0x100000000 #: Represents '*', greater than any message number or uid
 
-    if anchor:
-        if (anchor + 1) != last:
-            tmp.append( '%d:%d' % (anchor, last) )
+def _range_str(start, end):
+    if end == STAR:
+        if start == STAR:
+            return '*'
+        return '%d:*' % start
+    if start == end:
+        return '%d' % start
+    return '%d:%d' % (start, end)
+
+def _coalesce(ranges):
+    '''Sorts a list of (start, end) tuples, and merges the overlapping and
+    adjacent ranges.'''
+    ranges = sorted(ranges)
+    result = []
+    for start, end in ranges:
+        if result and start <= result[-1][1] + 1:
+            if end > result[-1][1]:
+                result[-1] = (result[-1][0], end)
         else:
-            tmp.append( '%d' % anchor )
-            tmp.append( '%d' % last )
-    else:
-        tmp.append( '%d' % last )
+            result.append( (start, end) )
+    return result
+
+def parse_sequence_set(text):
+    '''Parses a sequence set as sent by the server, for instance
+    '1:5,9,20:*'.
 
-    return tmp
+    @return: a L{SequenceSet<SequenceSet>} instance.
+    '''
+    ranges = []
+    for item in text.split(','):
+        try:
+            start, end = item.split(':')
+        except ValueError:
+            start = end = item
+        start = start == '*' and STAR or int(start)
+        end = end == '*' and STAR or int(end)
+        if start > end:
+            start, end = end, start
+        ranges.append( (start, end) )
+    return SequenceSet(ranges = ranges)
+
+class SequenceSet(object):
+    '''Set of message numbers or UIDs, stored as a list of ranges.
+
+    The ranges are kept on <instance>.ranges, a sorted list of (start, end)
+    tuples, end included. The ranges don't overlap and are not adjacent.
+    The '*' of the IMAP sequence sets is represented by STAR.
+
+    The union (|), intersection (&) and difference (-) operations run in
+    time proportional to the number of ranges, not to the number of
+    messages.
+
+    A sequence set can be used wherever a message list is accepted by
+    L{IMAP4P<imaplibii.imapp.IMAP4P>}, if the command line gets too long it
+    will be split in several commands, see L{chunks<chunks>}.
+    '''
+    def __init__(self, numbers = (), ranges = None):
+        '''
+        @param numbers: iterable of message numbers or uids. If the numbers
+        are sorted they are not copied.
+
+        @param ranges: list of (start, end) tuples, in any order.
+        '''
+        if isinstance(numbers, SequenceSet):
+            ranges = numbers.ranges
+        elif isinstance(numbers, basestring):
+            ranges = parse_sequence_set(numbers).ranges
+
+        if ranges is not None:
+            self.ranges = _coalesce(ranges)
+            return
+
+        self.ranges = []
+        last = None
+        it = iter(numbers)
+        for number in it:
+            if last is not None and number <= last:
+                # Not sorted, sort the remaining numbers
+                self.ranges = _coalesce( self.ranges + [ (number, number) ] +
+                    [ (Xi, Xi) for Xi in it ] )
+                return
+            if last is not None and number == last + 1:
+                self.ranges[-1] = (self.ranges[-1][0], number)
+            else:
+                self.ranges.append( (number, number) )
+            last = number
+
+    def __len__(self):
+        '''Number of messages, '*' counts as a single message.'''
+        return sum( end - start + 1 for start, end in self.ranges )
+
+    def __nonzero__(self):
+        return bool(self.ranges)
+
+    def __iter__(self):
+        for start, end in self.ranges:
+            if end == STAR:
+                raise ValueError('Can\'t iterate over an open range')
+            for number in xrange(start, end + 1):
+                yield number
+
+    def __contains__(self, number):
+        if number == '*':
+            number = STAR
+        pos = bisect_left(self.ranges, (number, STAR + 1)) - 1
+        return pos >= 0 and self.ranges[pos][1] >= number
+
+    def __eq__(self, other):
+        if not isinstance(other, SequenceSet):
+            return False
+        return self.ranges == other.ranges
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __or__(self, other):
+        '''Union'''
+        result = []
+        a, b = self.ranges, other.ranges
+        i = j = 0
+        while i < len(a) or j < len(b):
+            if j == len(b) or (i < len(a) and a[i] < b[j]):
+                start, end = a[i]
+                i += 1
+            else:
+                start, end = b[j]
+                j += 1
+            if result and start <= result[-1][1] + 1:
+                if end > result[-1][1]:
+                    result[-1] = (result[-1][0], end)
+            else:
+                result.append( (start, end) )
+        return self._new(result)
+
+    def __and__(self, other):
+        '''Intersection'''
+        result = []
+        a, b = self.ranges, other.ranges
+        i = j = 0
+        while i < len(a) and j < len(b):
+            start = max(a[i][0], b[j][0])
+            end = min(a[i][1], b[j][1])
+            if start <= end:
+                result.append( (start, end) )
+            if a[i][1] < b[j][1]:
+                i += 1
+            else:
+                j += 1
+        return self._new(result)
+
+    def __sub__(self, other):
+        '''Difference'''
+        result = []
+        b = other.ranges
+        j = 0
+        for start, end in self.ranges:
+            while j < len(b) and b[j][1] < start:
+                j += 1
+            k = j
+            while k < len(b) and b[k][0] <= end:
+                if b[k][0] > start:
+                    result.append( (start, b[k][0] - 1) )
+                start = b[k][1] + 1
+                k += 1
+            if start <= end:
+                result.append( (start, end) )
+        return self._new(result)
+
+    union = __or__
+    intersection = __and__
+    difference = __sub__
+
+    def _new(self, ranges):
+        obj = SequenceSet()
+        obj.ranges = ranges
+        return obj
+
+    def items(self):
+        '''Returns the ranges as strings, for instance ['1:5', '9', '20:*'].
+        '''
+        return [ _range_str(start, end) for start, end in self.ranges ]
+
+    def chunks(self, max_len):
+        '''Splits the sequence set in strings not longer than max_len.
+
+        @param max_len: maximum lenght of each string.
+
+        @return: generator of sequence set strings.
+        '''
+        chunk = []
+        lenght = -1
+        for item in self.items():
+            if chunk and lenght + len(item) + 1 > max_len:
+                yield ','.join(chunk)
+                chunk = []
+                lenght = -1
+            chunk.append(item)
+            lenght += len(item) + 1
+        if chunk:
+            yield ','.join(chunk)
+
+    def __str__(self):
+        return ','.join(self.items())
+
+    def __repr__(self):
+        return '<SequenceSet %s>' % self
 
 class NotAvailable(Exception): pass
 
@@ -263,6 +467,302 @@ def auth_ntlm(username, password, domain):
 # Classes
 ##
 
+PARSE_CHUNK = 65536 # Text chunk size used by parse_numbers
+
+def parse_numbers(text):
+    '''Parses a space separated list of numbers, for instance the SEARCH
+    response, to an array.
+
+    The text is processed in chunks, this way we never have more than a
+    few thousand number strings in memory.
+
+    @param text: the numbers list.
+    @type  text: string
+
+    @return: an array of unsigned integers.
+    '''
+    # UIDs are 32 bit unsigned integers
+    numbers = array('I')
+    pos = 0
+    lenght = len(text)
+
+    while pos < lenght:
+        end = text.find(' ', pos + PARSE_CHUNK)
+        if end == -1:
+            end = lenght
+        numbers.extend(map(int, text[pos:end].split()))
+        pos = end
+
+    return numbers
+
+class MessageArray(object):
+    '''Compact list of message numbers or UIDs, as returned by the SEARCH and
+    SORT commands.
+
+    The numbers are kept on an array of machine integers instead of a tuple
+    of python integers. It can be used as a read only sequence, the slices
+    are also MessageArray instances.
+
+    Membership tests use a binary search. If the numbers are not sorted (the
+    SORT responses) a sorted copy is created on the first test.
+    '''
+    def __init__(self, numbers = ()):
+        '''
+        @param numbers: an array, or any iterable of integers.
+        '''
+        if isinstance(numbers, array):
+            self.numbers = numbers
+        else:
+            self.numbers = array('I', numbers)
+        self.index = None
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __iter__(self):
+        return iter(self.numbers)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return MessageArray(self.numbers[key])
+        return self.numbers[key]
+
+    def __contains__(self, number):
+        if self.index is None:
+            numbers = self.numbers
+            if all(imap(le, numbers, islice(numbers, 1, None))):
+                self.index = numbers
+            else:
+                self.index = array(numbers.typecode, sorted(numbers))
+        pos = bisect_left(self.index, number)
+        return pos < len(self.index) and self.index[pos] == number
+
+    def __eq__(self, other):
+        if isinstance(other, MessageArray):
+            return self.numbers == other.numbers
+        try:
+            return tuple(self.numbers) == tuple(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'MessageArray(%s)' % self.numbers.tolist()
+
+    def tolist(self):
+        return self.numbers.tolist()
+
+class LRUCache(object):
+    '''Least recently used cache.
+
+    The cache is bounded on the number of entries and, optionally, on the
+    total size of the cached values. When any of the bounds is exceeded the
+    least recently used entries are evicted. The size of each value is given
+    when it's stored, it's up to the caller to estimate it.
+
+    The cache can be shared between threads.
+    '''
+    def __init__(self, max_entries = 1000, max_bytes = None):
+        '''
+        @param max_entries: maximum number of entries.
+        @param max_bytes: maximum total size of the entries, None for no
+        limit.
+        '''
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key: (value, size)
+        self.size = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def keys(self):
+        return self.entries.keys()
+
+    def get(self, key, default = None):
+        '''Returns a cached value, and marks it as the most recently used.'''
+        with self.lock:
+            try:
+                entry = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value, size = 0):
+        '''Stores a value on the cache.
+
+        @param size: size of the value, used for the max_bytes bound.
+        '''
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while len(self.entries) > self.max_entries or \
+                  (self.max_bytes is not None and self.size > self.max_bytes):
+                old_key, (old_value, old_size) = self.entries.popitem(False)
+                self.size -= old_size
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+class LiteralString(str):
+    '''A server response that contains literals.
+
+    Besides the response text, we keep the position of every literal on it,
+    this way the parsers don't have to look for the literal specification
+    ({<size>}CRLF) to find out where the literal starts and ends.
+
+    The literals are stored on <instance>.literals as a list of
+    (offset, size) tuples, where offset is the position of the '{' character
+    counted from the end of the string. Since the response is only sliced
+    from the beginning, the offsets are still valid on any tail of the
+    response::
+
+        args = LiteralString(response[start:], response.literals)
+
+    The literals written to a sink (see L{LiteralHandle<LiteralHandle>}) are
+    replaced by an empty literal, {0}, their handles are stored on
+    <instance>.handles as a list of (offset, handle) tuples.
+    '''
+    def __new__(cls, text, literals, handles = ()):
+        obj = str.__new__(cls, text)
+        obj.literals = literals
+        obj.handles = handles
+        return obj
+
+    def tail(self, start):
+        '''@return: the response from start on, keeping the literals.'''
+        return LiteralString(self[start:], self.literals, self.handles)
+
+class LiteralHandle(object):
+    '''A literal written to a sink instead of being read to memory.
+
+    The sink is a writable object, for instance a file, a temporary file or
+    an mmap. The handle takes the place of the literal on the parsed
+    response.
+    '''
+    def __init__(self, sink, offset, size):
+        '''
+        @param sink: object the literal was written to.
+        @param offset: position of the literal on the sink, None if the sink
+        has no tell method.
+        @param size: literal size.
+        '''
+        self.sink = sink
+        self.offset = offset
+        self.size = size
+
+    def read(self):
+        '''Reads the literal back from the sink, the sink must be
+        seekable.'''
+        self.sink.seek(self.offset or 0)
+        return self.sink.read(self.size)
+
+    def __repr__(self):
+        return '<LiteralHandle %d bytes at %s>' % (self.size, self.offset)
+
+def read_chunks(fileobj, size = SEND_CHUNK):
+    '''Iterates over the contents of a file like object, size bytes at a
+    time.'''
+    return iter(lambda: fileobj.read(size), '')
+
+def normalize_crlf(chunks):
+    '''Converts the line ends of a stream of text chunks to CRLF.
+
+    A CR at the end of a chunk is held back until the next chunk is read,
+    since it can be the first half of a CRLF.
+
+    @param chunks: iterable of strings.
+
+    @return: generator of the converted chunks.
+    '''
+    held_cr = ''
+    for chunk in chunks:
+        chunk = held_cr + chunk
+        if chunk[-1:] == '\r':
+            chunk, held_cr = chunk[:-1], '\r'
+        else:
+            held_cr = ''
+        if chunk:
+            yield map_crlf_re.sub('\r\n', chunk)
+    if held_cr:
+        yield '\r\n'
+
+class StreamLiteral(object):
+    '''Literal to be sent to the server in chunks.
+
+    The line ends are converted to CRLF as the data is read. Since the
+    literal size must be sent before the data, the size is computed on a
+    first pass over the message if it's a seekable file, otherwise the
+    converted data is spooled to a temporary file (kept in memory up to
+    SPOOL_SIZE bytes).
+
+    The literal data can only be iterated over once.
+    '''
+    def __init__(self, message, chunk_size = SEND_CHUNK):
+        '''
+        @param message: string, file like object or iterable of strings.
+        @param chunk_size: size of the chunks read from a file.
+        '''
+        self.chunk_size = chunk_size
+        self.spool = None
+
+        if isinstance(message, basestring):
+            message = map_crlf_re.sub('\r\n', message)
+            self.size = len(message)
+            self.chunks = [ message ]
+            return
+
+        if hasattr(message, 'read'):
+            try:
+                start = message.tell()
+                message.seek(start)
+            except (AttributeError, IOError):
+                message = read_chunks(message, chunk_size)
+            else:
+                self.size = sum( len(chunk) for chunk in
+                    normalize_crlf(read_chunks(message, chunk_size)) )
+                message.seek(start)
+                self.chunks = normalize_crlf(read_chunks(message, chunk_size))
+                return
+
+        self.spool = SpooledTemporaryFile(SPOOL_SIZE)
+        for chunk in normalize_crlf(message):
+            self.spool.write(chunk)
+        self.size = self.spool.tell()
+        self.spool.seek(0)
+        self.chunks = read_chunks(self.spool, chunk_size)
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield chunk
+        self.close()
+
+    def close(self):
+        '''Frees the spooled data.'''
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+    def __repr__(self):
+        return '<StreamLiteral %d bytes>' % self.size
+
 class ContinuationRequests(list):
     '''Class to be used with the continuation requests made by the server.
     '''
@@ -286,4 +786,10 @@ class ContinuationRequests(list):
         #    while True: list.pop(self)
         #except: pass
 
+##
+# Caches
+##
 
+header_cache = LRUCache(HEADER_CACHE_SIZE)
+envelope_date_cache = LRUCache(DATE_CACHE_SIZE)
+internal_date_cache = LRUCache(DATE_CACHE_SIZE)
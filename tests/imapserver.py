@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+'''A scripted IMAP server on a local socket, used by the tests.
+
+Each connection is served by its own thread. The commands are answered by
+the do_<COMMAND> methods (do_UID_FETCH for 'UID FETCH'), the ones without a
+method get a plain OK. The tests subclass IMAPServer to script the
+responses.
+'''
+
+import re
+import socket
+import threading
+
+literal_re = re.compile(r'{(\d+)(\+?)}$')
+
+class Connection(object):
+    '''A client connection to the server.'''
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.file = sock.makefile('rb')
+
+    def readline(self):
+        '''@return: a line, without the final CRLF, None on EOF.'''
+        line = self.file.readline()
+        if not line:
+            return None
+        return line[:-2]
+
+    def read(self, size):
+        return self.file.read(size)
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def read_command(self):
+        '''Reads a command, with its literals.
+
+        @return: (tag, name, args), or None on EOF.
+        '''
+        line = self.readline()
+        if line is None:
+            return None
+        command = line
+        literal = literal_re.search(line)
+        while literal:
+            if not literal.group(2):
+                self.send('+ go ahead\r\n')
+            command += '\r\n' + self.read(int(literal.group(1)))
+            line = self.readline()
+            command += line
+            literal = literal_re.search(line)
+
+        tag, command = command.split(' ', 1)
+        parts = command.split(' ', 1)
+        name = parts[0].upper()
+        args = len(parts) > 1 and parts[1] or ''
+        if name == 'UID':
+            parts = args.split(' ', 1)
+            name = 'UID %s' % parts[0].upper()
+            args = len(parts) > 1 and parts[1] or ''
+        return tag, name, args
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+class IMAPServer(object):
+    '''Answers the IMAP commands of any number of connections.'''
+    greeting = '* OK [CAPABILITY IMAP4rev1] ready\r\n'
+    capability = 'IMAP4rev1'
+
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+
+        self.lock = threading.Lock()
+        self.connections = []
+        self.commands = []      # (connection number, name, args)
+
+        thread = threading.Thread(target = self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except socket.error:
+                return
+            conn = Connection(self, sock)
+            with self.lock:
+                self.connections.append(conn)
+                conn.number = len(self.connections)
+            thread = threading.Thread(target = self.handle, args = (conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        try:
+            conn.send(self.greeting)
+            while True:
+                command = conn.read_command()
+                if command is None:
+                    break
+                tag, name, args = command
+                with self.lock:
+                    self.commands.append( (conn.number, name, args) )
+                method = getattr(self, 'do_' + name.replace(' ', '_'),
+                    self.do_default)
+                if method(conn, tag, args) is False or name == 'LOGOUT':
+                    break
+        except socket.error:
+            pass
+        finally:
+            # A failed handler closes the connection, the client gets an
+            # error instead of waiting forever
+            conn.close()
+
+    def names(self, number = None):
+        '''@return: the names of the commands received, on all the
+        connections or on a given one.'''
+        with self.lock:
+            return [ name for conn, name, args in self.commands
+                     if number is None or conn == number ]
+
+    def close(self):
+        # The shutdown wakes up the accept, the new connections are refused
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.listener.close()
+        with self.lock:
+            connections = list(self.connections)
+        for conn in connections:
+            conn.close()
+
+    # Command handlers, they can return False to close the connection
+
+    def do_default(self, conn, tag, args):
+        conn.send('%s OK done\r\n' % tag)
+
+    def do_CAPABILITY(self, conn, tag, args):
+        conn.send('* CAPABILITY %s\r\n%s OK done\r\n' % (self.capability,
+            tag))
+
+    def do_SELECT(self, conn, tag, args):
+        conn.send('* 3 EXISTS\r\n* 0 RECENT\r\n* OK [UIDVALIDITY 42] ok\r\n'
+            '%s OK [READ-WRITE] done\r\n' % tag)
+
+    do_EXAMINE = do_SELECT
+
+    def do_LOGOUT(self, conn, tag, args):
+        conn.send('* BYE logging out\r\n%s OK done\r\n' % tag)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+'''The FETCH responses are parsed as they arrive.
+
+A thread plays the server on a local socket. It sends the first FETCH
+response and waits until the client has parsed it before sending the
+others, a client that collects the whole FETCH before parsing it never gets
+there.
+
+Run with::
+
+    python -m unittest discover tests
+'''
+
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from imaplibii.imapp import IMAP4P
+from imaplibii.utils import LiteralHandle
+
+WAIT = 5    # Max seconds the server waits for the client
+
+FIRST = 'Subject: first\r\n\r\n' + 'a' * 50000 + '\r\n'
+SECOND = 'Subject: second\r\n\r\n' + 'b' * 70000 + '\r\n'
+
+class FetchServer(object):
+    '''Answers the commands of a single connection, the FETCH responses are
+    sent one by one, see fetch.'''
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+
+        self.client = None      # IMAP4P instance, set by the test
+        self.parsed_early = None
+
+        self.thread = threading.Thread(target = self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        sock, address = self.listener.accept()
+        self.listener.close()
+        f = sock.makefile('rb')
+        sock.sendall('* OK [CAPABILITY IMAP4rev1] ready\r\n')
+        for line in iter(f.readline, ''):
+            tag, command = line.split(' ', 2)[:2]
+            command = command.strip().upper()
+            if command == 'FETCH':
+                self.fetch(sock)
+            elif command == 'SELECT':
+                sock.sendall('* 2 EXISTS\r\n* OK [UIDVALIDITY 1] ok\r\n')
+            sock.sendall('%s OK done\r\n' % tag)
+            if command == 'LOGOUT':
+                break
+        sock.close()
+
+    def fetch(self, sock):
+        sock.sendall('* 1 FETCH (UID 11 BODY[] {%d}\r\n%s FLAGS (\\Seen))\r\n'
+            % (len(FIRST), FIRST))
+
+        # Wait until the client has the first message
+        deadline = time.time() + WAIT
+        while time.time() < deadline:
+            if 11 in self.client.sstatus.get('fetch_response', {}):
+                self.parsed_early = True
+                break
+            time.sleep(0.01)
+        else:
+            self.parsed_early = False
+
+        # The literal of the second message is sent in pieces
+        sock.sendall('* 2 FETCH (UID 12 FLAGS () BODY[] {%d}\r\n' %
+            len(SECOND))
+        for pos in range(0, len(SECOND), 16384):
+            sock.sendall(SECOND[pos:pos+16384])
+        sock.sendall(')\r\n')
+
+class FetchStreamingTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FetchServer()
+        self.client = IMAP4P('127.0.0.1', self.server.port,
+            autologout = False)
+        self.server.client = self.client
+        self.client.login('user', 'password')
+        self.client.select('INBOX')
+
+    def tearDown(self):
+        self.client.logout()
+        self.server.thread.join(WAIT)
+
+    def test_parsed_while_arriving(self):
+        response = self.client.fetch('1:2', '(UID BODY[] FLAGS)')
+
+        self.assertTrue(self.server.parsed_early)
+        self.assertEqual(sorted(response), [11, 12])
+        self.assertEqual(response[11]['BODY[]'], FIRST)
+        self.assertEqual(response[11]['FLAGS'], ['\\Seen'])
+        self.assertEqual(response[12]['BODY[]'], SECOND)
+        self.assertEqual(response[12]['FLAGS'], [])
+
+    def test_sink(self):
+        sink = tempfile.TemporaryFile()
+        response = self.client.fetch('1:2', '(UID BODY[] FLAGS)', sink = sink,
+            sink_threshold = 60000)
+
+        self.assertTrue(self.server.parsed_early)
+        self.assertEqual(response[11]['BODY[]'], FIRST)
+        handle = response[12]['BODY[]']
+        self.assertTrue(isinstance(handle, LiteralHandle))
+        self.assertEqual(handle.read(), SECOND)
+        self.assertEqual(response[12]['FLAGS'], [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+'''The LRU cache, and its use as the BODYSTRUCTURE cache of IMAP4P.
+
+Run with::
+
+    python -m unittest discover tests
+'''
+
+import threading
+import unittest
+
+from imaplibii.imapp import IMAP4P
+from imaplibii.utils import LRUCache, SequenceSet
+
+from imapserver import IMAPServer
+
+class LRUCacheTest(unittest.TestCase):
+    def test_max_entries(self):
+        cache = LRUCache(max_entries = 3)
+        for key in 'abcd':
+            cache.set(key, key.upper())
+        self.assertEqual(sorted(cache.keys()), ['b', 'c', 'd'])
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 1), 1)
+        self.assertEqual(cache.get('b'), 'B')
+
+    def test_recently_used(self):
+        cache = LRUCache(max_entries = 3)
+        for key in 'abc':
+            cache.set(key, key.upper())
+        cache.get('a')
+        cache.set('d', 'D')
+        self.assertFalse('b' in cache)
+        self.assertTrue('a' in cache)
+        # Storing a value again also counts as a use
+        cache.set('c', 'C')
+        cache.set('e', 'E')
+        self.assertEqual(sorted(cache.keys()), ['c', 'd', 'e'])
+
+    def test_max_bytes(self):
+        cache = LRUCache(max_entries = 100, max_bytes = 100)
+        cache.set('a', 'A', 40)
+        cache.set('b', 'B', 40)
+        self.assertEqual(cache.size, 80)
+        cache.set('c', 'C', 40)
+        self.assertEqual(sorted(cache.keys()), ['b', 'c'])
+        self.assertEqual(cache.size, 80)
+        # Replacing a value replaces its size
+        cache.set('b', 'B', 10)
+        self.assertEqual(cache.size, 50)
+        # A value bigger than the cache isn't kept
+        cache.set('d', 'D', 101)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_discard_clear(self):
+        cache = LRUCache()
+        cache.set('a', 'A', 10)
+        cache.set('b', 'B', 20)
+        cache.discard('a')
+        cache.discard('z')
+        self.assertEqual(cache.keys(), ['b'])
+        self.assertEqual(cache.size, 20)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_threads(self):
+        cache = LRUCache(max_entries = 50, max_bytes = 500)
+        def worker(start):
+            for i in range(2000):
+                key = (start + i) % 80
+                if cache.get(key) is None:
+                    cache.set(key, key, key % 20)
+        threads = [ threading.Thread(target = worker, args = (i * 7,))
+                    for i in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(len(cache) <= 50)
+        self.assertEqual(cache.size, sum( key % 20 for key in cache.keys() ))
+        self.assertTrue(cache.size <= 500)
+
+STRUCTURE = '("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" %d 1 NIL ' \
+    'NIL NIL)'
+
+class StructureServer(IMAPServer):
+    '''Messages with UIDs 1 to 3, the UIDVALIDITY can be changed.'''
+    uidvalidity = 42
+
+    def do_SELECT(self, conn, tag, args):
+        conn.send('* 3 EXISTS\r\n* OK [UIDVALIDITY %d] ok\r\n'
+            '%s OK [READ-WRITE] done\r\n' % (self.uidvalidity, tag))
+
+    def do_UID_FETCH(self, conn, tag, args):
+        for uid in SequenceSet(args.split()[0]):
+            conn.send('* %d FETCH (UID %d BODYSTRUCTURE %s)\r\n' % (uid, uid,
+                STRUCTURE % (uid * 100)))
+        conn.send('%s OK done\r\n' % tag)
+
+class StructureCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StructureServer()
+        self.client = IMAP4P('127.0.0.1', self.server.port,
+            autologout = False, structure_cache = LRUCache())
+        self.client.login('user', 'password')
+        self.client.select('INBOX')
+
+    def tearDown(self):
+        self.client.logout()
+        self.server.close()
+
+    def fetches(self):
+        return [ args for conn, name, args in self.server.commands
+                 if name == 'UID FETCH' ]
+
+    def test_cached(self):
+        first = self.client.fetch_structure([1, 2])
+        second = self.client.fetch_structure([1, '2', 3])
+        self.assertEqual(self.fetches(), ['1:2 (UID BODYSTRUCTURE)',
+            '3 (UID BODYSTRUCTURE)'])
+        self.assertEqual(sorted(second), [1, 2, 3])
+        self.assertTrue(second[1]['BODYSTRUCTURE'] is
+            first[1]['BODYSTRUCTURE'])
+        # The same plain dicts whether cached or fetched
+        for response in second.values():
+            self.assertEqual(type(response), dict)
+            self.assertEqual(sorted(response), ['BODYSTRUCTURE', 'UID'])
+
+    def test_uidvalidity(self):
+        self.client.fetch_structure([1])
+        self.client.select('INBOX')
+        self.client.fetch_structure([1])
+        self.assertEqual(len(self.fetches()), 1)
+
+        self.server.uidvalidity = 43
+        self.client.select('INBOX')
+        self.client.fetch_structure([1])
+        self.assertEqual(len(self.fetches()), 2)
+
+if __name__ == '__main__':
+    unittest.main()
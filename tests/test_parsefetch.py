@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+'''The FETCH response parser, FetchParser.
+
+A lazy FetchParser must look the same as an eager one whatever the way its
+data items are reached, and the single pass parser of the usual layouts,
+fetch_data_items, must agree with the generic one.
+
+Run with::
+
+    python -m unittest discover tests
+'''
+
+import unittest
+
+from imaplibii.parsefetch import FetchParser, fetch_data_items, \
+    scan_data_items
+
+RESPONSE = ('(UID 31608 FLAGS (\\Seen) RFC822.SIZE 4509 INTERNALDATE '
+    '"30-Jan-2008 02:48:01 +0000" ENVELOPE ("Tue, 29 Jan 2008 14:00:24 +0000" '
+    '"Aprenda as tecnicas" (("Ediclube" NIL "ediclube" "sigmathis.info")) '
+    '(("Ediclube" NIL "ediclube" "sigmathis.info")) '
+    '((NIL NIL "ediclube" "sigmathis.info")) '
+    '((NIL NIL "helder" "example.com")) NIL NIL NIL "<id@localhost>"))')
+
+# The body structures don't compare by value, this one is only checked for
+# its type
+STRUCTURE = ('(UID 1 BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "us-ascii") '
+    'NIL NIL "7BIT" 25 1 NIL NIL NIL))')
+
+class FetchParserLazyTest(unittest.TestCase):
+    def setUp(self):
+        self.eager = FetchParser(RESPONSE)
+        self.lazy = FetchParser(RESPONSE, True)
+        self.assertTrue(self.lazy.pending_items)
+
+    def test_getitem(self):
+        for key in self.eager:
+            self.assertEqual(self.lazy[key], self.eager[key])
+
+    def test_dict(self):
+        self.assertEqual(dict(self.lazy), dict(self.eager))
+
+    def test_eq(self):
+        self.assertTrue(self.lazy == self.eager)
+        self.assertTrue(self.lazy == dict(self.eager))
+        self.assertTrue(dict(self.eager) == self.lazy)
+        self.assertFalse(self.lazy != self.eager)
+
+    def test_get(self):
+        self.assertEqual(self.lazy.get('ENVELOPE'), self.eager['ENVELOPE'])
+        self.assertEqual(self.lazy.get('BODY[]', 1), 1)
+
+    def test_setdefault(self):
+        self.assertEqual(self.lazy.setdefault('ENVELOPE', None),
+            self.eager['ENVELOPE'])
+
+    def test_pop(self):
+        self.assertEqual(self.lazy.pop('ENVELOPE'), self.eager['ENVELOPE'])
+        self.assertFalse('ENVELOPE' in self.lazy)
+
+    def test_popitem(self):
+        while self.lazy:
+            key, value = self.lazy.popitem()
+            self.assertEqual(value, self.eager[key])
+
+    def test_viewitems(self):
+        self.assertEqual(sorted(self.lazy.viewitems()),
+            sorted(self.eager.items()))
+
+    def test_items(self):
+        self.assertEqual(sorted(self.lazy.items()), sorted(self.eager.items()))
+
+    def test_iteritems(self):
+        self.assertEqual(sorted(self.lazy.iteritems()),
+            sorted(self.eager.items()))
+
+    def test_viewvalues(self):
+        self.assertEqual(sorted(self.lazy.viewvalues()),
+            sorted(self.eager.values()))
+
+    def test_values(self):
+        self.assertEqual(sorted(self.lazy.values()),
+            sorted(self.eager.values()))
+
+    def test_itervalues(self):
+        self.assertEqual(sorted(self.lazy.itervalues()),
+            sorted(self.eager.values()))
+
+    def test_keys(self):
+        self.assertEqual(sorted(self.lazy.keys()), sorted(self.eager.keys()))
+        self.assertEqual(sorted(self.lazy.viewkeys()),
+            sorted(self.eager.keys()))
+        self.assertTrue(self.lazy.has_key('ENVELOPE'))
+        self.assertEqual(len(self.lazy), len(self.eager))
+
+    def test_copy(self):
+        self.assertEqual(self.lazy.copy(), dict(self.eager))
+
+    def test_repr(self):
+        self.assertEqual(repr(self.lazy), repr(self.eager))
+
+    def test_structure(self):
+        lazy = FetchParser(STRUCTURE, True)
+        self.assertTrue(isinstance(dict(lazy)['BODYSTRUCTURE'],
+            type(FetchParser(STRUCTURE)['BODYSTRUCTURE'])))
+
+    def test_update(self):
+        self.lazy.update({'ENVELOPE': 1})
+        self.assertEqual(self.lazy['ENVELOPE'], 1)
+        self.assertEqual(dict(self.lazy)['ENVELOPE'], 1)
+
+# Responses fetch_data_items parses on its own
+FAST = [
+    RESPONSE,
+    '(UID 1 FLAGS ())',
+    '(FLAGS (\\Seen \\Answered) UID 4294967295)',
+    '(UID 2 FLAGS (\\Seen 123 NIL $Forwarded))',
+    '(UID 3 FLAGS (123 \\Seen))',
+    '(UID 4 FLAGS (\\Seen  \\Deleted) RFC822.SIZE 0)',
+    '(UID 5 INTERNALDATE "01-Jan-2000 00:00:00 +0000")',
+    '(UID 6 ENVELOPE (NIL "123" NIL NIL NIL NIL NIL NIL NIL NIL))',
+    '(UID 7 ENVELOPE ("date" "a \\"quoted\\" subject" ((NIL NIL "a" "b") '
+        '("N" NIL "c" "d")) NIL NIL NIL NIL NIL "<x>" "<y>"))',
+    '(UID 8 BODYSTRUCTURE ("TEXT" "PLAIN" NIL NIL NIL "7BIT" 25 1 NIL NIL '
+        'NIL) FLAGS (\\Seen))',
+    ]
+
+# Responses left to the generic parser, at least in part
+GENERIC = [
+    '(UID 9 FLAGS (a[b c]))',
+    '(UID 10 FLAGS ("quoted"))',
+    '(UID 11 ENVELOPE (NIL {5}\r\nhello NIL NIL NIL NIL NIL NIL NIL NIL))',
+    '(UID 12 INTERNALDATE "01-Jan-2000 \\"00:00:00 +0000")',
+    ]
+
+class FetchDataItemsTest(unittest.TestCase):
+    def test_fast_path(self):
+        for response in FAST:
+            self.assertNotEqual(fetch_data_items(response), None)
+
+    def test_same_result(self):
+        for response in FAST + GENERIC:
+            fast = fetch_data_items(response)
+            if fast is not None:
+                self.assertEqual(fast, scan_data_items(response))
+
+    def test_flags(self):
+        self.assertEqual(fetch_data_items('(FLAGS (\\Seen 123 NIL))'),
+            {'FLAGS': ['\\Seen', 123, None]})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+'''The resumable download of messages with partial fetches.
+
+Run with::
+
+    python -m unittest discover tests
+'''
+
+import re
+import tempfile
+import unittest
+
+from imaplibii.imapp import IMAP4P
+from imaplibii.partial import PartialDownloader, DownloadError
+
+from imapserver import IMAPServer
+
+MESSAGE = ''.join( '%04d:' % i + 'x' * 94 + '\r\n' for i in range(45) )
+
+partial_re = re.compile(r'BODY\.PEEK\[([^]]*)\]<(\d+)\.(\d+)>')
+
+class PartialServer(IMAPServer):
+    '''Serves the messages on self.messages, {uid: text}.'''
+    def __init__(self):
+        IMAPServer.__init__(self)
+        self.messages = {7: MESSAGE}
+        self.uidvalidity = 42
+        self.drop = []          # Partial fetches to drop, counting from 1
+        self.renumber = False   # Change the UIDVALIDITY when dropping
+        self.chunks = []        # (connection number, offset, size)
+
+    def do_EXAMINE(self, conn, tag, args):
+        conn.send('* 3 EXISTS\r\n* 0 RECENT\r\n* OK [UIDVALIDITY %d] ok\r\n'
+            '%s OK [READ-ONLY] done\r\n' % (self.uidvalidity, tag))
+
+    def do_UID_FETCH(self, conn, tag, args):
+        uid, items = args.split(' ', 1)
+        uid = int(uid)
+        if uid in self.messages:
+            text = self.messages[uid]
+            partial = partial_re.search(items)
+            if partial:
+                offset, size = int(partial.group(2)), int(partial.group(3))
+                with self.lock:
+                    self.chunks.append( (conn.number, offset, size) )
+                    if len(self.chunks) in self.drop:
+                        if self.renumber:
+                            self.uidvalidity += 1
+                        return False
+                data = text[offset:offset+size]
+                conn.send('* 1 FETCH (UID %d BODY[%s]<%d> {%d}\r\n%s)\r\n' %
+                    (uid, partial.group(1), offset, len(data), data))
+            elif 'RFC822.SIZE' in items:
+                conn.send('* 1 FETCH (UID %d RFC822.SIZE %d)\r\n' %
+                    (uid, len(text)))
+        conn.send('%s OK done\r\n' % tag)
+
+class PartialDownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = PartialServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def connect(self):
+        session = IMAP4P('127.0.0.1', self.server.port, autologout = False)
+        session.login('user', 'password')
+        return session
+
+    def downloader(self, uid = 7, **kwargs):
+        return PartialDownloader(self.connect, 'INBOX', uid,
+            chunk_size = 1000, retry_delay = 0, **kwargs)
+
+    def offsets(self):
+        return [ offset for number, offset, size in self.server.chunks ]
+
+    def test_sequential(self):
+        sink = tempfile.TemporaryFile()
+        self.assertEqual(self.downloader().download(sink), len(MESSAGE))
+        sink.seek(0)
+        self.assertEqual(sink.read(), MESSAGE)
+        self.assertEqual(self.offsets(), range(0, len(MESSAGE), 1000))
+        self.assertEqual(self.server.chunks[-1][2], len(MESSAGE) % 1000)
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(self.server.names(1)[-1], 'LOGOUT')
+
+    def test_parallel(self):
+        sink = tempfile.TemporaryFile()
+        downloader = self.downloader()
+        downloader.download(sink, workers = 3)
+        sink.seek(0)
+        self.assertEqual(sink.read(), MESSAGE)
+        self.assertEqual(downloader.offset, len(MESSAGE))
+        self.assertEqual(sorted(self.offsets()), range(0, len(MESSAGE), 1000))
+        self.assertEqual(len(self.server.connections), 3)
+
+    def test_connection_lost(self):
+        # The download goes on from the chunk lost, on a new connection
+        self.server.drop = [3]
+        sink = tempfile.TemporaryFile()
+        self.downloader().download(sink)
+        sink.seek(0)
+        self.assertEqual(sink.read(), MESSAGE)
+        self.assertEqual(self.offsets(), [0, 1000, 2000, 2000, 3000, 4000])
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_resume(self):
+        sink = tempfile.TemporaryFile()
+        sink.write(MESSAGE[:2000])
+        self.downloader(offset = 2000).download(sink)
+        sink.seek(0)
+        self.assertEqual(sink.read(), MESSAGE)
+        self.assertEqual(self.offsets(), [2000, 3000, 4000])
+
+    def test_give_up(self):
+        self.server.drop = range(1, 10)
+        downloader = self.downloader(retries = 2)
+        self.assertRaises(DownloadError, downloader.download,
+            tempfile.TemporaryFile())
+        self.assertEqual(len(self.server.chunks), 3)
+        self.assertEqual(downloader.offset, 0)
+
+    def test_uidvalidity_changed(self):
+        self.server.drop = [2]
+        self.server.renumber = True
+        downloader = self.downloader()
+        self.assertRaises(DownloadError, downloader.download,
+            tempfile.TemporaryFile())
+        # The new connection finds other message with the same uid
+        self.assertEqual(self.offsets(), [0, 1000])
+        self.assertEqual(downloader.offset, 1000)
+
+    def test_not_found(self):
+        self.assertRaises(DownloadError, self.downloader(uid = 8).download,
+            tempfile.TemporaryFile())
+
+if __name__ == '__main__':
+    unittest.main()
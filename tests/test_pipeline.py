@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+'''Command pipelining, IMAP4.pipeline and the PendingCommand handles.
+
+The server reads all the pipelined commands before answering, and answers
+them out of order.
+
+Run with::
+
+    python -m unittest discover tests
+'''
+
+import threading
+import unittest
+
+from imaplibii.imapll import IMAP4
+
+from imapserver import IMAPServer
+
+WAIT = 5    # Max seconds the client waits for the server
+
+class PipelineServer(IMAPServer):
+    '''The NOOP commands are answered in groups of three, the tagged
+    responses in the order 1, 3, 2.'''
+    def __init__(self):
+        IMAPServer.__init__(self)
+        self.tags = []
+
+    def do_NOOP(self, conn, tag, args):
+        self.tags.append(tag)
+        if len(self.tags) < 3:
+            return
+        first, second, third = self.tags
+        self.tags = []
+        conn.send('* 1 EXISTS\r\n%s OK first\r\n' % first)
+        conn.send('%s OK third\r\n' % third)
+        conn.send('* 2 EXISTS\r\n%s OK second\r\n' % second)
+
+    def do_APPEND(self, conn, tag, args):
+        conn.send('%s OK appended\r\n' % tag)
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.server = PipelineServer()
+        self.client = IMAP4('127.0.0.1', self.server.port)
+        self.client.sock.settimeout(WAIT)
+
+    def tearDown(self):
+        self.client.send_command('LOGOUT')
+        self.client.shutdown()
+        self.server.close()
+
+    def test_out_of_order(self):
+        completed = []
+        handles = self.client.pipeline(['NOOP'] * 3,
+            callback = lambda handle: completed.append(handle.tag))
+        self.assertFalse([ handle for handle in handles if handle.done() ])
+
+        # Reading the third response reads the first one on the way
+        third = handles[2].result()
+        self.assertEqual(completed, [handles[0].tag, handles[2].tag])
+        self.assertFalse(handles[1].done())
+        self.assertEqual(third['tagged'][handles[2].tag]['message'], 'third')
+        self.assertEqual(third['untagged'], [])
+
+        # The untagged responses go to the oldest command still pending
+        first = handles[0].result()
+        self.assertEqual(first['untagged'], ['* 1 EXISTS'])
+        second = handles[1].result()
+        self.assertEqual(second['untagged'], ['* 2 EXISTS'])
+        self.assertEqual(completed, [handles[0].tag, handles[2].tag,
+            handles[1].tag])
+        self.assertEqual(self.client.pending, [])
+
+    def test_send_command_completes_pipeline(self):
+        handles = self.client.pipeline(['NOOP'] * 3)
+        self.client.send_command('CAPABILITY')
+        self.assertTrue(all( handle.done() for handle in handles ))
+
+    def test_synchronizing_literal(self):
+        self.assertRaises(IMAP4.Error, self.client.pipeline,
+            ['APPEND INBOX {5}\r\nhello'])
+        self.assertEqual(self.client.pending, [])
+
+    def test_non_synchronizing_literal(self):
+        self.client.nonsync_literals = 'LITERAL+'
+        handle, = self.client.pipeline(['APPEND INBOX {5}\r\nhello'])
+        response = handle.result()
+        self.assertEqual(response['tagged'][handle.tag]['status'], 'OK')
+        self.assertEqual(self.server.commands[-1][1:],
+            ('APPEND', 'INBOX {5+}\r\nhello'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+'''The pool of IMAP4P sessions.
+
+Run with::
+
+    python -m unittest discover tests
+'''
+
+import threading
+import time
+import unittest
+
+from imaplibii.imapp import IMAP4P
+from imaplibii.pool import IMAP4PPool, PoolExhausted
+
+from imapserver import IMAPServer
+
+class PoolServer(IMAPServer):
+    def __init__(self):
+        IMAPServer.__init__(self)
+        self.drop_noop = False
+
+    def do_NOOP(self, conn, tag, args):
+        if self.drop_noop:
+            return False
+        conn.send('%s OK done\r\n' % tag)
+
+class PoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = PoolServer()
+        self.pool = IMAP4PPool(max_connections = 2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+
+    def get(self, user = 'user', password = 'password', **kwargs):
+        return self.pool.get('127.0.0.1', user, password,
+            port = self.server.port, **kwargs)
+
+    def test_reuse(self):
+        session = self.get()
+        self.assertTrue(isinstance(session, IMAP4P))
+        self.assertEqual(session.state, 'AUTH')
+        self.pool.release(session)
+        self.assertTrue(self.get() is session)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_keys(self):
+        session = self.get()
+        self.pool.release(session)
+        other = self.get(user = 'other')
+        self.assertFalse(other is session)
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_exhausted(self):
+        sessions = [ self.get(), self.get() ]
+        self.assertRaises(PoolExhausted, self.get, block = False)
+        self.assertRaises(PoolExhausted, self.get, timeout = 0.05)
+
+        # A blocked get takes the first session released
+        timer = threading.Timer(0.05, self.pool.release, (sessions[1],))
+        timer.start()
+        self.assertTrue(self.get(timeout = 5) is sessions[1])
+        timer.join()
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_discard(self):
+        session = self.get()
+        self.pool.release(session, discard = True)
+        self.assertEqual(self.server.names(1)[-1], 'LOGOUT')
+        self.assertFalse(self.get() is session)
+        self.assertEqual(self.pool.count.values(), [1])
+
+    def test_password_change(self):
+        session = self.get()
+        self.pool.release(session)
+        other = self.get(password = 'new password')
+        self.assertFalse(other is session)
+        self.assertEqual(self.server.names(1)[-1], 'LOGOUT')
+
+        # The sessions out of the pool with the old password aren't reused
+        self.pool.release(other)
+        self.assertTrue(self.get(password = 'new password') is other)
+
+    def test_check(self):
+        self.pool.check_after = 0
+        session = self.get()
+        self.pool.release(session)
+        self.assertTrue(self.get() is session)
+        self.assertEqual(self.server.names(1)[-1], 'NOOP')
+        self.pool.release(session)
+
+        # A dead session is replaced
+        self.server.drop_noop = True
+        other = self.get()
+        self.assertFalse(other is session)
+        self.assertEqual(len(self.server.connections), 2)
+        self.assertEqual(self.pool.count.values(), [1])
+
+    def test_prune(self):
+        session = self.get()
+        self.pool.release(session)
+        self.pool.prune()
+        self.assertEqual(len(self.pool.idle.values()[0]), 1)
+
+        self.pool.max_idle = 0
+        time.sleep(0.01)
+        self.pool.prune()
+        self.assertEqual(self.pool.idle.values(), [[]])
+        self.assertEqual(self.pool.count.values(), [0])
+        self.assertEqual(self.server.names(1)[-1], 'LOGOUT')
+
+    def test_close(self):
+        sessions = [ self.get(), self.get() ]
+        self.pool.release(sessions[0])
+        self.pool.close()
+        self.assertEqual(self.server.names(1)[-1], 'LOGOUT')
+        self.assertNotEqual(self.server.names(2)[-1], 'LOGOUT')
+        self.assertEqual(self.pool.count.values(), [1])
+        self.pool.release(sessions[1], discard = True)
+
+    def test_session(self):
+        with self.pool.session('127.0.0.1', 'user', 'password',
+                port = self.server.port) as session:
+            session.select('INBOX')
+        self.assertTrue(self.get() is session)
+        self.pool.release(session)
+
+        # The session is discarded when the connection fails
+        try:
+            with self.pool.session('127.0.0.1', 'user', 'password',
+                    port = self.server.port) as session:
+                raise IMAP4P.Abort('connection lost')
+        except IMAP4P.Abort:
+            pass
+        self.assertEqual(self.pool.count.values(), [0])
+        self.assertEqual(self.server.names(1)[-1], 'LOGOUT')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+'''The resilient mode of IMAP4P, the connection is opened again when lost.
+
+The server closes the connection, without answering, on the first command
+named on its drop set.
+
+Run with::
+
+    python -m unittest discover tests
+'''
+
+import socket
+import unittest
+
+from imaplibii.imapll import IMAP4
+from imaplibii.imapp import IMAP4P
+
+from imapserver import IMAPServer
+
+LOST = (IMAP4.Abort, IMAP4P.Abort, socket.error)
+
+class DropServer(IMAPServer):
+    def __init__(self):
+        IMAPServer.__init__(self)
+        self.drop = set()
+        self.uidvalidity = 42
+
+    def do_default(self, conn, tag, args):
+        with self.lock:
+            name = self.commands[-1][1]
+            if name in self.drop:
+                self.drop.remove(name)
+                return False
+        conn.send('%s OK done\r\n' % tag)
+
+    def do_SELECT(self, conn, tag, args):
+        conn.send('* 3 EXISTS\r\n* 0 RECENT\r\n* OK [UIDVALIDITY %d] ok\r\n'
+            '%s OK [READ-WRITE] done\r\n' % (self.uidvalidity, tag))
+
+    def do_FETCH(self, conn, tag, args):
+        if self.do_default(conn, tag, args) is False:
+            return False
+
+    do_UID_FETCH = do_FETCH
+
+class ReconnectTest(unittest.TestCase):
+    def setUp(self):
+        self.server = DropServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def connect(self, reconnect = True):
+        client = IMAP4P('127.0.0.1', self.server.port, autologout = False,
+            reconnect = reconnect)
+        client.reconnect_delay = 0
+        client.login('user', 'password')
+        client.select('INBOX')
+        return client
+
+    def test_replay(self):
+        client = self.connect()
+        self.server.drop.add('NOOP')
+        client.noop()
+
+        # The session is restored on the new connection before the NOOP is
+        # sent again
+        self.assertEqual(len(self.server.connections), 2)
+        names = self.server.names(2)
+        self.assertEqual(names[names.index('LOGIN'):],
+            ['LOGIN', 'CAPABILITY', 'SELECT', 'NOOP'])
+        self.assertEqual(self.server.commands[-2][2], '"INBOX"')
+        self.assertEqual(client.sstatus['current_folder']['UIDVALIDITY'], 42)
+
+    def test_not_idempotent(self):
+        client = self.connect()
+        self.server.drop.add('STORE')
+        self.assertRaises(LOST, client.store, '1', '+FLAGS', '(\\Seen)')
+
+        # Reconnected, but the STORE isn't sent again
+        self.assertEqual(self.server.names().count('STORE'), 1)
+        self.assertEqual(self.server.names(2)[-1], 'SELECT')
+        client.noop()
+        self.assertEqual(self.server.names(2)[-1], 'NOOP')
+
+    def test_uidvalidity_changed(self):
+        client = self.connect()
+        self.server.drop.add('UID FETCH')
+        self.server.uidvalidity = 43
+        self.assertRaises(LOST, client.fetch_uid, '1', '(FLAGS)')
+        self.assertEqual(self.server.names().count('UID FETCH'), 1)
+
+        # The message sequence numbers are still meaningful
+        self.server.drop.add('SEARCH')
+        client.search('ALL')
+        self.assertEqual(self.server.names(3)[-1], 'SEARCH')
+
+    def test_no_reconnect(self):
+        client = self.connect(reconnect = False)
+        self.server.drop.add('NOOP')
+        self.assertRaises(LOST, client.noop)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_give_up(self):
+        client = self.connect()
+        client.reconnect_attempts = 2
+        self.server.close()
+        self.assertRaises(IMAP4P.Abort, client.noop)
+        self.assertFalse(client.connected)
+
+if __name__ == '__main__':
+    unittest.main()
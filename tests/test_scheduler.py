@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+'''The timer wheel of the keepalive scheduler.
+
+The wheel reads the time through the time module of imaplibii.scheduler,
+it's replaced by a clock the tests move by hand.
+
+Run with::
+
+    python -m unittest discover tests
+'''
+
+import math
+import random
+import threading
+import unittest
+
+from imaplibii import scheduler
+from imaplibii.scheduler import TimerWheel
+
+class Clock(object):
+    '''Stands for the time module.'''
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.time = scheduler.time
+        self.clock = scheduler.time = Clock()
+        self.wheel = TimerWheel(tick = 1.0, slots = 8, levels = 3)
+        self.fired = []
+
+    def tearDown(self):
+        scheduler.time = self.time
+
+    def fire(self, name):
+        self.fired.append( (name, self.wheel.current) )
+
+    def run_until(self, seconds):
+        '''Moves the clock a second at a time, running the timers due.'''
+        while self.clock.now < 1000 + seconds:
+            self.clock.now += 1
+            self.wheel.run_pending()
+
+    def test_order(self):
+        for delay in (3, 0.5, 1, 2.5):
+            self.wheel.schedule(delay, self.fire, delay)
+        self.assertEqual(len(self.wheel), 4)
+        self.run_until(5)
+        # The timers due on the same tick come in no particular order
+        self.assertEqual(sorted(self.fired, key = lambda (name, tick): tick),
+            self.fired)
+        self.assertEqual(sorted(self.fired), [(0.5, 1), (1, 1), (2.5, 3), (3, 3)])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_levels(self):
+        # With 8 slots and 3 levels the wheel covers 512 ticks, the later
+        # timers wait on the top level and are cascaded until due
+        random.seed(7)
+        delays = [ random.uniform(0, 2000) for i in range(300) ]
+        for delay in delays:
+            self.wheel.schedule(delay, self.fire, delay)
+        self.run_until(2001)
+
+        self.assertEqual(len(self.fired), len(delays))
+        for delay, tick in self.fired:
+            self.assertEqual(tick, max(1, int(math.ceil(delay))))
+
+    def test_jump(self):
+        # The ticks missed are all processed on the next run
+        for delay in (1, 10, 100):
+            self.wheel.schedule(delay, self.fire, delay)
+        self.clock.now += 150
+        self.wheel.run_pending()
+        self.assertEqual([ name for name, tick in self.fired ], [1, 10, 100])
+
+    def test_cancel(self):
+        timers = [ self.wheel.schedule(delay, self.fire, delay)
+                   for delay in (5, 50, 500) ]
+        self.assertTrue(timers[1].active())
+        timers[1].cancel()
+        self.assertFalse(timers[1].active())
+        self.assertEqual(len(self.wheel), 2)
+        self.run_until(600)
+        self.assertEqual([ name for name, tick in self.fired ], [5, 500])
+        # Cancelling a timer already called does nothing
+        timers[0].cancel()
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_schedule_from_callback(self):
+        def again(count):
+            self.fire(count)
+            if count < 3:
+                self.wheel.schedule(10, again, count + 1)
+        self.wheel.schedule(10, again, 1)
+        self.run_until(100)
+        self.assertEqual(self.fired, [(1, 10), (2, 20), (3, 30)])
+
+class TimerWheelThreadTest(unittest.TestCase):
+    def test_thread(self):
+        wheel = TimerWheel(tick = 0.01)
+        fired = threading.Event()
+        wheel.start()
+        try:
+            wheel.schedule(0.05, fired.set)
+            fired.wait(5)
+            self.assertTrue(fired.is_set())
+        finally:
+            wheel.stop()
+            wheel.thread.join(5)
+        self.assertFalse(wheel.thread.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+'''The message sets, SequenceSet and its split in command sized chunks.
+
+The set operations are checked against python sets of the same numbers.
+
+Run with::
+
+    python -m unittest discover tests
+'''
+
+import random
+import unittest
+
+from imaplibii.utils import SequenceSet, STAR, parse_sequence_set, \
+    shrink_fetch_list
+
+def random_numbers(count, top):
+    return random.sample(xrange(1, top), count)
+
+class SequenceSetTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(7)
+
+    def test_ranges(self):
+        self.assertEqual(SequenceSet([1, 2, 3, 5, 7, 8]).ranges,
+            [(1, 3), (5, 5), (7, 8)])
+        # Unsorted and repeated numbers
+        self.assertEqual(SequenceSet([8, 1, 3, 2, 7, 3, 5]).ranges,
+            [(1, 3), (5, 5), (7, 8)])
+        # Overlapping and adjacent ranges
+        self.assertEqual(SequenceSet(ranges = [(5, 9), (1, 4), (7, 12),
+            (20, 20)]).ranges, [(1, 12), (20, 20)])
+        self.assertEqual(SequenceSet([]).ranges, [])
+        self.assertFalse(SequenceSet())
+
+    def test_str(self):
+        numbers = SequenceSet([1, 2, 3, 5, 7, 8])
+        self.assertEqual(str(numbers), '1:3,5,7:8')
+        self.assertEqual(numbers.items(), ['1:3', '5', '7:8'])
+        self.assertEqual(shrink_fetch_list([1, 2, 3, 5]), ['1:3', '5'])
+
+    def test_parse(self):
+        numbers = parse_sequence_set('9,1:5,20:*,3')
+        self.assertEqual(numbers.ranges, [(1, 5), (9, 9), (20, STAR)])
+        self.assertEqual(str(numbers), '1:5,9,20:*')
+        self.assertEqual(SequenceSet('5:2,*').ranges, [(2, 5), (STAR, STAR)])
+        self.assertEqual(SequenceSet('*').items(), ['*'])
+        self.assertEqual(SequenceSet(numbers), numbers)
+
+    def test_contains(self):
+        numbers = SequenceSet('1:5,9,20:*')
+        for number in (1, 3, 5, 9, 20, 4294967295, '*'):
+            self.assertTrue(number in numbers)
+        for number in (0, 6, 8, 10, 19):
+            self.assertFalse(number in numbers)
+
+    def test_len_iter(self):
+        numbers = random_numbers(500, 2000)
+        sequence = SequenceSet(numbers)
+        self.assertEqual(len(sequence), 500)
+        self.assertEqual(list(sequence), sorted(numbers))
+        self.assertRaises(ValueError, next, iter(SequenceSet('1:*')))
+
+    def test_operations(self):
+        for i in range(20):
+            a = random_numbers(random.randint(0, 300), 1000)
+            b = random_numbers(random.randint(0, 300), 1000)
+            sa, sb = SequenceSet(a), SequenceSet(b)
+            self.assertEqual(list(sa | sb), sorted(set(a) | set(b)))
+            self.assertEqual(list(sa & sb), sorted(set(a) & set(b)))
+            self.assertEqual(list(sa - sb), sorted(set(a) - set(b)))
+            self.assertEqual(list(sb - sa), sorted(set(b) - set(a)))
+            # The results are normalised
+            self.assertEqual((sa | sb).ranges,
+                SequenceSet(list(sa | sb)).ranges)
+
+    def test_open_ranges(self):
+        a = SequenceSet('1:10,50:*')
+        b = SequenceSet('5:60')
+        self.assertEqual(str(a | b), '1:*')
+        self.assertEqual(str(a & b), '5:10,50:60')
+        self.assertEqual(str(a - b), '1:4,61:*')
+
+    def test_eq(self):
+        self.assertEqual(SequenceSet([3, 1, 2]), SequenceSet('1:3'))
+        self.assertNotEqual(SequenceSet([1, 2]), SequenceSet('1:3'))
+        self.assertNotEqual(SequenceSet([1]), [1])
+
+class ChunksTest(unittest.TestCase):
+    def test_chunks(self):
+        random.seed(7)
+        sequence = SequenceSet(random_numbers(5000, 100000))
+        for max_len in (20, 100, 1000):
+            chunks = list(sequence.chunks(max_len))
+            self.assertTrue(chunks)
+            for chunk in chunks:
+                self.assertTrue(len(chunk) <= max_len)
+            # Together the chunks are the whole set, in order
+            self.assertEqual(','.join(chunks), str(sequence))
+
+    def test_single_chunk(self):
+        self.assertEqual(list(SequenceSet('1:5,9').chunks(100)), ['1:5,9'])
+        self.assertEqual(list(SequenceSet().chunks(100)), [])
+
+    def test_long_item(self):
+        # An item longer than max_len goes alone on its chunk
+        self.assertEqual(list(SequenceSet('1:100000,5000000').chunks(5)),
+            ['1:100000', '5000000'])
+
+if __name__ == '__main__':
+    unittest.main()
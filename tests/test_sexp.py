@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of imaplib2.
+##
+## imaplib2 is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## imaplib2 is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+# $Id$
+#
+'''The incremental scanner, SexpScanner, must produce the same elements as
+scan_sexp whatever the way the response is split in chunks. FetchScanner
+must build the same FetchParser as the whole response.
+
+Run with::
+
+    python -m unittest discover tests
+'''
+
+import unittest
+
+from imaplibii.parsefetch import FetchParser, FetchScanner
+from imaplibii.sexp import SError, SexpScanner, scan_sexp
+
+RESPONSES = [
+    '* 1 FETCH (UID 7 BODY[1]<0> {3}\r\nabc FLAGS (\\Seen NIL 12))',
+    '* 2 FETCH (BODY[HEADER.FIELDS (Message-ID)] {5}\r\nhello '
+        'RFC822.SIZE 44)',
+    '* 3 FETCH (BODY[1] "quo\\"ted" BODY[2.MIME]<10> NIL BODY[] {0}\r\n)',
+    '* 4 FETCH (ENVELOPE ("Tue, 29 Jan 2008 14:00:24 +0000" {6}\r\n'
+        'a\r\nb\r\n (("Ediclube" NIL "ediclube" "sigmathis.info")) NIL NIL '
+        'NIL NIL NIL NIL "<id@host>") UID 31608)',
+    '* LIST (\\HasNoChildren) "/" "INBOX"',
+    '* SEARCH 2 84 882',
+    ]
+
+def scan_chunks(text, size):
+    '''Feeds text to a SexpScanner in chunks of size octets.'''
+    scanner = SexpScanner()
+    for pos in range(0, len(text), size):
+        scanner.feed(text[pos:pos+size])
+    return scanner.close()
+
+class SexpScannerTest(unittest.TestCase):
+    def test_char_by_char(self):
+        for response in RESPONSES:
+            self.assertEqual(scan_chunks(response + '\r\n', 1),
+                scan_sexp(response))
+
+    def test_chunks(self):
+        for response in RESPONSES:
+            for size in (2, 3, 5, 7, 11, 64):
+                self.assertEqual(scan_chunks(response + '\r\n', size),
+                    scan_sexp(response))
+
+    def test_elements_as_completed(self):
+        elements = []
+        scanner = SexpScanner(elements.append)
+        scanner.feed('* 1 FETCH (UID 5 BODY[] {10}\r\n')
+        self.assertEqual(elements, ['*', 1, 'FETCH'])
+        scanner.feed('0123456789')
+        scanner.feed(')\r\n* 2 FE')
+        self.assertEqual(elements[3], ['UID', 5, 'BODY[]', '0123456789'])
+        self.assertEqual(elements[4:], ['*', 2])
+        self.assertEqual(scanner.size, 49)
+
+    def test_iter(self):
+        scanner = SexpScanner()
+        scanner.feed('* SEARCH 2 84 ')
+        self.assertEqual(list(scanner), ['*', 'SEARCH', 2, 84])
+        scanner.feed('882\r\n')
+        self.assertEqual(list(scanner), [882])
+        self.assertEqual(scanner.close(), [])
+
+    def test_skip_literal(self):
+        scanner = SexpScanner()
+        scanner.feed('(BODY[] {100}\r\n')
+        scanner.skip_literal('handle')
+        scanner.feed(' UID 1)\r\n')
+        self.assertEqual(scanner.close(), [['BODY[]', 'handle', 'UID', 1]])
+        self.assertRaises(SError, scanner.skip_literal, 'handle')
+
+    def test_incomplete(self):
+        for text in ('(UID 1', '(BODY[] {5}\r\nabc', '"abc'):
+            scanner = SexpScanner()
+            scanner.feed(text)
+            self.assertRaises(SError, scanner.close)
+
+    def test_unexpected_parenthesis(self):
+        self.assertRaises(SError, SexpScanner().feed, 'UID 1)')
+
+class FetchScannerTest(unittest.TestCase):
+    def scan(self, response, size):
+        '''Feeds a FETCH response to a FetchScanner, like
+        IMAP4.scan_response does, in chunks of size octets.'''
+        fetched = []
+        scanner = FetchScanner(lambda *args: fetched.append(args))
+        text = response + '\r\n'
+        for pos in range(0, len(text), size):
+            scanner.feed(text[pos:pos+size])
+            # Parsed as soon as the final parenthesis arrives
+            self.assertEqual(len(fetched), int(pos + size >= len(response)))
+        return fetched[0]
+
+    def test_same_as_parser(self):
+        for response in RESPONSES:
+            if ' FETCH ' not in response:
+                continue
+            start = response.index(' FETCH ') + 7
+            for size in (1, 7, 4096):
+                msg_num, parsed = self.scan(response, size)
+                self.assertEqual(msg_num, int(response[2:start-7]))
+                self.assertEqual(dict(parsed),
+                    dict(FetchParser(response[start:])))
+                self.assertTrue(parsed.raw_size >= len(response))
+
+if __name__ == '__main__':
+    unittest.main()